@@ -0,0 +1,299 @@
+"""
+Killmail pipeline replay benchmark.
+
+Replays a recorded zKill killstream through the real KillWatch pipeline
+(enqueue -> worker -> process_killmail -> extract_mail_data -> build_embed -> send_kill -> dispatcher)
+using an in-process fake ESI responder and fake discord channels, then reports throughput, end to end latency,
+ESI calls per kill and peak memory.
+
+Record a killstream (one JSON message per line):
+    python -m benchmarks.kill_pipeline record killstream.jsonl --count 500
+
+Replay it:
+    python -m benchmarks.kill_pipeline replay killstream.jsonl --speed max
+    python -m benchmarks.kill_pipeline replay killstream.jsonl --speed 10 --esi-latency 0.05 --channels 200
+    python -m benchmarks.kill_pipeline replay killstream.jsonl --channels 200 --rate 5   # With discord's rate limit.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import tracemalloc
+from datetime import datetime
+
+from cogs.kill_watch.cog import KillWatch
+from cogs.kill_watch.helpers import RecentIds
+from cogs.kill_watch.routing import RoutingIndex
+from utils.cache import name_cache
+from utils.dispatch import Dispatcher
+from utils.metrics import metrics
+from utils.sde import UniverseIndex, UNIVERSE_PATH
+
+UNLIMITED_RATE = 10 ** 9   # Dispatcher rate used when --rate is 0; no channel ever runs out of tokens.
+
+
+class FakeOperation:
+    def __init__(self, name: str, kwargs: dict):
+        self.name = name
+        self.kwargs = kwargs
+
+
+class FakeEsiApp:
+    """
+    Stands in for the swagger app; op[name](**kwargs) returns a FakeOperation for FakeEsi to answer.
+    """
+    class _Ops:
+        def __getitem__(self, name):
+            return lambda **kwargs: FakeOperation(name, kwargs)
+
+    def __init__(self):
+        self.op = self._Ops()
+
+
+class FakeResponse:
+    def __init__(self, status: int, data):
+        self.status = status
+        self.data = data
+        self.header = {}
+
+
+class FakeEsi:
+    """
+    In-process ESI responder with a configurable latency. Counts every request.
+    """
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+
+    async def request(self, req_and_resp, raw_body_only: bool = False, **kwargs):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        op = req_and_resp
+        if op.name == 'post_universe_names':
+            return FakeResponse(200, [{'id': x, 'name': f'Entity {x}', 'category': 'character'}
+                                      for x in op.kwargs['ids']])
+        if op.name == 'get_universe_systems_system_id':
+            system_id = op.kwargs['system_id']
+            return FakeResponse(200, {'name': f'System {system_id}', 'constellation_id': 20000000 + system_id % 1000})
+        if op.name == 'get_universe_constellations_constellation_id':
+            constellation_id = op.kwargs['constellation_id']
+            return FakeResponse(200, {'name': f'Constellation {constellation_id}',
+                                      'region_id': 10000000 + constellation_id % 100})
+        return FakeResponse(404, {'error': f'{op.name} is not faked'})
+
+    def with_priority(self, priority: int):
+        return self
+
+    async def close(self):
+        pass
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+        self.sent = 0
+
+    async def send(self, **kwargs):
+        self.sent += 1
+
+
+class FakeBot:
+    def __init__(self, esi: FakeEsi, concurrency: int, rate: int):
+        self.loop = asyncio.get_event_loop()
+        self.config = {'bot': {'user_agent': 'benchmark'}}
+        self.esi_app = FakeEsiApp()
+        self.esi = esi
+        self.universe = UniverseIndex.load() if os.path.exists(UNIVERSE_PATH) else UniverseIndex()
+        self.channels = {}
+        # A rate of 0 means no per channel rate limit, so the run measures the pipeline rather than discord's limit.
+        self.dispatcher = Dispatcher(self, concurrency=concurrency, rate=rate or UNLIMITED_RATE, per=5.0)
+
+    def get_channel(self, channel_id: int):
+        if channel_id not in self.channels:
+            self.channels[channel_id] = FakeChannel(channel_id)
+        return self.channels[channel_id]
+
+
+def load_killstream(path: str) -> list:
+    """
+    Loads a recorded killstream.
+    :param path:
+    :return: A list of (received_timestamp, message) tuples, in recorded order.
+    """
+    kills = []
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            message = json.loads(line)
+            received = message.pop('_received', None)
+            if received is None:
+                received = datetime.strptime(message['killmail_time'], '%Y-%m-%dT%H:%M:%SZ').timestamp()
+            kills.append((received, message))
+
+    return kills
+
+
+def build_routing(kills: list, channels: int, seed: int = 0) -> RoutingIndex:
+    """
+    Subscribes fake channels to entities that appear in the killstream so that kills are routed.
+    :param kills:
+    :param channels: Number of fake channels.
+    :param seed:
+    :return:
+    """
+    rng = random.Random(seed)
+    entities = []
+    for _, message in kills:
+        victim = message['victim']
+        for entity_type, key in (('corporation', 'corporation_id'), ('alliance', 'alliance_id'),
+                                 ('ship', 'ship_type_id')):
+            if key in victim:
+                entities.append((entity_type, victim[key]))
+        entities.append(('system', message['solar_system_id']))
+
+    rows = []
+    for channel_id in range(1, channels + 1):
+        for entity_type, entity_id in rng.sample(entities, min(len(entities), 5)):
+            rows.append((entity_type, entity_id, channel_id))
+
+    return RoutingIndex.build(rows)
+
+
+def build_cog(bot: FakeBot, routing: RoutingIndex, workers: int, queue_size: int) -> KillWatch:
+    """
+    Builds a KillWatch cog wired to the fakes, without its DB loading or websocket tasks.
+    :param bot:
+    :param routing:
+    :param workers:
+    :param queue_size:
+    :return:
+    """
+    cog = KillWatch.__new__(KillWatch)
+    cog.bot = bot
+    cog.routing = routing
+    cog.queue = asyncio.Queue(maxsize=queue_size)
+    cog.overflow = 'block'
+    cog.seen = RecentIds(10000)
+    cog.workers = [bot.loop.create_task(cog.worker()) for _ in range(workers)]
+
+    return cog
+
+
+def percentile(samples: list, pct: float) -> float:
+    if len(samples) == 0:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def replay(args):
+    kills = load_killstream(args.path)
+    esi = FakeEsi(latency=args.esi_latency)
+    bot = FakeBot(esi, concurrency=args.concurrency, rate=args.rate)
+    cog = build_cog(bot, build_routing(kills, args.channels), args.workers, args.queue_size)
+    name_cache.memory.clear()
+
+    # Time each kill from the moment it is handed to the pipeline until its messages are queued for delivery. Delivery
+    # itself is timed by the dispatcher (dispatch.kills.last_delivery).
+    started = {}
+    latencies = []
+    process_killmail = cog.process_killmail
+
+    async def timed_process_killmail(message):
+        await process_killmail(message)
+        start = started.pop(message['killmail_id'], None)
+        if start is not None:
+            latencies.append(time.perf_counter() - start)
+
+    cog.process_killmail = timed_process_killmail
+
+    tracemalloc.start()
+    wall_start = time.perf_counter()
+    first_received = kills[0][0] if kills else 0
+    for received, message in kills:
+        if args.speed != 'max':
+            due = wall_start + (received - first_received) / float(args.speed)
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        started[message['killmail_id']] = time.perf_counter()
+        await cog.enqueue(message)
+
+    await cog.queue.join()
+    wall = time.perf_counter() - wall_start
+    drain_start = time.perf_counter()
+    await bot.dispatcher.drain()
+    drain = time.perf_counter() - drain_start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    for worker in cog.workers:
+        worker.cancel()
+    await bot.dispatcher.close()
+
+    delivered = sum(x.sent for x in bot.channels.values())
+    print(f'Kills replayed:      {len(kills)} (speed: {args.speed})')
+    print(f'Kills routed:        {metrics.counters.get("kill_watch.routed", 0)}')
+    print(f'Messages delivered:  {delivered}')
+    print(f'Throughput:          {len(kills) / wall:.1f} kills/sec (to dispatch)')
+    print(f'Delivery drain:      {drain:.2f} s (after the last kill was dispatched)')
+    print(f'Latency p50/p95/p99: {percentile(latencies, 50) * 1000:.1f} / {percentile(latencies, 95) * 1000:.1f} / '
+          f'{percentile(latencies, 99) * 1000:.1f} ms (to dispatch)')
+    delivery = metrics.summary('dispatch.kills')['timings'].get('dispatch.kills.last_delivery')
+    if delivery is not None:
+        print(f'Delivery p50/p95/p99: {delivery["p50"] * 1000:.1f} / {delivery["p95"] * 1000:.1f} / '
+              f'{delivery["p99"] * 1000:.1f} ms (dispatch to last message)')
+    print(f'ESI calls per kill:  {esi.calls / max(len(kills), 1):.2f}')
+    print(f'Peak memory:         {peak / 1024 / 1024:.1f} MiB')
+    hits, misses = metrics.counters.get('names.hits', 0), metrics.counters.get('names.misses', 0)
+    print(f'Name cache hit rate: {hits / max(hits + misses, 1) * 100:.1f}%')
+    for name, timing in metrics.summary('kill_watch').get('timings', {}).items():
+        print(f'  {name}: p50={timing["p50"] * 1000:.1f}ms p95={timing["p95"] * 1000:.1f}ms')
+
+
+async def record(args):
+    import websockets
+
+    uri = 'wss://zkillboard.com/websocket/'
+    async with websockets.connect(uri, ssl=True) as ws:
+        await ws.send(json.dumps({'action': 'sub', 'channel': 'killstream'}))
+        with open(args.path, 'w') as f:
+            for i in range(args.count):
+                message = json.loads(await ws.recv())
+                message['_received'] = time.time()
+                f.write(json.dumps(message) + '\n')
+                print(f'Recorded {i + 1}/{args.count}', end='\r')
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mercury killmail pipeline benchmark")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    rec = sub.add_parser('record', help="Record killmails from the zKill websocket.")
+    rec.add_argument('path')
+    rec.add_argument('--count', type=int, default=500)
+
+    rep = sub.add_parser('replay', help="Replay a recorded killstream through the pipeline.")
+    rep.add_argument('path')
+    rep.add_argument('--speed', default='max', help="Replay speed multiplier (e.g. 1, 10) or max.")
+    rep.add_argument('--esi-latency', type=float, default=0.0, help="Fake ESI latency in seconds.")
+    rep.add_argument('--channels', type=int, default=50, help="Number of fake subscribed channels.")
+    rep.add_argument('--workers', type=int, default=4)
+    rep.add_argument('--queue-size', type=int, default=1000)
+    rep.add_argument('--concurrency', type=int, default=10, help="Dispatcher concurrency.")
+    rep.add_argument('--rate', type=int, default=0,
+                     help="Messages per channel every 5 seconds (discord allows 5). Defaults to 0, no limit.")
+
+    args = parser.parse_args()
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(record(args) if args.command == 'record' else replay(args))
+
+
+if __name__ == '__main__':
+    main()
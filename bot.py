@@ -2,13 +2,21 @@ import discord
 from tomlkit import loads, dumps
 from discord.ext.commands import Bot
 from discord.ext import commands
-from esipy import EsiApp
 
 import settings
+from utils import create_session
 from utils.loggers import get_logger
+from utils.esi import AsyncEsiClient, EsiUnavailable
+from utils.metrics import metrics
+from utils.swagger import load_swagger, refresh_swagger
+from utils.cache import name_cache
+from utils.dispatch import Dispatcher
+from utils.sde import UniverseIndex, UNIVERSE_PATH, TypeIndex, TYPES_PATH
 from tortoise import Tortoise
 
+import asyncio
 import os
+import time
 import traceback
 import shutil
 import datetime
@@ -69,12 +77,17 @@ def setup():
 
 class MercuryBot(Bot):
     def __init__(self, config, *args, **kwargs):
+        self.init_started = time.perf_counter()
+        self.ready_at = None
         self.config = config
         intents = discord.Intents.default()
         intents.members = True
         intents.presences = True
-        app = EsiApp()
-        self.esi_app = app.get_latest_swagger
+        # The swagger spec is loaded from the on-disk cache and refreshed in the background once the loop runs.
+        with metrics.timer('bot.startup.swagger'):
+            self.esi_app = load_swagger(config['bot']['user_agent'])
+        self.esi = AsyncEsiClient(config['bot']['user_agent'])  # Shared by all cogs.
+        self._session = None
 
         self.description = "A discord.py bot to do some stuff."
 
@@ -95,11 +108,32 @@ class MercuryBot(Bot):
             **kwargs
         )
 
-        self.loop.create_task(Tortoise.init(config=settings.TORTOISE_ORM))  # Connect to the database.
+        self.db_ready = asyncio.Event()  # Set once the database is connected.
+        self.loop.create_task(self.init_db())  # Connect to the database.
+        self.loop.create_task(self.refresh_swagger())
+
+        # Outbound dispatcher shared by the feed cogs.
+        self.dispatcher = Dispatcher(self, concurrency=int(config.get('dispatch', {}).get('concurrency', 10)))
+
+        # Load the static universe index, building it on first run.
+        self.universe = UniverseIndex()
+        try:
+            if os.path.exists(UNIVERSE_PATH):
+                self.universe = UniverseIndex.load()
+        except (OSError, EOFError, ValueError, KeyError) as e:
+            # A truncated gzip raises EOFError rather than OSError.
+            self.logger.error(f"Error loading the universe index, rebuilding it: {e}")
+        if not self.universe.loaded:
+            self.loop.create_task(self.build_universe())
+
+        # Likewise for the inventory type index, which is big enough to load in the background.
+        self.types = TypeIndex()
+        self.loop.create_task(self.load_types())
 
         # Load extensions
         try:
-            self.load_extension(f'cogs.core.cog')
+            with metrics.timer('bot.load.core'):
+                self.load_extension(f'cogs.core.cog')
         except Exception as e:
             self.logger.fatal("Core cog failed to load. Exception:")
             self.logger.fatal(e)
@@ -109,7 +143,8 @@ class MercuryBot(Bot):
 
         for extension in self.config['bot']['extensions']:
             try:
-                self.load_extension(f'cogs.{extension}.cog')
+                with metrics.timer(f'bot.load.{extension}'):
+                    self.load_extension(f'cogs.{extension}.cog')
             except Exception as e:
                 self.logger.critical(f"{extension} failed to load. Exception:")
                 self.logger.critical(e)
@@ -118,10 +153,112 @@ class MercuryBot(Bot):
                 self.logger.info(f'{extension} loaded.')
                 print(f"{extension} loaded successfully.")
 
+        metrics.observe('bot.startup.init', time.perf_counter() - self.init_started)
+
     def run(self):
         super().run(self.token)
 
+    @property
+    def session(self):
+        """
+        Pooled HTTP session shared by every cog for non-ESI APIs. Created on first use.
+        :return:
+        """
+        if self._session is None or self._session.closed:
+            self._session = create_session(self.config['bot']['user_agent'])
+        return self._session
+
+    async def close(self):
+        await self.dispatcher.close()
+        await name_cache.close()
+        await self.esi.close()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        await super().close()
+
+    async def init_db(self):
+        """
+        Connects to the database, then warms the shared name cache from it.
+        :return:
+        """
+        await Tortoise.init(config=settings.TORTOISE_ORM)
+        self.db_ready.set()
+        try:
+            await name_cache.warm()
+        except Exception as e:
+            self.logger.error(f"Error warming the name cache: {e}")
+            self.logger.error(traceback.format_exc())
+        name_cache.start(self.loop)
+
+    async def build_universe(self):
+        """
+        Builds the static universe index from the SDE and saves it for future starts.
+            Until this finishes, lookups fall back to ESI.
+        :return:
+        """
+        try:
+            universe = await UniverseIndex.build(self.session)
+            await self.loop.run_in_executor(None, universe.save)
+        except Exception as e:
+            self.logger.error(f"Error building the universe index: {e}")
+            self.logger.error(traceback.format_exc())
+            return
+
+        self.universe = universe
+        self.logger.info(f"Universe index built with {len(universe.systems)} systems.")
+
+    async def load_types(self):
+        """
+        Loads the inventory type index in an executor and swaps it in once ready, building it if there is no usable
+        copy on disk.
+        :return:
+        """
+        if os.path.exists(TYPES_PATH):
+            try:
+                self.types = await self.loop.run_in_executor(None, TypeIndex.load)
+                return
+            except (OSError, EOFError, ValueError, KeyError) as e:
+                self.logger.error(f"Error loading the type index, rebuilding it: {e}")
+
+        await self.build_types()
+
+    async def build_types(self):
+        """
+        Builds the inventory type index from the SDE and saves it for future starts.
+            Until this finishes, type names are resolved through ESI.
+        :return:
+        """
+        try:
+            types = await TypeIndex.build(self.session)
+            await self.loop.run_in_executor(None, types.save)
+        except Exception as e:
+            self.logger.error(f"Error building the type index: {e}")
+            self.logger.error(traceback.format_exc())
+            return
+
+        self.types = types
+        self.logger.info(f"Type index built with {len(types)} types.")
+
+    async def refresh_swagger(self):
+        """
+        Replaces the swagger app if ESI has published a newer spec than the cached one.
+        :return:
+        """
+        try:
+            with metrics.timer('bot.swagger_refresh'):
+                app = await refresh_swagger(self.esi.session, self.loop)
+        except Exception as e:
+            self.logger.warning(f"Error refreshing the ESI swagger spec, keeping the cached copy: {e}")
+            return
+
+        if app is not None:
+            self.esi_app = app
+            self.logger.info("ESI swagger spec updated.")
+
     async def on_ready(self):
+        if self.ready_at is None:
+            self.ready_at = time.perf_counter()
+            metrics.observe('bot.startup.ready', self.ready_at - self.init_started)
         self.logger.info(f"Bot Started! (U: {self.user.name} I: {self.user.id})")
         print(f"Bot Started! (U: {self.user.name} I: {self.user.id})")
 
@@ -134,6 +271,8 @@ class MercuryBot(Bot):
             await context.send(exception)
         elif isinstance(exception, commands.NotOwner):
             self.logger.error('%s tried to run %s but is not the owner' % (context.author, context.command.name))
+        elif isinstance(exception, commands.CommandInvokeError) and isinstance(exception.original, EsiUnavailable):
+            await context.send('ESI is currently rate limiting the bot, please try again in a minute.')
         elif isinstance(exception, commands.CommandInvokeError):
             self.logger.error('In %s:' % context.command.qualified_name)
             self.logger.error(''.join(traceback.format_tb(exception.original.__traceback__)))
@@ -8,6 +8,7 @@ from pathlib import Path
 from .models import *
 from utils import checks
 from utils.loggers import get_logger
+from utils.metrics import metrics
 
 logger = get_logger(__name__)
 
@@ -48,6 +49,38 @@ class AdminCommands(commands.Cog):
 
         return await ctx.send(ret_str)
 
+    @commands.command(name='metrics', aliases=['met'], hidden=True)
+    @commands.is_owner()
+    async def show_metrics(self, ctx, prefix: str = ''):
+        """
+        Displays internal performance metrics.
+            Optionally filtered to the metrics starting with the given prefix (e.g. kill_watch).
+        """
+        snapshot = metrics.summary(prefix)
+        lines = [f'{k}: {v}' for k, v in snapshot['counters'].items()]
+        lines += [f'{k}: {v}' for k, v in snapshot['gauges'].items()]
+        for k, v in snapshot['timings'].items():
+            lines.append(
+                f'{k}: n={v["count"]} avg={v["avg"] * 1000:.1f}ms p50={v["p50"] * 1000:.1f}ms '
+                f'p95={v["p95"] * 1000:.1f}ms p99={v["p99"] * 1000:.1f}ms max={v["max"] * 1000:.1f}ms'
+            )
+        for k, v in snapshot['histograms'].items():
+            buckets = [
+                f'<={bound * 1000:.0f}ms:{count}' if bound is not None else f'more:{count}' for bound, count in v
+            ]
+            lines.append(f'{k}: {" ".join(buckets)}')
+        if len(lines) == 0:
+            return await ctx.send('No metrics recorded yet.')
+
+        # Keep each message under discord's 2000 character limit.
+        page = ''
+        for line in lines:
+            if len(page) + len(line) > 1900:
+                await ctx.send(f'```{page}```')
+                page = ''
+            page += f'{line}\n'
+        return await ctx.send(f'```{page}```')
+
     @commands.command(aliases=['sad', 'set_adminrole', 'set_admin', 'setadmin', 'setadminrole', 'ad'], hidden=True)
     @checks.guild_owner()
     async def set_admin_role(self, ctx, role: discord.Role):
@@ -136,7 +169,8 @@ class AdminCommands(commands.Cog):
                 return await ctx.send(f"{ext} is not a valid extension.")
             elif f'cogs.{ext}.cog' in tuple(self.bot.extensions):
                 return await ctx.send(f"Extension {ext} already loaded.")
-            self.bot.load_extension(f"cogs.{ext}.cog")
+            with metrics.timer(f'bot.load.{ext}'):
+                self.bot.load_extension(f"cogs.{ext}.cog")
             logger.warning(f'{ext} loaded by {ctx.author.name}#{ctx.author.discriminator} ({ctx.author.id})')
             return await ctx.send(f'{ext} loaded.')
         except Exception as e:
@@ -8,3 +8,14 @@ class BotAdminRole(Model):
 
     def __str__(self):
         return f'BotAdminRole for Guild <{self.guild_id}>'
+
+
+class CachedName(Model):
+    entity_id = fields.BigIntField(pk=True)
+    name = fields.CharField(max_length=255, null=False)
+    category = fields.CharField(max_length=32, null=False)
+    expires = fields.DatetimeField(null=True)
+    updated = fields.DatetimeField(null=False)
+
+    def __str__(self):
+        return f'{self.name} (id: {self.entity_id})'
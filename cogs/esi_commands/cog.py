@@ -1,3 +1,5 @@
+import asyncio
+import time
 import traceback
 import re
 from datetime import datetime, timezone
@@ -5,27 +7,41 @@ from typing import Optional, Union
 from urllib.parse import quote_plus
 
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord.ext.commands import Cog
-from esipy import EsiClient
 from esipy.exceptions import APIException
 
 from utils import strftdelta
+from utils.cache import name_cache
+from utils.esi import expires_at, PRIORITY_NORMAL
 from utils.loggers import get_logger
+from utils.metrics import metrics
 
 logger = get_logger(__name__)
 
+# Universe-wide system stats kept in the snapshot, and the ESI operation for each.
+STATS_OPS = {
+    'jumps': 'get_universe_system_jumps',
+    'kills': 'get_universe_system_kills',
+    'sov': 'get_sovereignty_map'
+}
+
+COMMAND_BUDGET = 10.0  # Seconds a lookup command may spend waiting on ESI.
+
 
 class EsiCommands(Cog):
     def __init__(self, bot):
         self.bot = bot
 
-        self.esi = EsiClient(
-            retry_requests=True,
-            headers={'User-Agent': f'application: MercuryBot contact: {self.bot.config["bot"]["user_agent"]}'}
-        )
+        # Snapshot of universe-wide system stats, indexed by system_id and refreshed as ESI's cache expires.
+        self.stats = {x: None for x in STATS_OPS}
+        self.stats_expires = {x: 0 for x in STATS_OPS}
+        self.refresh_stats.start()
+
+    def cog_unload(self):
+        self.refresh_stats.cancel()
 
-    def _get_esi_id(self, search: str, category: str, strict: bool) -> Union[list, int]:
+    async def _get_esi_id(self, search: str, category: str, strict: bool) -> Union[list, int]:
         """
         Returns the ID for the specified query from ESI.
         :param search: string representing the search query
@@ -39,7 +55,7 @@ class EsiCommands(Cog):
             strict=strict,
         )
 
-        search_response = self.esi.request(search_op)
+        search_response = await self.bot.esi.request(search_op)
 
         if category not in search_response.data:
             return -1
@@ -49,7 +65,7 @@ class EsiCommands(Cog):
         else:
             return search_response.data[category]
 
-    def _get_char_from_esi(self, char_id: int) -> Optional[dict]:
+    async def _get_char_from_esi(self, char_id: int) -> Optional[dict]:
         """
         Gets public data for the specified character_id.
         :param char_id:
@@ -60,7 +76,7 @@ class EsiCommands(Cog):
         )
 
         try:
-            char_response = self.esi.request(char_op)
+            char_response = await self.bot.esi.request(char_op)
         except APIException as e:
             logger.error(f"Error getting char with id {char_id} from ESI! Error: {e}")
             logger.error(traceback.print_exc())
@@ -68,7 +84,22 @@ class EsiCommands(Cog):
 
         return char_response.data
 
-    def _get_alliance_from_esi(self, ally_id: int) -> Optional[dict]:
+    async def _get_name(self, entity_id: int) -> Optional[str]:
+        """
+        Gets the name of any entity through the shared name cache.
+        :param entity_id:
+        :return:
+        """
+        try:
+            names = await name_cache.resolve(self.bot.esi_app, self.bot.esi, [entity_id])
+        except APIException as e:
+            logger.error(f"Error getting name for id {entity_id} from ESI! Error: {e}")
+            logger.error(traceback.print_exc())
+            return None
+
+        return names.get(entity_id)
+
+    async def _get_alliance_from_esi(self, ally_id: int) -> Optional[dict]:
         """
         Gets public data for the specified alliance_id
         :param ally_id:
@@ -79,7 +110,7 @@ class EsiCommands(Cog):
         )
 
         try:
-            ally_response = self.esi.request(ally_op)
+            ally_response = await self.bot.esi.request(ally_op)
         except APIException as e:
             logger.error(f"Error getting alliance with id {ally_id} from ESI! Error: {e}")
             logger.error(traceback.print_exc())
@@ -87,7 +118,7 @@ class EsiCommands(Cog):
 
         return ally_response.data
 
-    def _get_corporation_from_esi(self, corp_id: int) -> Optional[dict]:
+    async def _get_corporation_from_esi(self, corp_id: int) -> Optional[dict]:
         """
         Gets public data for the specified corporation_id
         :param corp_id:
@@ -98,7 +129,7 @@ class EsiCommands(Cog):
         )
 
         try:
-            corp_response = self.esi.request(corp_op)
+            corp_response = await self.bot.esi.request(corp_op)
         except APIException as e:
             logger.error(f"Error getting corporation with id {corp_id} from ESI! Error: {e}")
             logger.error(traceback.print_exc())
@@ -106,7 +137,7 @@ class EsiCommands(Cog):
 
         return corp_response.data
 
-    def _get_system_from_esi(self, system_id: int) -> Optional[dict]:
+    async def _get_system_from_esi(self, system_id: int) -> Optional[dict]:
         """
         Gets static system data from esi for the specified system_id
         :param system_id:
@@ -117,7 +148,7 @@ class EsiCommands(Cog):
         )
 
         try:
-            system_response = self.esi.request(sys_op)
+            system_response = await self.bot.esi.request(sys_op)
         except APIException as e:
             logger.error(f"Error getting system with id {system_id} from ESI! Error: {e}")
             logger.error(traceback.print_exc())
@@ -125,7 +156,7 @@ class EsiCommands(Cog):
 
         return system_response.data
 
-    def _get_region_from_esi(self, region_id: int) -> Optional[dict]:
+    async def _get_region_from_esi(self, region_id: int) -> Optional[dict]:
         """
         Gets static region data from esi for the specified region_id.
         :param region_id:
@@ -136,7 +167,7 @@ class EsiCommands(Cog):
         )
 
         try:
-            region_response = self.esi.request(reg_op)
+            region_response = await self.bot.esi.request(reg_op)
         except APIException as e:
             logger.error(f"Error getting region with id {region_id} from ESI! Error: {e}")
             logger.error(traceback.print_exc())
@@ -144,7 +175,7 @@ class EsiCommands(Cog):
 
         return region_response.data
 
-    def _get_constellation_from_esi(self, constellation_id: int) -> Optional[dict]:
+    async def _get_constellation_from_esi(self, constellation_id: int) -> Optional[dict]:
         """
         Gets static constellation data from ESI for the specified constellation_id.
         :param constellation_id:
@@ -155,7 +186,7 @@ class EsiCommands(Cog):
         )
 
         try:
-            constellation_response = self.esi.request(const_op)
+            constellation_response = await self.bot.esi.request(const_op)
         except APIException as e:
             logger.error(f"Error getting constellation with id {constellation_id} from ESI! Error: {e}")
             logger.error(traceback.print_exc())
@@ -163,7 +194,7 @@ class EsiCommands(Cog):
 
         return constellation_response.data
 
-    def _get_star_from_esi(self, star_id: int) -> Optional[dict]:
+    async def _get_star_from_esi(self, star_id: int) -> Optional[dict]:
         """
         Gets the static star data from ESI for the given star_id.
         :param star_id:
@@ -174,7 +205,7 @@ class EsiCommands(Cog):
         )
 
         try:
-            star_response = self.esi.request(star_op)
+            star_response = await self.bot.esi.request(star_op)
         except APIException as e:
             logger.error(f"Error getting star with id {star_id} from ESI! Error: {a}")
             logger.error(traceback.print_exc())
@@ -182,66 +213,114 @@ class EsiCommands(Cog):
 
         return star_response.data
 
+    @staticmethod
+    def _index_stats(name: str, data: list) -> dict:
+        """
+        Indexes one universe-wide stats payload by system_id.
+        :param name: A key of STATS_OPS.
+        :param data:
+        :return:
+        """
+        if name == 'jumps':
+            return {x['system_id']: x['ship_jumps'] for x in data}
+        if name == 'kills':
+            return {
+                x['system_id']: {k: x[k] for k in ('ship_kills', 'npc_kills', 'pod_kills')} for x in data
+            }
+        # Unclaimed systems are listed with only their system_id.
+        return {x['system_id']: x for x in data if len(x) > 1}
+
+    @tasks.loop(seconds=30.0)
+    async def refresh_stats(self):
+        """
+        Refreshes any part of the system stats snapshot whose ESI cache window has passed.
+        :return:
+        """
+        now = time.time()
+        due = [x for x in STATS_OPS if self.stats_expires[x] <= now]
+        if len(due) == 0:
+            return
+
+        try:
+            with metrics.timer('esi_commands.stats_refresh'):
+                responses = await asyncio.gather(*[
+                    self.bot.esi.request(self.bot.esi_app.op[STATS_OPS[x]](), priority=PRIORITY_NORMAL) for x in due
+                ])
+                for name, response in zip(due, responses):
+                    if response.status != 200:
+                        logger.warning(f"ESI returned {response.status} when refreshing system {name}.")
+                        continue
+                    self.stats[name] = self._index_stats(name, response.data)
+                    # Fall back to a five minute window if ESI sent no usable Expires header.
+                    expires = expires_at(response.header)
+                    self.stats_expires[name] = expires if expires > now else now + 300
+        except Exception as e:
+            logger.error(f"Error refreshing system stats from ESI! Error: {e}")
+            logger.error(traceback.format_exc())
+
     def _get_system_stats(self, system_id: int) -> Optional[dict]:
         """
-        Returns the following data for a given system:
+        Returns the following data for a given system from the stats snapshot:
             - Jumps
             - Kills
             - Sovereignty
+            Systems missing from a payload had no activity, so they default to 0.
         :param system_id:
-        :return:
+        :return: None if the snapshot has not been loaded yet.
         """
-        # Get System Stats
-        jump_op = self.bot.esi_app.op['get_universe_system_jumps']()
-        kills_op = self.bot.esi_app.op['get_universe_system_kills']()
-        sov_op = self.bot.esi_app.op['get_sovereignty_map']()
+        if self.stats['jumps'] is None or self.stats['kills'] is None:
+            return None
 
-        try:
-            jump_response = self.esi.request(jump_op)
-            kills_response = self.esi.request(kills_op)
-            sov_response = self.esi.request(sov_op)
-        except APIException as e:
-            logger.error(f"Error getting system stats from ESI! Error: {e}")
-            logger.error(traceback.print_exc())
+        return {
+            'ship_jumps': self.stats['jumps'].get(system_id, 0),
+            'kills': self.stats['kills'].get(system_id, {'ship_kills': 0, 'npc_kills': 0, 'pod_kills': 0}),
+            'sov': (self.stats['sov'] or {}).get(system_id)
+        }
+
+    async def _gather(self, deadline: float, *aws) -> list:
+        """
+        Runs independent lookups concurrently, within what is left of a command's time budget.
+            Raises asyncio.TimeoutError once the deadline passes.
+        :param deadline: Loop time by which the command must be done.
+        :param aws: The lookups to run. None entries are skipped and return None.
+        :return: The results, in the same order as aws.
+        """
+        async def skip():
             return None
 
-        ret = dict()
-        ret['sov'] = None
-        for sys in jump_response.data:
-            if sys['system_id'] == system_id:
-                ret['ship_jumps'] = sys['ship_jumps']
-                break
-        for sys in kills_response.data:
-            if sys['system_id'] == system_id:
-                ret['kills'] = sys
-                break
-        for sys in sov_response.data:
-            if sys['system_id'] == system_id:
-                if len(sys) == 1:
-                    break
-                ret['sov'] = sys
-                break
-
-        return ret
+        remaining = max(0.0, deadline - self.bot.loop.time())
+        return await asyncio.wait_for(asyncio.gather(*[x if x is not None else skip() for x in aws]), remaining)
 
     @commands.command(aliases=('char', 'ch'))
     async def character(self, ctx, *, character_name: str):
         """
         Returns public data about the named character.
         """
-        # Get ID from ESI
-        char_id = self._get_esi_id(character_name, "character", True)
-        if char_id == -1:
-            return await ctx.send("Character not found. Please check your spelling and try again.")
-
-        # Get Public data
-        char = self._get_char_from_esi(char_id)
-        if char is None:
-            return await ctx.send("Something went wrong, please try again later.")
-
-        corp = self._get_corporation_from_esi(char['corporation_id'])
-        if corp is None:
-            return await ctx.send("Something went wrong, please try again later.")
+        with metrics.timer('esi_commands.character', histogram=True):
+            deadline = self.bot.loop.time() + COMMAND_BUDGET
+            try:
+                # Get ID from ESI
+                char_id, = await self._gather(deadline, self._get_esi_id(character_name, "character", True))
+                if char_id == -1:
+                    return await ctx.send("Character not found. Please check your spelling and try again.")
+
+                # Get Public data
+                char, = await self._gather(deadline, self._get_char_from_esi(char_id))
+                if char is None:
+                    return await ctx.send("Something went wrong, please try again later.")
+
+                # The corporation and alliance only depend on the character.
+                corp, ally = await self._gather(
+                    deadline,
+                    self._get_corporation_from_esi(char['corporation_id']),
+                    self._get_alliance_from_esi(char['alliance_id']) if char['alliance_id'] is not None else None
+                )
+            except asyncio.TimeoutError:
+                return await ctx.send("ESI is taking too long to respond, please try again later.")
+            if corp is None:
+                return await ctx.send("Something went wrong, please try again later.")
+            if char['alliance_id'] is not None and ally is None:
+                return await ctx.send("Something went wrong, please try again later.")
 
         urln = quote_plus(char['name'])
 
@@ -261,10 +340,7 @@ class EsiCommands(Cog):
 
         embed.add_field(name='Corporation', value=f'{corp["name"]} [{corp["ticker"]}]', inline=True)
         embed.add_field(name='\u200B', value='\u200B', inline=True)  # Empty Field
-        if corp['alliance_id'] is not None:
-            ally = self._get_alliance_from_esi(corp['alliance_id'])
-            if ally is None:
-                return await ctx.send("Something went wrong, please try again later.")
+        if ally is not None:
             embed.add_field(name='Alliance', value=f'{ally["name"]} [{ally["ticker"]}]')
         embed.add_field(name='Birthday', value=dob.strftime("%a %d %b, %Y"), inline=True)
         embed.add_field(name='\u200B', value='\u200B', inline=True)  # Empty Field
@@ -278,19 +354,31 @@ class EsiCommands(Cog):
         """
         Returns public data about the specified corporation.
         """
-        # Get ID
-        corp_id = self._get_esi_id(corporation, "corporation", True)
-        if corp_id == -1:
-            return await ctx.send("Corporation not found. Please check your spelling and try again.")
-
-        # Get Corp data
-        corp = self._get_corporation_from_esi(corp_id)
-        if corp is None:
-            return await ctx.send("Something went wrong, please try again later.")
-
-        ceo = self._get_char_from_esi(corp['ceo_id'])
-        if ceo is None:
-            return await ctx.send("Something went wrong, please try again later.")
+        with metrics.timer('esi_commands.corporation', histogram=True):
+            deadline = self.bot.loop.time() + COMMAND_BUDGET
+            try:
+                # Get ID
+                corp_id, = await self._gather(deadline, self._get_esi_id(corporation, "corporation", True))
+                if corp_id == -1:
+                    return await ctx.send("Corporation not found. Please check your spelling and try again.")
+
+                # Get Corp data
+                corp, = await self._gather(deadline, self._get_corporation_from_esi(corp_id))
+                if corp is None:
+                    return await ctx.send("Something went wrong, please try again later.")
+
+                # The CEO and alliance only depend on the corporation.
+                ceo, ally = await self._gather(
+                    deadline,
+                    self._get_name(corp['ceo_id']),
+                    self._get_alliance_from_esi(corp['alliance_id']) if corp['alliance_id'] is not None else None
+                )
+            except asyncio.TimeoutError:
+                return await ctx.send("ESI is taking too long to respond, please try again later.")
+            if ceo is None:
+                return await ctx.send("Something went wrong, please try again later.")
+            if corp['alliance_id'] is not None and ally is None:
+                return await ctx.send("Something went wrong, please try again later.")
 
         urls = {
             'zkb': f'https://zkillboard.com/corporation/{corp_id}/',
@@ -306,14 +394,11 @@ class EsiCommands(Cog):
         embed.add_field(name='Ticker', value=f'[{corp["ticker"]}]', inline=True)
         embed.add_field(name='\u200B', value='\u200B', inline=True)  # Empty Field
         embed.add_field(name='Member Count', value=f'{corp["member_count"]}', inline=True)
-        embed.add_field(name='CEO', value=f'{ceo["name"]}', inline=True)
+        embed.add_field(name='CEO', value=ceo, inline=True)
         embed.add_field(name='\u200B', value='\u200B', inline=True)  # Empty Field
         if corp['date_founded'] is not None:
             embed.add_field(name='Founded', value=corp["date_founded"].v.strftime("%a %d %b, %Y"), inline=True)
-        if corp['alliance_id'] is not None:
-            ally = self._get_alliance_from_esi(corp['alliance_id'])
-            if ally is None:
-                return ctx.send("Something went wrong, please try again later.")
+        if ally is not None:
             embed.add_field(name='Alliance', value=f'{ally["name"]} [{ally["ticker"]}]', inline=False)
         embed.add_field(name='Additional Information', value=f'{urls["zkb"]}\n{urls["dotlan"]}', inline=False)
 
@@ -324,26 +409,30 @@ class EsiCommands(Cog):
         """
         Returns public data about the specified alliance.
         """
-        ally_id = self._get_esi_id(alliance, "alliance", True)
-        if ally_id == -1:
-            return await ctx.send("Alliance not found. Please check your spelling and try again.")
-
-        ally = self._get_alliance_from_esi(ally_id)
-        if ally is None:
-            return await ctx.send("Something went wrong, please try again later.")
-
-        found_corp = self._get_corporation_from_esi(ally['creator_corporation_id'])
-        if found_corp is None:
-            return await ctx.send("Something went wrong, please try again later.")
-
-        founder = self._get_char_from_esi(ally['creator_id'])
-        if founder is None:
-            return await ctx.send("Something went wrong, please try again later.")
-
-        exec_corp = None
-        if 'executor_corporation_id' in ally:
-            exec_corp = self._get_corporation_from_esi(ally['executor_corporation_id'])
-            if exec_corp is None:
+        with metrics.timer('esi_commands.alliance', histogram=True):
+            deadline = self.bot.loop.time() + COMMAND_BUDGET
+            try:
+                ally_id, = await self._gather(deadline, self._get_esi_id(alliance, "alliance", True))
+                if ally_id == -1:
+                    return await ctx.send("Alliance not found. Please check your spelling and try again.")
+
+                ally, = await self._gather(deadline, self._get_alliance_from_esi(ally_id))
+                if ally is None:
+                    return await ctx.send("Something went wrong, please try again later.")
+
+                # The founding corp, founder and executor corp only depend on the alliance.
+                found_corp, founder, exec_corp = await self._gather(
+                    deadline,
+                    self._get_corporation_from_esi(ally['creator_corporation_id']),
+                    self._get_name(ally['creator_id']),
+                    self._get_corporation_from_esi(ally['executor_corporation_id'])
+                    if 'executor_corporation_id' in ally else None
+                )
+            except asyncio.TimeoutError:
+                return await ctx.send("ESI is taking too long to respond, please try again later.")
+            if found_corp is None or founder is None:
+                return await ctx.send("Something went wrong, please try again later.")
+            if 'executor_corporation_id' in ally and exec_corp is None:
                 return await ctx.send("Something went wrong, please try again later.")
 
         urls = {
@@ -366,7 +455,7 @@ class EsiCommands(Cog):
         if exec_corp is not None:
             embed.add_field(name='Executor Corp', value=f'{exec_corp["name"]} [{exec_corp["ticker"]}]', inline=True)
 
-        embed.add_field(name='Founder', value=f'{founder["name"]}', inline=True)
+        embed.add_field(name='Founder', value=founder, inline=True)
         embed.add_field(name='\u200B', value='\u200B', inline=True)  # Empty Field
         embed.add_field(name='Founding Corp', value=f'{found_corp["name"]} [{found_corp["ticker"]}]', inline=True)
 
@@ -384,7 +473,7 @@ class EsiCommands(Cog):
         status_op = self.bot.esi_app.op['get_status']()
 
         try:
-            status_response = self.esi.request(status_op)
+            status_response = await self.bot.esi.request(status_op)
             status_response = status_response.data
         except APIException as e:
             embed = discord.Embed(title="Tranquility Status", color=discord.Color.red())
@@ -425,13 +514,17 @@ class EsiCommands(Cog):
         if re.match(r'[Jj]([0-9]{6})', system_name) or system_name == "Thera":
             return await ctx.send('System Information not available for wormhole systems.')
 
-        # Get System ID
-        sys_id = self._get_esi_id(system_name, 'solar_system', True)
+        # Get System ID, preferring the static universe index over an ESI search.
+        indexed = self.bot.universe.system_from_name(system_name)
+        if indexed is not None:
+            sys_id = indexed.system_id
+        else:
+            sys_id = await self._get_esi_id(system_name, 'solar_system', True)
         if sys_id == -1:
             return await ctx.send("System not found. Please check your spelling and try again.")
 
         # Get System Data
-        system = self._get_system_from_esi(sys_id)
+        system = await self._get_system_from_esi(sys_id)
         if system is None:
             return await ctx.send("Something went wrong, please try again later.")
 
@@ -445,19 +538,23 @@ class EsiCommands(Cog):
             planets = 0
             moons = 0
 
-        star = self._get_star_from_esi(system['star_id'])
+        star = await self._get_star_from_esi(system['star_id'])
 
-        constellation = self._get_constellation_from_esi(system['constellation_id'])
-        if constellation is None:
-            return await ctx.send("Something went wrong, please try again later.")
+        if indexed is not None:
+            constellation = self.bot.universe.constellation(indexed.constellation_id)._asdict()
+            region = self.bot.universe.region(indexed.region_id)._asdict()
+        else:
+            constellation = await self._get_constellation_from_esi(system['constellation_id'])
+            if constellation is None:
+                return await ctx.send("Something went wrong, please try again later.")
 
-        region = self._get_region_from_esi(constellation['region_id'])
+            region = await self._get_region_from_esi(constellation['region_id'])
         if region is None:
             return await ctx.send("Something went wrong, please try again later.")
 
         stats = self._get_system_stats(sys_id)
         thumb_url = f'https://images.evetech.net/types/{star["type_id"]}/icon'
-        if stats['sov'] is not None:
+        if stats is not None and stats['sov'] is not None:
             if 'faction_id' in stats['sov']:
                 thumb_url = f'https://images.evetech.net/corporations/{stats["sov"]["faction_id"]}/logo'
             elif 'alliance_id' in stats['sov']:
@@ -487,14 +584,17 @@ class EsiCommands(Cog):
         if 'stargates' in system:
             embed.add_field(name='Stargates', value=str(len(system['stargates'])))
 
-        embed.add_field(
-            name='Stats (Last Hour)',
-            value=f'**Jumps:** {stats["ship_jumps"]} \n'
-                  f'**Ship Kills**: {stats["kills"]["ship_kills"]} \n'
-                  f'**NPC Kills:** {stats["kills"]["npc_kills"]}\n'
-                  f'**Pod Kills:** {stats["kills"]["pod_kills"]}',
-            inline=False
-        )
+        if stats is None:
+            embed.add_field(name='Stats (Last Hour)', value='*Not yet available.*', inline=False)
+        else:
+            embed.add_field(
+                name='Stats (Last Hour)',
+                value=f'**Jumps:** {stats["ship_jumps"]} \n'
+                      f'**Ship Kills**: {stats["kills"]["ship_kills"]} \n'
+                      f'**NPC Kills:** {stats["kills"]["npc_kills"]}\n'
+                      f'**Pod Kills:** {stats["kills"]["pod_kills"]}',
+                inline=False
+            )
         embed.add_field(name='Additional Info', value=f'{dotlan} \n{zkill}')
 
         return await ctx.send(embed=embed)
@@ -1,20 +1,38 @@
 import traceback
 import json
 import asyncio
+import time
 
 import discord
 import websockets
 from discord.ext import commands, tasks
 from discord.ext.commands import Cog
-from esipy import EsiClient
 
 from .models import *
 from .helpers import *
+from .routing import RoutingIndex, LOCATION_TYPES, PARTY_TYPES
 from utils import checks
+from utils.db import fetch_subscriptions
+from utils.dispatch import PRIORITY_KILL
+from utils.esi import PRIORITY_HIGH
 from utils.loggers import get_logger
+from utils.metrics import metrics
 
 logger = get_logger(__name__)
 
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'degrade')
+SEEN_PATH = 'data/kill_watch_seen.json'
+# Entity type -> KillChannel M2M field.
+CHANNEL_RELATIONS = {
+    'system': 'systems',
+    'constellation': 'constellation',
+    'region': 'regions',
+    'corporation': 'corporations',
+    'alliance': 'alliances',
+    'character': 'characters',
+    'ship': 'ships'
+}
+
 
 class KillWatch(Cog, command_attrs=dict(hidden=True)):
     """
@@ -33,53 +51,54 @@ class KillWatch(Cog, command_attrs=dict(hidden=True)):
             'ship': KillEveShipType
         }
 
-        self.channels = None
+        self.routing = None
         self.bot.loop.create_task(self.load_channels())
 
-        self.esi = EsiClient(
-            retry_requests=True,
-            headers={'User-Agent': f'application: MercuryBot contact: {self.bot.config["bot"]["user_agent"]}'},
-            raw_body_only=False
-        )
+        # Killmails are handed from the websocket reader to a pool of workers through a bounded queue.
+        settings = self.bot.config.get('kill_watch', {})
+        self.queue = asyncio.Queue(maxsize=int(settings.get('queue_size', 1000)))
+        self.overflow = settings.get('overflow', 'block')
+        if self.overflow not in OVERFLOW_POLICIES:
+            logger.warning(f'Unknown kill_watch overflow policy `{self.overflow}`, using `block`.')
+            self.overflow = 'block'
+        self.workers = [self.bot.loop.create_task(self.worker()) for _ in range(int(settings.get('workers', 4)))]
+
+        # Duplicate suppression. zKill re-sends recent kills after a reconnect, so recently seen IDs are remembered,
+        # and saved so the same applies across restarts. Kills do not arrive in ID order (late verified kills carry
+        # older IDs), so only IDs that were actually seen are skipped.
+        self.seen = RecentIds(int(settings.get('dedup_size', 10000)))
+        self.load_seen()    # Before the checkpoint starts, so its first save doesn't replace the file with nothing.
+        self.checkpoint.start()
 
         self.ws_task = self.bot.loop.create_task(self.listen())
 
     def cog_unload(self):
         self.ws_task.cancel()
+        self.checkpoint.cancel()
+        for worker in self.workers:
+            worker.cancel()
 
     async def load_channels(self):
         """
-        Loads self.channels
+        Builds self.routing from the tracked entities.
+            All subscriptions are read in one query, so this does not grow with the number of tracked entities.
         :return:
         """
-        systems = await KillEveSystem.all()
-        constellations = await KillEveConstellation.all()
-        regions = await KillEveRegion.all()
-        corporations = await KillEveCorporation.all()
-        alliances = await KillEveAlliance.all()
-        characters = await KillEveCharacter.all()
-        ships = await KillEveShipType.all()
-        self.channels = {
-            'systems': {x.system_id: await x.channels.all() for x in systems},
-            'constellations': {x.constellation_id: await x.channels.all() for x in constellations},
-            'regions': {x.region_id: await x.channels.all() for x in regions},
-            'corporations': {x.corporation_id: await x.channels.all() for x in corporations},
-            'alliances': {x.alliance_id: await x.channels.all() for x in alliances},
-            'characters': {x.character_id: await x.channels.all() for x in characters},
-            'ships': {x.type_id: await x.channels.all() for x in ships},
-        }
+        with metrics.timer('kill_watch.load_channels'):
+            rows = await fetch_subscriptions(KillChannel, CHANNEL_RELATIONS)
+            self.routing = RoutingIndex.build(rows)
+        metrics.gauge('kill_watch.subscriptions', len(rows))
 
     async def update_channels(self, id_type: str, id_obj):
         """
-        Updates self.channels
+        Updates the routes for a single tracked entity.
         :param id_type:
         :param id_obj:
         :return:
         """
-        if self.channels is None:
+        if self.routing is None:
             await self.load_channels()
-        plural = f'{id_type}s'
-        self.channels[plural][id_obj.pk] = await id_obj.channels.all()
+        self.routing.set_route(id_type, id_obj.pk, [x.channel_id for x in await id_obj.channels.all()])
 
     async def item_from_name(self, track_type, to_track):
         """
@@ -94,11 +113,19 @@ class KillWatch(Cog, command_attrs=dict(hidden=True)):
         if await self.TYPE_MODELS[track_type].filter(name__iexact=to_track).exists():
             return await self.TYPE_MODELS[track_type].filter(name__iexact=to_track).first()
 
+        # Ship names can be resolved from the local type index.
+        if track_type == 'ship':
+            match = self.bot.types.exact(to_track)
+            if match is not None:
+                item = self.TYPE_MODELS[track_type](type_id=match[0], name=match[1])
+                await item.save()
+                return item
+
         # If its not in the database, get info from ESI and save a DB record for it.
         cat = 'inventory_types' if track_type == 'ship' else plural
 
         post_op = self.bot.esi_app.op['post_universe_ids'](names=[to_track])
-        response = self.esi.request(post_op)
+        response = await self.bot.esi.request(post_op)
         if cat not in response.data:
             logger.debug(response.data)
             return -1
@@ -155,7 +182,7 @@ class KillWatch(Cog, command_attrs=dict(hidden=True)):
         cat = 'inventory_type' if track_type == 'ship' else track_type
 
         post_op = self.bot.esi_app.op['post_universe_names'](ids=[to_track])
-        response = self.esi.request(post_op)
+        response = await self.bot.esi.request(post_op)
         if cat not in response.data[0]['category']:
             logger.debug(response.data)
             return -1
@@ -271,6 +298,7 @@ class KillWatch(Cog, command_attrs=dict(hidden=True)):
             # Unset the channel
             channel = await KillChannel.filter(pk=ctx.guild.id).first()
             await channel.delete()
+            await self.load_channels()  # Reloading channels is easier on delete.
 
             return await ctx.send(f'The kill feed channel for `{ctx.guild.name}` has been unset.')
 
@@ -284,6 +312,7 @@ class KillWatch(Cog, command_attrs=dict(hidden=True)):
             channel = await KillChannel.filter(pk=ctx.guild.id).first()
             channel.channel_id = ctx.channel.id
             await channel.save()
+            await self.load_channels()
 
             return await ctx.send(f'The kill feed channel for this server has been updated. '
                                   f'New channel is {ctx.channel.mention}')
@@ -292,38 +321,141 @@ class KillWatch(Cog, command_attrs=dict(hidden=True)):
             return await ctx.send(f'`{action}` is not a valid action for this command. To see valid actions run'
                                   f'the help command. (`/help kill_channel`)')
 
+    def load_seen(self):
+        """
+        Loads the killmail IDs seen by the last run.
+        :return:
+        """
+        try:
+            self.seen.load(SEEN_PATH)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Error loading the seen killmail IDs: {e}")
+
+    def save_seen(self):
+        """
+        Saves the recently seen killmail IDs.
+        :return:
+        """
+        self.seen.save(SEEN_PATH)
+
+    @tasks.loop(seconds=60.0)
+    async def checkpoint(self):
+        try:
+            self.save_seen()
+        except Exception as e:
+            logger.warning(f"Error saving the seen killmail IDs: {e}")
+
+    @checkpoint.after_loop
+    async def on_checkpoint_cancel(self):
+        if self.checkpoint.is_being_cancelled():
+            self.save_seen()
+
     async def listen(self):
         """
         Subscribe to the killstream on zKill's websocket
+            Reconnects with an exponential backoff (with jitter) after errors.
         :return:
         """
         await self.load_channels()
         uri = 'wss://zkillboard.com/websocket/'
 
-        ws = await websockets.connect(uri, ssl=True)
-        await ws.send(json.dumps({'action': 'sub', 'channel': 'killstream'}))
-
+        failures = 0
+        disconnected_at = None
         while 'KillWatch' in self.bot.cogs:
-            if not ws.open:
-                logger.info("Not connected to zKill; attempting to connect...")
-                try:
-                    ws = await websockets.connect(uri, ssl=True)
-                    await ws.send(json.dumps({'action': 'sub', 'channel': 'killstream'}))
-
-                except Exception as e:
-                    logger.error(f"Error connecting to zKill's websocket: {e}")
-                    logger.error(traceback.format_exc())
             try:
-                async for message in ws:
-                    if message is not None:
-                        await self.process_killmail(json.loads(message))
+                async with websockets.connect(uri, ssl=True) as ws:
+                    await ws.send(json.dumps({'action': 'sub', 'channel': 'killstream'}))
+                    if disconnected_at is not None:
+                        gap = time.monotonic() - disconnected_at
+                        metrics.observe('kill_watch.reconnect_gap', gap)
+                        logger.info(f"Reconnected to zKill after {gap:.1f}s. Kills in that window were not received.")
+
+                    async for message in ws:
+                        failures = 0
+                        if message is not None:
+                            await self.enqueue(json.loads(message))
             except asyncio.CancelledError:
-                pass    # We dont want to log this
+                raise    # We dont want to log this
             except Exception as e:
                 logger.error(f"Error receiving message from zKill: {e}")
                 logger.error(traceback.format_exc())
+
+            disconnected_at = time.monotonic()
+            failures += 1
+            delay = backoff_delay(failures)
+            metrics.incr('kill_watch.reconnects')
+            logger.info(f"Not connected to zKill; reconnecting in {delay:.1f}s...")
+            await asyncio.sleep(delay)
+
+    async def enqueue(self, message: dict):
+        """
+        Hands a killmail from the websocket reader to the workers.
+            When the queue is full the configured overflow policy applies:
+             - block: wait for space (zKill may drop us if this takes too long)
+             - drop_oldest: discard the oldest queued killmail
+             - degrade: discard killmails no channel wants, and the oldest queued killmail to make room for ones
+               that are wanted
+        :param message:
+        :return:
+        """
+        metrics.incr('kill_watch.received')
+
+        # Duplicates never reach enrichment or discord.
+        if not self.seen.add(message['killmail_id']):
+            metrics.incr('kill_watch.duplicates')
+            return
+
+        if self.queue.full():
+            metrics.incr('kill_watch.queue_full')
+            if self.overflow == 'degrade' and not self.is_routed(message):
+                metrics.incr('kill_watch.shed')
+                return
+            if self.overflow in ('drop_oldest', 'degrade'):
+                self.queue.get_nowait()
+                self.queue.task_done()
+                metrics.incr('kill_watch.dropped')
+
+        await self.queue.put((time.perf_counter(), message))
+        metrics.gauge('kill_watch.queue_depth', self.queue.qsize())
+
+    def is_routed(self, message: dict) -> bool:
+        """
+        Cheap, in-memory check of whether any channel might want a killmail.
+            If the universe index is not loaded, location routes can not be checked, so any location subscription
+            counts as a match.
+        :param message:
+        :return:
+        """
+        if self.routing is None:
+            return True
+        ids = get_party_ids([message['victim']] + message['attackers'])
+        system = self.bot.universe.system(message['solar_system_id'])
+        if system is not None:
+            ids['system'] = (system.system_id,)
+            ids['constellation'] = (system.constellation_id,)
+            ids['region'] = (system.region_id,)
+        elif any(len(self.routing.routes[x]) != 0 for x in LOCATION_TYPES):
+            return True
+
+        return len(self.routing.match(ids)) != 0
+
+    async def worker(self):
+        """
+        Processes killmails from the queue until cancelled.
+        :return:
+        """
+        while True:
+            received, message = await self.queue.get()
+            metrics.gauge('kill_watch.queue_depth', self.queue.qsize())
+            metrics.observe('kill_watch.queue_wait', time.perf_counter() - received)
+            try:
+                with metrics.timer('kill_watch.process'):
+                    await self.process_killmail(message)
+            except Exception as e:
+                logger.error(f"Error processing killmail {message.get('killmail_id')}: {e}")
+                logger.error(traceback.format_exc())
             finally:
-                await ws.close()
+                self.queue.task_done()
 
     async def process_killmail(self, message: dict):
         """
@@ -331,75 +463,60 @@ class KillWatch(Cog, command_attrs=dict(hidden=True)):
         :param message:
         :return:
         """
-        mail_ids = {
-            'alliance_id': [],
-            'character_id': [],
-            'corporation_id': [],
-            'ship_type_id': []
-        }
-        for attacker in message['attackers']:
-            for key in attacker:
-                if 'id' in key and 'faction' not in key and 'weapon' not in key:
-                    mail_ids[key].append(attacker[key])
-        for key in message['victim']:
-            if 'id' in key and 'faction' not in key:
-                mail_ids[key].append(message['victim'][key])
-        mail_ids = {
-            **mail_ids,
-            **get_location_dict(
+        with metrics.timer('kill_watch.route'):
+            victim_ids = get_party_ids([message['victim']])
+            attacker_ids = get_party_ids(message['attackers'])
+            location = await get_location_dict(
                 self.bot.esi_app,
-                self.esi,
-                message['solar_system_id']
+                self.bot.esi.with_priority(PRIORITY_HIGH),
+                message['solar_system_id'],
+                universe=self.bot.universe
             )
-        }
-
-        # Build channel set
-        send_channels = set()
+            mail_ids = {
+                'system': location['system_id'],
+                'constellation': location['constellation_id'],
+                'region': location['region_id'],
+                **{x: victim_ids[x] | attacker_ids[x] for x in PARTY_TYPES}
+            }
 
-        for key in mail_ids:
-            channel_key = 'ships' if key == 'ship_type_id' else f'{key.strip("_id")}s'
-            for item_id in mail_ids[key]:
-                if item_id in self.channels[channel_key]:
-                    send_channels.update([(x, channel_key) for x in self.channels[channel_key][item_id]])
+            send_channels = self.routing.match(mail_ids)
 
         if len(send_channels) != 0:
-            await self.send_kill(message, send_channels)
+            metrics.incr('kill_watch.routed')
+            await self.send_kill(message, send_channels, victim_ids)
 
-    async def send_kill(self, kill_mail: dict, send_channels: set):
+    async def send_kill(self, kill_mail: dict, send_channels: dict, victim_ids: dict):
         """
         Builds and sends embed for the given killmail.
+            Whether the kill is a loss for a channel is decided from the routing index, so no queries are made here.
         :param kill_mail:
-        :param send_channels:
+        :param send_channels: A dict mapping discord channel IDs to the entity types they matched on.
+        :param victim_ids: The victim's IDs, as returned by get_party_ids.
         :return:
         """
-        data = extract_mail_data(
-            self.bot.esi_app,
-            self.esi,
-            kill_mail
-        )
+        with metrics.timer('kill_watch.enrich'):
+            data = await extract_mail_data(
+                self.bot.esi_app,
+                self.bot.esi.with_priority(PRIORITY_HIGH),
+                kill_mail,
+                self.bot.universe
+            )
 
-        embed = await build_embed(data)
+            kill_embed = await build_embed(data)
+            kill_embed.colour = discord.Color.green()
+            loss_embed = kill_embed.copy()
+            loss_embed.colour = discord.Color.red()
 
         # Send to channels
-        for channel_tuple in send_channels:
-            channel = channel_tuple[0]
-            kill_key = 'ship_type_id' if channel_tuple[1] == 'ships' else channel_tuple[1].replace('s', '_id')
-            KEY_METHODS = {
-                'alliances': channel.alliances,
-                'corporations': channel.corporations,
-                'characters': channel.characters,
-                'ships': channel.ships
-            }
-            # Check if we are watching for char/corp/ally/ship of victim
-            color = discord.Color.green()
-            if await KEY_METHODS[channel_tuple[1]].filter(pk=data['victim'][kill_key]).exists():
-                color = discord.Color.red()
-
-            embed.colour = color
-
-            # Get the channel
-            channel = self.bot.get_channel(channel.channel_id)
-            await channel.send(embed=embed)
+        with metrics.timer('kill_watch.send'):
+            # Channels watching the victim's char/corp/ally/ship get the loss embed.
+            sends = [
+                (x, {'embed': loss_embed if self.routing.is_loss(x, victim_ids) else kill_embed})
+                for x in send_channels
+            ]
+            # Delivery is not waited on, so a kill going to many (or rate limited) channels does not hold up the
+            # worker. The dispatcher records delivery times itself.
+            self.bot.dispatcher.fanout('kills', PRIORITY_KILL, sends)
 
 
 def setup(bot):
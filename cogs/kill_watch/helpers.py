@@ -1,37 +1,143 @@
+import json
+import os
+import random
+from collections import deque
 from datetime import datetime, timezone
 
 import discord
 from pyswagger.primitives import Datetime
 
+from utils.cache import name_cache
+from utils.loggers import get_logger
 
-def get_location_dict(esi_app, esi_client, system_id: int, names=False) -> dict:
+logger = get_logger(__name__)
+
+# Maps killmail party entity types to their keys on the killmail.
+PARTY_KEYS = {
+    'character': 'character_id',
+    'corporation': 'corporation_id',
+    'alliance': 'alliance_id',
+    'ship': 'ship_type_id'
+}
+
+
+async def get_location_dict(esi_app, esi_client, system_id: int, names=False, universe=None) -> dict:
     """
-    Returns ESI data for a system_id.
+    Returns location data for a system_id.
+        The static universe index is used when it is available, otherwise the data is pulled from ESI.
     :param esi_app:
     :param esi_client:
     :param system_id:
     :param names:
+    :param universe: The bot's UniverseIndex.
     :return:
     """
-    system = esi_client.request(
+    system = universe.system(system_id) if universe is not None else None
+    if system is not None:
+        if names:
+            return {'system': system.name, 'region': universe.region(system.region_id).name}
+        return {
+            'system_id': (system_id,),
+            'constellation_id': (system.constellation_id,),
+            'region_id': (system.region_id,)
+        }
+
+    system = await esi_client.request(
         esi_app.op['get_universe_systems_system_id'](system_id=system_id)
     )
     constellation_id = system.data['constellation_id']
-    region = esi_client.request(
+    region = (await esi_client.request(
         esi_app.op['get_universe_constellations_constellation_id'](constellation_id=constellation_id)
-    ).data
+    )).data
     if names:
         return {'system': system.data['name'], 'region': region['name']}
     return {'system_id': (system_id,), 'constellation_id': (constellation_id,), 'region_id': (region['region_id'],)}
 
 
-def extract_mail_data(esi_app, esi_client, killmail: dict) -> dict:
+class RecentIds:
+    """
+    Fixed size record of recently seen IDs; the oldest ID is forgotten once the buffer is full.
+    """
+    def __init__(self, size: int):
+        self.ring = deque(maxlen=size)
+        self.ids = set()
+
+    def __contains__(self, item):
+        return item in self.ids
+
+    def add(self, item) -> bool:
+        """
+        Records an ID.
+        :param item:
+        :return: False if the ID was already recorded.
+        """
+        if item in self.ids:
+            return False
+        if len(self.ring) == self.ring.maxlen:
+            self.ids.discard(self.ring[0])
+        self.ring.append(item)
+        self.ids.add(item)
+        return True
+
+    def save(self, path: str):
+        """
+        Writes the recorded IDs, oldest first, through a temporary file so an interrupted write never replaces a good
+        copy.
+        :param path:
+        :return:
+        """
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(list(self.ring), f)
+        os.replace(tmp, path)
+
+    def load(self, path: str):
+        """
+        Records the IDs saved by save, if the file exists.
+        :param path:
+        :return:
+        """
+        if not os.path.exists(path):
+            return
+        with open(path, 'r') as f:
+            for item in json.load(f):
+                self.add(item)
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 300.0) -> float:
+    """
+    Exponential backoff with full jitter.
+    :param attempt: Number of consecutive failures so far.
+    :param base: Delay ceiling for the first attempt, in seconds.
+    :param cap: Maximum delay ceiling, in seconds.
+    :return:
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def get_party_ids(parties: list) -> dict:
+    """
+    Collects the character, corporation, alliance and ship IDs of killmail parties (the victim or attackers).
+    :param parties: A list of victim/attacker dicts.
+    :return: A dict mapping entity type to a set of IDs.
+    """
+    ids = {x: set() for x in PARTY_KEYS}
+    for party in parties:
+        for entity_type, key in PARTY_KEYS.items():
+            if key in party:
+                ids[entity_type].add(party[key])
+
+    return ids
+
+
+async def extract_mail_data(esi_app, esi_client, killmail: dict, universe=None) -> dict:
     """
     Extracts all the relevant information from a killmail, returns a dict to be used when constructing
     the embed to be sent.
     :param esi_app:
     :param esi_client:
     :param killmail:
+    :param universe: The bot's UniverseIndex.
     :return:
     """
     # Get Basic Data
@@ -49,63 +155,34 @@ def extract_mail_data(esi_app, esi_client, killmail: dict) -> dict:
         link = killmail['zkb']['url']
     else:
         link = f'https://zkillboard.com/kill/{killmail["killmail_id"]}/'
-    location = get_location_dict(esi_app, esi_client, killmail['solar_system_id'], True)
+    location = await get_location_dict(esi_app, esi_client, killmail['solar_system_id'], True, universe)
     value = killmail['zkb']['totalValue']
 
-    # Get info to be added to victim
-    vic_corp_name = esi_client.request(
-        esi_app.op['get_corporations_corporation_id'](corporation_id=victim['corporation_id'])
-    ).data['name']
-    victim['corporation_name'] = vic_corp_name
-
-    vic_ally_name = None
-    if 'alliance_id' in victim:
-        vic_ally_name = esi_client.request(
-            esi_app.op['get_alliances_alliance_id'](alliance_id=victim['alliance_id'])
-        ).data['name']
-    victim['alliance_name'] = vic_ally_name
-
-    vic_char_name = None
-    if 'character_id' in victim:
-        vic_char_name = esi_client.request(
-            esi_app.op['get_characters_character_id'](character_id=victim['character_id'])
-        ).data['name']
-    victim['character_name'] = vic_char_name
-
-    # Get info to be added to final blow
-    final_corp_name = None
-    if 'corporation_id' in final_blow:
-        final_corp_name = esi_client.request(
-            esi_app.op['get_corporations_corporation_id'](corporation_id=final_blow['corporation_id'])
-        ).data['name']
-    final_blow['corporation_name'] = final_corp_name
-
-    final_char_name = '<Corpless NPC>'
-    if 'character_id' in final_blow:
-        final_char_name = esi_client.request(
-            esi_app.op['get_characters_character_id'](character_id=final_blow['character_id'])
-        ).data['name']
-    final_blow['character_name'] = final_char_name
-
-    final_ally_name = None
-    if 'alliance_id' in final_blow:
-        final_ally_name = esi_client.request(
-            esi_app.op['get_alliances_alliance_id'](alliance_id=final_blow['alliance_id'])
-        ).data['name']
-    final_blow['alliance_name'] = final_ally_name
-
-    final_ship_name = None
-    if 'ship_type_id' in final_blow:
-        final_ship_name = esi_client.request(
-            esi_app.op['get_universe_types_type_id'](type_id=final_blow['ship_type_id'])
-        ).data['name']
-    final_blow['ship_name'] =final_ship_name
-
-    # Get and add ship name to ship dict.
-    ship_name = esi_client.request(
-        esi_app.op['get_universe_types_type_id'](type_id=ship['type_id'])
-    ).data['name']
-    ship['name'] = ship_name
+    # Resolve every name the embed needs in a single bulk call.
+    names = await name_cache.resolve(esi_app, esi_client, [
+        victim.get('corporation_id'),
+        victim.get('alliance_id'),
+        victim.get('character_id'),
+        final_blow.get('corporation_id'),
+        final_blow.get('character_id'),
+        final_blow.get('alliance_id'),
+        final_blow.get('ship_type_id'),
+        ship['type_id'],
+    ])
+
+    # Add names to the victim
+    victim['corporation_name'] = names.get(victim.get('corporation_id'))
+    victim['alliance_name'] = names.get(victim.get('alliance_id'))
+    victim['character_name'] = names.get(victim.get('character_id'))
+
+    # Add names to the final blow
+    final_blow['corporation_name'] = names.get(final_blow.get('corporation_id'))
+    final_blow['character_name'] = names.get(final_blow.get('character_id'), '<Corpless NPC>')
+    final_blow['alliance_name'] = names.get(final_blow.get('alliance_id'))
+    final_blow['ship_name'] = names.get(final_blow.get('ship_type_id'))
+
+    # Add the ship name to the ship dict.
+    ship['name'] = names.get(ship['type_id'])
 
     processed = {
         'final_blow': final_blow,
@@ -0,0 +1,88 @@
+LOCATION_TYPES = ('system', 'constellation', 'region')
+PARTY_TYPES = ('character', 'corporation', 'alliance', 'ship')
+ENTITY_TYPES = LOCATION_TYPES + PARTY_TYPES
+
+
+class RoutingIndex:
+    """
+    Compiled kill feed subscriptions.
+        routes maps entity type -> entity ID -> frozenset of discord channel IDs subscribed to that entity, and
+        subscriptions maps discord channel ID -> entity type -> the set of IDs that channel is subscribed to.
+    """
+    def __init__(self):
+        self.routes = {x: {} for x in ENTITY_TYPES}
+        self.subscriptions = {}
+
+    @classmethod
+    def build(cls, rows) -> 'RoutingIndex':
+        """
+        Builds an index from (entity_type, entity_id, channel_id) rows.
+        :param rows:
+        :return:
+        """
+        routes = {x: {} for x in ENTITY_TYPES}
+        for entity_type, entity_id, channel_id in rows:
+            routes[entity_type].setdefault(int(entity_id), set()).add(channel_id)
+
+        index = cls()
+        for entity_type, entities in routes.items():
+            for entity_id, channel_ids in entities.items():
+                index.set_route(entity_type, entity_id, channel_ids)
+
+        return index
+
+    def set_route(self, entity_type: str, entity_id: int, channel_ids):
+        """
+        Replaces the set of channels subscribed to a single entity.
+        :param entity_type:
+        :param entity_id:
+        :param channel_ids: The discord channel IDs now subscribed to the entity.
+        :return:
+        """
+        entity_id = int(entity_id)
+        channel_ids = frozenset(channel_ids)
+        previous = self.routes[entity_type].get(entity_id, frozenset())
+
+        for channel_id in previous - channel_ids:
+            subscribed = self.subscriptions[channel_id]
+            subscribed[entity_type].discard(entity_id)
+            if len(subscribed[entity_type]) == 0:
+                del subscribed[entity_type]
+            if len(subscribed) == 0:
+                del self.subscriptions[channel_id]
+        for channel_id in channel_ids - previous:
+            self.subscriptions.setdefault(channel_id, {}).setdefault(entity_type, set()).add(entity_id)
+
+        if len(channel_ids) == 0:
+            self.routes[entity_type].pop(entity_id, None)
+        else:
+            self.routes[entity_type][entity_id] = channel_ids
+
+    def match(self, ids: dict) -> dict:
+        """
+        Returns the channels that should receive a killmail.
+        :param ids: A dict mapping entity type to the IDs of that type on the killmail.
+        :return: A dict mapping discord channel ID to the set of entity types it matched on.
+        """
+        matched = {}
+        for entity_type, type_ids in ids.items():
+            routes = self.routes[entity_type]
+            for entity_id in type_ids:
+                for channel_id in routes.get(entity_id, ()):
+                    matched.setdefault(channel_id, set()).add(entity_type)
+
+        return matched
+
+    def is_loss(self, channel_id: int, victim_ids: dict) -> bool:
+        """
+        Returns True when the channel is subscribed to the victim's character, corporation, alliance or ship.
+        :param channel_id:
+        :param victim_ids: A dict mapping party entity type to the victim's IDs of that type.
+        :return:
+        """
+        subscribed = self.subscriptions.get(channel_id, {})
+        for entity_type in PARTY_TYPES:
+            if not subscribed.get(entity_type, set()).isdisjoint(victim_ids.get(entity_type, ())):
+                return True
+
+        return False
@@ -2,14 +2,13 @@ import traceback
 import re
 from typing import Optional
 
-import aiohttp
 import discord
 from discord.ext import commands
 from discord.ext.commands import Cog
-from esipy import EsiClient
 from esipy.exceptions import APIException
 
 from utils import get_json
+from utils.cache import name_cache
 from utils.loggers import get_logger
 from cogs.kill_watch.helpers import extract_mail_data, build_embed as build_kill_embed
 from cogs.zkill_commands.helpers import get_char_stats_from_zkill, build_embed as build_threat_embed
@@ -22,11 +21,6 @@ class LinkListener(Cog):
     def __init__(self, bot):
         self.bot = bot
 
-        self.esi = EsiClient(
-            retry_requests=True,
-            headers={'User-Agent': f'application: MercuryBot contact: {self.bot.config["bot"]["user_agent"]}'}
-        )
-
     async def _get_killmail(self, kill_id: int) -> dict:
         """
         Get killmail from zkill and ESI.
@@ -36,8 +30,7 @@ class LinkListener(Cog):
 
         # Get zkill data
         kill_api_url = f'https://zkillboard.com/api/killID/{kill_id}/'
-        async with aiohttp.ClientSession() as session:
-            zkill_km = await get_json(session, kill_api_url)
+        zkill_km = await get_json(self.bot.session, kill_api_url)
 
         zkill_km = zkill_km['resp'][0]
 
@@ -47,7 +40,7 @@ class LinkListener(Cog):
             killmail_hash=zkill_km['zkb']['hash'],
         )
 
-        km_response = self.esi.request(km_op)
+        km_response = await self.bot.esi.request(km_op)
 
         km = km_response.data
         km['zkb'] = zkill_km['zkb']
@@ -61,30 +54,30 @@ class LinkListener(Cog):
         :param character_id:
         :return:
         """
-        name_op = self.bot.esi_app.op["get_characters_character_id"](
-            character_id=character_id
-        )
-
         try:
-            name_response = self.esi.request(name_op)
+            names = await name_cache.resolve(self.bot.esi_app, self.bot.esi, [character_id])
         except APIException:
             logger.error(f'Error getting name for character with ID {character_id} from ESI.')
             logger.error(traceback.print_exc())
             return None
 
-        return name_response.data['name']
+        return names.get(int(character_id))
 
     async def type_from_id(self, type_id: int) -> Optional[dict]:
         """
-        Returns a type ID from ESI for a given name.
-            Return value of None indicates an invalid type name.
+        Returns the type data for a given type ID, from the local type index or else ESI.
+            Return value of None indicates an invalid type ID.
         :param type_id:
         :return:
         """
+        name = self.bot.types.name(type_id)
+        if name is not None:
+            return {'type_id': int(type_id), 'name': name}
+
         post_op = self.bot.esi_app.op['get_universe_types_type_id'](type_id=type_id)
 
         try:
-            response = self.esi.request(post_op)
+            response = await self.bot.esi.request(post_op)
         except APIException:
             logger.error(f"Issue getting Type with ID {type_id} from ESI!")
             logger.error(traceback.print_exc())
@@ -113,13 +106,13 @@ class LinkListener(Cog):
             if re_match[3] == 'zkillboard':
                 if re_match[4] == '/kill/':
                     km = await self._get_killmail(re_match[5])
-                    data = extract_mail_data(self.bot.esi_app, self.esi, km)
+                    data = await extract_mail_data(self.bot.esi_app, self.bot.esi, km, self.bot.universe)
                     embed = await build_kill_embed(data)
 
                     return await message.reply(embed=embed)
                 elif re_match[4] == '/character/':
                     char_id = re_match[5]
-                    stats = await get_char_stats_from_zkill(char_id)
+                    stats = await get_char_stats_from_zkill(self.bot.session, char_id)
                     if stats is None:
                         return
                     char_name = await self._get_character_name_from_id(char_id)
@@ -134,7 +127,7 @@ class LinkListener(Cog):
                 type_data = await self.type_from_id(type_id)
                 # Rename the type_id key for compatability with embed builder.
                 type_data['id'] = type_data.pop('type_id')
-                market_data = await get_market_data(type_id)
+                market_data = await get_market_data(self.bot.session, type_id)
 
                 embed = await build_market_embed(type_data, market_data['resp'])
 
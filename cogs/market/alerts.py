@@ -0,0 +1,111 @@
+import re
+from typing import Optional
+
+import discord
+import numpy as np
+
+from utils.metrics import metrics
+
+HYSTERESIS = 0.02   # A triggered alert re-arms once the price is back more than 2% on the other side of its threshold.
+MAX_ALERTS = 25     # Per guild.
+
+# "PLEX sell < 4.5M", "Large Skill Injector buy > 900m" or "Tritanium sell<4.25"
+ALERT_PATTERN = re.compile(
+    r'^(?P<name>.+?)\s+(?P<side>sell|buy)\s*(?P<op>[<>])\s*(?P<price>\d[\d,]*(?:\.\d+)?)\s*(?P<unit>[kmb])?$',
+    re.IGNORECASE
+)
+UNITS = {'k': 1e3, 'm': 1e6, 'b': 1e9}
+
+
+def parse_alert(text: str) -> Optional[tuple]:
+    """
+    Parses an alert definition.
+    :param text:
+    :return: (item name, side, above, threshold), or None if the text is not a valid alert.
+    """
+    match = ALERT_PATTERN.match(text.strip())
+    if match is None:
+        return None
+
+    threshold = float(match['price'].replace(',', '')) * UNITS.get((match['unit'] or '').lower(), 1)
+    return match['name'].strip(), match['side'].lower(), match['op'] == '>', threshold
+
+
+class AlertBook:
+    """
+    The alert subscriptions as parallel arrays, so every alert can be evaluated against a poll in one pass.
+    """
+    def __init__(self, alerts: list):
+        """
+        :param alerts: A list of PriceAlert models.
+        """
+        self.alerts = alerts
+        count = len(alerts)
+        self.type_ids = np.fromiter((x.type_id for x in alerts), dtype=np.int64, count=count)
+        self.buy = np.fromiter((x.side == 'buy' for x in alerts), dtype=bool, count=count)
+        self.above = np.fromiter((x.above for x in alerts), dtype=bool, count=count)
+        self.thresholds = np.fromiter((x.threshold for x in alerts), dtype=np.float64, count=count)
+        self.triggered = np.fromiter((x.triggered for x in alerts), dtype=bool, count=count)
+
+    def __len__(self):
+        return len(self.alerts)
+
+    def types(self) -> list:
+        """
+        Returns the distinct type IDs with alerts, across every guild.
+        :return:
+        """
+        return [int(x) for x in np.unique(self.type_ids)]
+
+    def evaluate(self, market_data: dict) -> tuple:
+        """
+        Evaluates every alert against one poll of market data, updating each alert's triggered state.
+        :param market_data: A dict mapping str(type_id) to its fuzzwork aggregate data.
+        :return: (fired, rearmed) lists of PriceAlert models.
+        """
+        prices = {int(k): (float(v['sell']['min']), float(v['buy']['max'])) for k, v in market_data.items()}
+        sell = np.fromiter((prices.get(int(x), (0, 0))[0] for x in self.type_ids), dtype=np.float64, count=len(self))
+        buy = np.fromiter((prices.get(int(x), (0, 0))[1] for x in self.type_ids), dtype=np.float64, count=len(self))
+        price = np.where(self.buy, buy, sell)
+
+        # A price of 0 means there were no orders on that side, which should neither fire nor re-arm an alert.
+        valid = price > 0
+        crossed = np.where(self.above, price > self.thresholds, price < self.thresholds)
+        band = self.thresholds * HYSTERESIS
+        cleared = np.where(self.above, price < self.thresholds - band, price > self.thresholds + band)
+
+        fire = valid & crossed & ~self.triggered
+        rearm = valid & cleared & self.triggered
+        self.triggered = (self.triggered | fire) & ~rearm
+
+        fired = [self.alerts[i] for i in np.flatnonzero(fire)]
+        rearmed = [self.alerts[i] for i in np.flatnonzero(rearm)]
+        for alert in fired:
+            alert.triggered = True
+        for alert in rearmed:
+            alert.triggered = False
+
+        metrics.incr('market.alerts.fired', len(fired))
+        return fired, rearmed
+
+
+def build_alert_embed(alert, market_data: dict) -> discord.Embed:
+    """
+    Builds the message posted when an alert fires.
+    :param alert: A PriceAlert model.
+    :param market_data: A dict mapping str(type_id) to its fuzzwork aggregate data.
+    :return:
+    """
+    data = market_data[str(alert.type_id)]
+    direction = 'above' if alert.above else 'below'
+
+    embed = discord.Embed(
+        title=f"Price Alert: {alert.type_name}",
+        description=f"The {alert.side} price is {direction} {alert.threshold:,.2f} ISK.",
+        color=discord.Color.orange()
+    )
+    embed.set_thumbnail(url=f'https://imageserver.eveonline.com/Type/{alert.type_id}_64.png')
+    embed.add_field(name="Sell Min", value=f"{float(data['sell']['min']):,.2f} ISK", inline=True)
+    embed.add_field(name="Buy Max", value=f"{float(data['buy']['max']):,.2f} ISK", inline=True)
+    embed.set_footer(text=f"Alert {alert.id} - Jita 4-4 CNAP")
+    return embed
@@ -0,0 +1,198 @@
+import asyncio
+import csv
+import io
+import re
+
+import discord
+import numpy as np
+
+from utils.loggers import get_logger
+from utils.metrics import metrics
+from .helpers import get_market_data_many
+
+logger = get_logger(__name__)
+
+ESI_NAMES_CHUNK = 500   # Names per post_universe_ids request.
+TOP_COUNT = 10
+ATTACHMENT_THRESHOLD = 25   # Appraisals with more items than this also get a CSV of every line.
+
+# "Tritanium 10000", "Tritanium x10,000", "10000 Tritanium" and "10000x Tritanium".
+NUMBER = r'\d[\d,.\s]*'
+QUANTITY_LAST = re.compile(rf'^(.+?)\s+x?\s*({NUMBER})$', re.IGNORECASE)
+QUANTITY_FIRST = re.compile(rf'^({NUMBER})\s*x?\s+(.+)$', re.IGNORECASE)
+
+
+def parse_quantity(text: str) -> int:
+    """
+    Parses a quantity that may use commas, dots or spaces as thousands separators.
+    :param text:
+    :return:
+    """
+    digits = re.sub(r'[^\d]', '', text)
+    return int(digits) if digits else 1
+
+
+def parse_line(line: str):
+    """
+    Parses one line of a paste.
+        Tab separated lines (inventory, cargo scan and contract copies) are read as name, quantity, ... columns.
+    :param line:
+    :return: (name, quantity), or None for blank lines.
+    """
+    line = line.strip()
+    if line == '':
+        return None
+
+    if '\t' in line:
+        columns = line.split('\t')
+        quantity = parse_quantity(columns[1]) if len(columns) > 1 else 1
+        return columns[0].strip(), quantity
+
+    match = QUANTITY_LAST.match(line)
+    if match is not None:
+        return match[1].strip(), parse_quantity(match[2])
+    match = QUANTITY_FIRST.match(line)
+    if match is not None:
+        return match[2].strip(), parse_quantity(match[1])
+    return line, 1
+
+
+def parse_paste(lines) -> dict:
+    """
+    Parses a paste line by line, merging repeated items.
+    :param lines: Any iterable of lines, so large pastes never need to be held in memory twice.
+    :return: A dict mapping lowercased name to (name, total quantity), in the order items first appear.
+    """
+    items = {}
+    for line in lines:
+        parsed = parse_line(line)
+        if parsed is None:
+            continue
+        name, quantity = parsed
+        first_name, total = items.get(name.lower(), (name, 0))
+        items[name.lower()] = (first_name, total + quantity)
+
+    return items
+
+
+async def resolve_types(bot, names: list) -> dict:
+    """
+    Resolves type names, from the local type index where possible and with bulk ESI calls for the rest.
+    :param bot:
+    :param names:
+    :return: A dict mapping lowercased name to (type_id, type name).
+    """
+    resolved = {}
+    missing = []
+    for name in names:
+        match = bot.types.exact(name)
+        if match is None:
+            missing.append(name)
+        else:
+            resolved[name.lower()] = match
+
+    chunks = [missing[i:i + ESI_NAMES_CHUNK] for i in range(0, len(missing), ESI_NAMES_CHUNK)]
+    responses = await asyncio.gather(*[
+        bot.esi.request(bot.esi_app.op['post_universe_ids'](names=chunk)) for chunk in chunks
+    ])
+    for response in responses:
+        if response.status == 200 and 'inventory_types' in response.data:
+            for x in response.data['inventory_types']:
+                resolved[x['name'].lower()] = (x['id'], x['name'])
+
+    return resolved
+
+
+async def appraise(bot, lines, region_id=None, station_id=None) -> dict:
+    """
+    Appraises a paste of items.
+    :param bot:
+    :param lines: An iterable of lines.
+    :param region_id:
+    :param station_id: Defaults to Jita 4-4 CNAP when neither location is given.
+    :return: A dict with:
+        rows: A list of (name, type_id, quantity, sell, buy) tuples, where sell and buy are unit prices,
+        missing: Names that could not be priced,
+        sell, buy: Totals,
+        top: Indices of rows ordered by sell value, largest first, at most TOP_COUNT.
+    """
+    with metrics.timer('market.appraise', histogram=True):
+        items = parse_paste(lines)
+        types = await resolve_types(bot, [x[0] for x in items.values()])
+
+        market_data = await get_market_data_many(bot.session, [x[0] for x in types.values()], region_id, station_id)
+
+        rows = []
+        missing = []
+        for key, (name, quantity) in items.items():
+            if key not in types or str(types[key][0]) not in market_data:
+                missing.append(name)
+                continue
+            type_id, type_name = types[key]
+            data = market_data[str(type_id)]
+            rows.append((type_name, type_id, quantity, float(data['sell']['min']), float(data['buy']['max'])))
+
+        quantities = np.fromiter((x[2] for x in rows), dtype=np.float64, count=len(rows))
+        sell = np.fromiter((x[3] for x in rows), dtype=np.float64, count=len(rows)) * quantities
+        buy = np.fromiter((x[4] for x in rows), dtype=np.float64, count=len(rows)) * quantities
+
+    metrics.incr('market.appraise.lines', len(items))
+    return {
+        'rows': rows,
+        'missing': missing,
+        'sell': float(sell.sum()),
+        'buy': float(buy.sum()),
+        'top': [int(x) for x in np.argsort(-sell, kind='stable')[:TOP_COUNT]],
+    }
+
+
+def build_appraisal_embed(result: dict) -> discord.Embed:
+    """
+    Builds the summary embed for an appraisal.
+    :param result: The result of appraise.
+    :return:
+    """
+    rows = result['rows']
+    embed = discord.Embed(title=f"Appraisal ({len(rows)} items)", color=discord.Color.gold())
+    embed.set_author(
+        name="Fuzzwork Market Data",
+        url="https://market.fuzzwork.co.uk",
+        icon_url="http://image.eveonline.com/Corporation/98072480_128.png"
+    )
+
+    embed.add_field(name='Sell Value', value=f"{result['sell']:,.2f} ISK", inline=True)
+    embed.add_field(name='\u200B', value='\u200B', inline=True)  # Empty Field
+    embed.add_field(name='Buy Value', value=f"{result['buy']:,.2f} ISK", inline=True)
+
+    top = []
+    for i in result['top']:
+        name, _, quantity, sell, _ = rows[i]
+        top.append(f'{quantity:,} x {name}: {quantity * sell:,.2f} ISK')
+    if len(top) != 0:
+        embed.add_field(name='Top Items (Sell)', value='\n'.join(top), inline=False)
+
+    if len(result['missing']) != 0:
+        missing = ', '.join(f'`{x}`' for x in result['missing'][:20])
+        if len(result['missing']) > 20:
+            missing += f" and {len(result['missing']) - 20} more"
+        embed.add_field(name='Not Found', value=missing[:1024], inline=False)
+
+    return embed
+
+
+def build_appraisal_file(result: dict) -> discord.File:
+    """
+    Builds a CSV attachment with every appraised line.
+    :param result: The result of appraise.
+    :return:
+    """
+    text = io.StringIO()
+    writer = csv.writer(text)
+    writer.writerow(('name', 'type_id', 'quantity', 'sell_unit', 'buy_unit', 'sell_total', 'buy_total'))
+    for name, type_id, quantity, sell, buy in result['rows']:
+        writer.writerow((name, type_id, quantity, f'{sell:.2f}', f'{buy:.2f}',
+                         f'{sell * quantity:.2f}', f'{buy * quantity:.2f}'))
+    for name in result['missing']:
+        writer.writerow((name, '', '', '', '', '', ''))
+
+    return discord.File(io.BytesIO(text.getvalue().encode('utf-8')), filename='appraisal.csv')
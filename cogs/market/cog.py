@@ -2,15 +2,27 @@ import traceback
 from typing import Optional
 
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord.ext.commands import Cog
-from esipy import EsiClient
 
+from utils import checks
+from utils.dispatch import PRIORITY_ALERT
 from utils.loggers import get_logger
+from utils.metrics import metrics
+from utils.paginator import paginate
+from .alerts import MAX_ALERTS, AlertBook, build_alert_embed, parse_alert
+from .appraisal import ATTACHMENT_THRESHOLD, appraise, build_appraisal_embed, build_appraisal_file
 from .helpers import *
+from .history import SAMPLE_INTERVAL, add_trend_field, price_history
+from .models import *
 
 logger = get_logger(__name__)
 
+# Items refreshed in the background whether or not they have been asked for:
+# PLEX, Large Skill Injector, Small Skill Injector and Skill Extractor.
+HOT_TYPES = (44992, 40520, 45635, 40519)
+HOT_COUNT = 20  # Number of the most requested items that are also kept fresh.
+
 
 class Market(Cog):
     """
@@ -19,34 +31,332 @@ class Market(Cog):
     def __init__(self, bot):
         self.bot = bot
 
-        self.esi = EsiClient(
-            retry_requests=True,
-            headers={'User-Agent': f'application: MercuryBot contact: {self.bot.config["bot"]["user_agent"]}'}
-        )
+        self.alerts = None
+
+        price_history.load()
+
+        self.refresh_hot.start()
+        self.record_history.start()
+        self.poll_alerts.start()
+
+    def cog_unload(self):
+        self.refresh_hot.cancel()
+        self.record_history.cancel()
+        self.poll_alerts.cancel()
+
+    async def load_alerts(self):
+        """
+        Loads self.alerts
+        :return:
+        """
+        self.alerts = AlertBook(await PriceAlert.all())
+        metrics.gauge('market.alerts.count', len(self.alerts))
+
+    @tasks.loop(seconds=MARKET_TTL - 60)
+    async def refresh_hot(self):
+        """
+        Refreshes the hot items before their cache entries expire, so lookups for them never wait on fuzzwork.
+        :return:
+        """
+        locations = {location_param(): set(HOT_TYPES)}
+        for type_id, location in market_cache.hot(HOT_COUNT):
+            locations.setdefault(location, set()).add(type_id)
+        market_cache.evict()
+        market_cache.decay()
+
+        try:
+            with metrics.timer('market.hot_refresh'):
+                for location, type_ids in locations.items():
+                    await fetch_aggregates(self.bot.session, sorted(type_ids), location)
+        except Exception as e:
+            logger.warning(f"Error refreshing hot market items: {e}")
+            logger.warning(traceback.format_exc())
 
-    def type_from_name(self, name: str) -> Optional[dict]:
+    @tasks.loop(seconds=SAMPLE_INTERVAL)
+    async def record_history(self):
+        """
+        Records a price history sample for the hot items at Jita.
+            Most of them are kept fresh by refresh_hot, so this rarely needs to fetch anything itself.
+        :return:
         """
-        Returns a type ID from ESI for a given name.
+        location = location_param()
+        type_ids = set(HOT_TYPES) | {x for x, loc in market_cache.hot(HOT_COUNT) if loc == location}
+        if self.alerts is not None:
+            type_ids.update(self.alerts.types())
+
+        aggregates = {}
+        missing = []
+        for type_id in type_ids:
+            cached = market_cache.peek(type_id, location)
+            if cached is None:
+                missing.append(type_id)
+            else:
+                aggregates[type_id] = cached
+
+        try:
+            if len(missing) != 0:
+                aggregates.update(await fetch_aggregates(self.bot.session, sorted(missing), location))
+            price_history.record(aggregates)
+            await self.bot.loop.run_in_executor(None, price_history.save)
+        except Exception as e:
+            logger.warning(f"Error recording market history: {e}")
+            logger.warning(traceback.format_exc())
+
+    @tasks.loop(seconds=MARKET_TTL)
+    async def poll_alerts(self):
+        """
+        Checks every price alert against Jita prices.
+            Types are deduplicated across guilds and fetched in multi-type batches, then every alert is evaluated in
+            one pass.
+        :return:
+        """
+        try:
+            if len(self.alerts) == 0:
+                return
+
+            with metrics.timer('market.alerts.poll'):
+                market_data = await get_market_data_many(self.bot.session, self.alerts.types())
+
+                fired, rearmed = self.alerts.evaluate(market_data)
+
+            if len(fired) != 0:
+                await PriceAlert.filter(id__in=[x.id for x in fired]).update(triggered=True)
+                sends = [(x.channel_id, {'embed': build_alert_embed(x, market_data)}) for x in fired]
+                await self.bot.dispatcher.fanout('alerts', PRIORITY_ALERT, sends)
+            if len(rearmed) != 0:
+                await PriceAlert.filter(id__in=[x.id for x in rearmed]).update(triggered=False)
+        except Exception as e:
+            logger.warning(f"Error polling price alerts: {e}")
+            logger.warning(traceback.format_exc())
+
+    @poll_alerts.before_loop
+    async def before_poll_alerts(self):
+        # Wait until the bot is ready and connected to the database.
+        await self.bot.wait_until_ready()
+        await self.bot.db_ready.wait()
+        await self.load_alerts()
+
+    async def type_from_name(self, name: str) -> Optional[dict]:
+        """
+        Returns a type ID for a given name, from the local type index or else ESI.
             Return value of None indicates an invalid type name.
         :param name:
         :return:
         """
+        match = self.bot.types.resolve(name)
+        if match is not None:
+            return {'id': match[0], 'name': match[1]}
+
         post_op = self.bot.esi_app.op['post_universe_ids'](names=[name])
-        response = self.esi.request(post_op)
+        response = await self.bot.esi.request(post_op)
         if 'inventory_types' not in response.data:
             return None
         return response.data['inventory_types'][0]
 
+    async def types_from_names(self, names: list) -> dict:
+        """
+        Resolves many type names, locally where possible and otherwise with a single ESI call.
+        :param names:
+        :return: A dict mapping each lowercased name that was found to its {'id', 'name'} type data.
+        """
+        types = {}
+        missing = []
+        for name in names:
+            match = self.bot.types.resolve(name)
+            if match is None:
+                missing.append(name)
+            else:
+                types[name.lower()] = {'id': match[0], 'name': match[1]}
+        if len(missing) == 0:
+            return types
+
+        post_op = self.bot.esi_app.op['post_universe_ids'](names=missing)
+        response = await self.bot.esi.request(post_op)
+        if response.status != 200 or 'inventory_types' not in response.data:
+            return types
+        types.update({x['name'].lower(): {'id': x['id'], 'name': x['name']} for x in response.data['inventory_types']})
+        return types
+
     @commands.command(aliases=['pc'])
-    async def price_check(self, ctx, item_name):
+    async def price_check(self, ctx, *, items: str):
+        """
+        Check the price of one or more items.
+            Separate items with commas or new lines, optionally with quantities (e.g. "10 PLEX, Tritanium x1000").
+            Returns Jita price data. Add --hubs to compare prices at Jita, Amarr, Dodixie, Rens and Hek instead.
+        """
+        hubs = '--hubs' in items.split()
+        if hubs:
+            items = items.replace('--hubs', '')
+
+        # Merge repeated items, keeping the order they were given in.
+        wanted = {}
+        for name, quantity in parse_item_list(items):
+            first_name, total = wanted.get(name.lower(), (name, 0))
+            wanted[name.lower()] = (first_name, total + quantity)
+        if len(wanted) == 0:
+            return await ctx.send("Please provide at least one item.")
+        if len(wanted) > 500:
+            return await ctx.send("Please price check at most 500 different items at a time.")
+
+        if hubs:
+            return await self.hub_comparison(ctx, [x[0] for x in wanted.values()])
+
+        # A single item with no quantity keeps the detailed embed.
+        if len(wanted) == 1 and list(wanted.values())[0][1] == 1:
+            type_data = await self.type_from_name(list(wanted.values())[0][0])
+            if type_data is None:
+                return await ctx.send("Item not found. Please check your spelling and try again.")
+            market_data = await get_market_data(self.bot.session, type_data['id'])
+            embed = await build_embed(type_data, market_data['resp'])
+            note = substitution_note([(list(wanted.values())[0][0], type_data['name'])])
+            return await ctx.send(note, embed=add_trend_field(embed, type_data['id']))
+
+        types = await self.types_from_names([x[0] for x in wanted.values()])
+        market_data = await get_market_data_many(self.bot.session, [x['id'] for x in types.values()])
+
+        rows = []
+        missing = []
+        resolved = []
+        for key, (name, quantity) in wanted.items():
+            if key not in types or str(types[key]['id']) not in market_data:
+                missing.append(name)
+                continue
+            type_data = types[key]
+            resolved.append((name, type_data['name']))
+            data = market_data[str(type_data['id'])]
+            rows.append((
+                type_data['name'],
+                type_data['id'],
+                quantity,
+                float(data['sell']['min']),
+                float(data['buy']['max'])
+            ))
+
+        if len(rows) == 0:
+            return await ctx.send("None of those items were found. Please check your spelling and try again.")
+
+        return await paginate(self.bot, ctx, build_list_embeds(rows, missing), content=substitution_note(resolved))
+
+    async def hub_comparison(self, ctx, names: list):
+        """
+        Replies with a comparison of prices at each trade hub.
+        :param ctx:
+        :param names:
+        :return:
+        """
+        if len(names) > HUB_ITEMS:
+            return await ctx.send(f"Please compare at most {HUB_ITEMS} items across hubs at a time.")
+
+        types = await self.types_from_names(names)
+        missing = [x for x in names if x.lower() not in types]
+        if len(types) == 0:
+            return await ctx.send("None of those items were found. Please check your spelling and try again.")
+
+        hub_data = await get_hub_data(self.bot.session, [x['id'] for x in types.values()])
+        note = substitution_note([(x, types[x.lower()]['name']) for x in names if x.lower() in types])
+        return await ctx.send(note, embed=build_hub_embed(list(types.values()), hub_data, missing))
+
+    @commands.command(aliases=['ap'])
+    async def appraise(self, ctx, *, paste: str = ''):
         """
-        Check the price of a given item.
-            Returns Jita price data.
+        Appraise a list of items at Jita prices.
+            Paste one item per line (inventory, cargo scan and contract copies work), or attach a text file.
+            Returns buy and sell totals, the most valuable items and, for long lists, a CSV of every line.
+        """
+        if len(ctx.message.attachments) != 0:
+            attachment = ctx.message.attachments[0]
+            if attachment.size > 1024 * 1024:
+                return await ctx.send("Please attach a file no larger than 1MB.")
+            lines = (await attachment.read()).decode('utf-8', errors='replace').splitlines()
+        else:
+            lines = paste.splitlines()
+
+        async with ctx.typing():
+            result = await appraise(self.bot, lines)
+        if len(result['rows']) == 0:
+            return await ctx.send("None of those items were found. Please check your paste and try again.")
+
+        embed = build_appraisal_embed(result)
+        if len(result['rows']) + len(result['missing']) > ATTACHMENT_THRESHOLD:
+            return await ctx.send(embed=embed, file=build_appraisal_file(result))
+        return await ctx.send(embed=embed)
+
+    @commands.command(aliases=['pa', 'alert'])
+    @checks.is_admin()
+    async def price_alert(self, ctx, action, *, alert: str = ''):
         """
-        type_data = self.type_from_name(item_name)
-        market_data = await get_market_data(type_data['id'])
+        Manages the server's Jita price alerts, which are posted to the channel they were added from.
+
+            Valid Actions:
+             - add: e.g. "add PLEX sell < 4.5M" or "add Large Skill Injector buy > 900m"
+             - remove (aliases: delete): takes the alert ID shown by list
+             - list
+
+            An alert posts once when its price crosses the threshold, and again only after the price has moved back
+            past it.
+        """
+        action = action.lower()
+        if action == 'add':
+            parsed = parse_alert(alert)
+            if parsed is None:
+                return await ctx.send("Please give the alert as `<item> sell|buy <|> <price>`, "
+                                      "e.g. `PLEX sell < 4.5M`.")
+            name, side, above, threshold = parsed
+            if await PriceAlert.filter(guild_id=ctx.guild.id).count() >= MAX_ALERTS:
+                return await ctx.send(f"This server already has {MAX_ALERTS} price alerts. Please remove one first.")
+
+            # Alerts are kept indefinitely, so only an exact name is accepted; a guess could watch the wrong item.
+            match = self.bot.types.exact(name)
+            if match is not None:
+                type_data = {'id': match[0], 'name': match[1]}
+            elif self.bot.types.loaded:
+                candidates = self.bot.types.fuzzy(name)
+                if len(candidates) == 0:
+                    return await ctx.send("Item not found. Please check your spelling and try again.")
+                suggestions = ', '.join(f'`{x[1]}`' for x in candidates)
+                return await ctx.send(f"No item is named exactly `{name}`. Did you mean: {suggestions}?")
+            else:
+                # ESI only matches exact names.
+                response = await self.bot.esi.request(self.bot.esi_app.op['post_universe_ids'](names=[name]))
+                if 'inventory_types' not in response.data:
+                    return await ctx.send("Item not found. Please check your spelling and try again.")
+                type_data = response.data['inventory_types'][0]
+
+            price_alert = await PriceAlert.create(
+                guild_id=ctx.guild.id,
+                channel_id=ctx.channel.id,
+                type_id=type_data['id'],
+                type_name=type_data['name'],
+                side=side,
+                above=above,
+                threshold=threshold
+            )
+            await self.load_alerts()
+            return await ctx.send(f"Added alert `{price_alert}` in {ctx.channel.mention}.")
+
+        elif action in ('remove', 'delete'):
+            if not alert.strip().isdigit():
+                return await ctx.send("Please give the ID of the alert to remove. (See the `list` action.)")
+            price_alert = await PriceAlert.filter(pk=int(alert), guild_id=ctx.guild.id).first()
+            if price_alert is None:
+                return await ctx.send(f"There is no alert with ID {alert.strip()} on this server.")
+
+            await price_alert.delete()
+            await self.load_alerts()
+            return await ctx.send(f"Removed alert `{price_alert}`.")
+
+        elif action == 'list':
+            price_alerts = await PriceAlert.filter(guild_id=ctx.guild.id).order_by('id')
+            if len(price_alerts) == 0:
+                return await ctx.send("This server has no price alerts.")
+
+            lines = [f'{x} in <#{x.channel_id}>{" (triggered)" if x.triggered else ""}' for x in price_alerts]
+            embed = discord.Embed(title=f"Price Alerts for {ctx.guild.name}", description='\n'.join(lines))
+            return await ctx.send(embed=embed)
 
-        return await ctx.send(embed=await build_embed(type_data, market_data['resp']))
+        else:
+            return await ctx.send(f"{action} is not a valid action for this command. To see valid actions run "
+                                  f"the help command. (`/help price_alert`)")
 
 
 def setup(bot):
@@ -1,32 +1,343 @@
-import aiohttp
+import asyncio
+import re
+import time
+from collections import Counter
+from typing import Optional
 
 import discord
 
 from utils import get_json
 from utils.loggers import get_logger
+from utils.metrics import metrics
 
 logger = get_logger(__name__)
 
+JITA_STATION = 60003760
+MARKET_TTL = 300    # Fuzzwork aggregates are only rebuilt every few minutes.
+MARKET_CACHE_SIZE = 5000    # Most (type, location) aggregates kept at once.
+REQUEST_KEYS = 1000     # Most (type, location) request counts kept for picking hot items.
+AGGREGATES_URL = 'https://market.fuzzwork.co.uk/aggregates/?{location}&types={types}'
+ITEMS_PER_PAGE = 10
+FUZZWORK_CHUNK = 200    # Most types in one fuzzwork aggregates request.
+HUBS = {
+    'Jita': JITA_STATION,
+    'Amarr': 60008494,
+    'Dodixie': 60011866,
+    'Rens': 60004588,
+    'Hek': 60005686,
+}
+HUB_ITEMS = 10  # Most items a hub comparison will show, one embed field each.
 
-async def get_market_data(type_id, region_id=None, station_id=None) -> dict:
+# "100 Tritanium", "100x Tritanium", "Tritanium x100" and "Tritanium 100".
+QUANTITY_FIRST = re.compile(r'^(\d+)\s*x?\s+(.+)$', re.IGNORECASE)
+QUANTITY_LAST = re.compile(r'^(.+?)\s+x?\s*(\d+)$', re.IGNORECASE)
+
+
+def location_param(region_id=None, station_id=None) -> str:
+    """
+    Returns the fuzzwork location parameter, defaulting to Jita 4-4 CNAP.
+    :param region_id: The API will accept both region and system IDs for this field.
+    :param station_id:
+    :return:
+    """
+    if station_id:
+        return f"station={station_id}"
+    elif region_id:
+        return f"region={region_id}"
+    return f"station={JITA_STATION}"
+
+
+class MarketCache:
+    """
+    Fuzzwork aggregates keyed by (type_id, location), each kept for MARKET_TTL seconds and at most size at once.
+        Lookups are counted per key so the most requested items can be refreshed in the background. The counts are
+        halved by decay(), so they favour recent requests and keys nobody asks for any more drop out.
+    """
+    def __init__(self, ttl: float = MARKET_TTL, size: int = MARKET_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self.entries = {}   # Oldest first.
+        self.requests = Counter()
+
+    def get(self, type_id: int, location: str):
+        """
+        Returns the cached aggregate for a type, or None if there is no fresh copy.
+        :param type_id:
+        :param location: A location_param string.
+        :return:
+        """
+        key = (int(type_id), location)
+        self.requests[key] += 1
+        entry = self.entries.get(key)
+        if entry is not None and time.time() - entry[1] > self.ttl:
+            del self.entries[key]
+            entry = None
+        if entry is None:
+            metrics.incr('market.cache.misses')
+            self._hit_rate()
+            return None
+
+        metrics.incr('market.cache.hits')
+        metrics.observe('market.cache.staleness', time.time() - entry[1])
+        self._hit_rate()
+        return entry[0]
+
+    def peek(self, type_id: int, location: str):
+        """
+        Returns the cached aggregate for a type if there is a fresh copy, without counting it as a request.
+        :param type_id:
+        :param location: A location_param string.
+        :return:
+        """
+        entry = self.entries.get((int(type_id), location))
+        if entry is None or time.time() - entry[1] > self.ttl:
+            return None
+        return entry[0]
+
+    def set(self, type_id: int, location: str, data: dict):
+        key = (int(type_id), location)
+        self.entries.pop(key, None)     # Re-inserted at the end, so the dict stays in age order.
+        self.entries[key] = (data, time.time())
+        while len(self.entries) > self.size:
+            del self.entries[next(iter(self.entries))]
+        metrics.gauge('market.cache.entries', len(self.entries))
+
+    def evict(self):
+        """
+        Drops expired entries.
+        :return:
+        """
+        cutoff = time.time() - self.ttl
+        for key in [k for k, v in self.entries.items() if v[1] < cutoff]:
+            del self.entries[key]
+        metrics.gauge('market.cache.entries', len(self.entries))
+
+    def decay(self):
+        """
+        Halves the request counts, dropping keys that reach 0 and keeping at most REQUEST_KEYS.
+        :return:
+        """
+        self.requests = Counter({k: v // 2 for k, v in self.requests.most_common(REQUEST_KEYS) if v // 2 > 0})
+
+    def hot(self, count: int) -> list:
+        """
+        Returns the most requested (type_id, location) keys.
+        :param count:
+        :return:
+        """
+        return [x for x, _ in self.requests.most_common(count)]
+
+    @staticmethod
+    def _hit_rate():
+        hits = metrics.counters.get('market.cache.hits', 0)
+        total = hits + metrics.counters.get('market.cache.misses', 0)
+        metrics.gauge('market.cache.hit_rate', round(hits / total, 3))
+
+
+market_cache = MarketCache()
+
+
+async def fetch_aggregates(session, type_ids, location: str) -> dict:
+    """
+    Fetches fuzzwork aggregates for several types at one location in a single request, and caches them.
+    :param session: The bot's shared HTTP session.
+    :param type_ids:
+    :param location: A location_param string.
+    :return: A dict mapping str(type_id) to its aggregate data.
+    """
+    types = ','.join(str(x) for x in type_ids)
+    response = await get_json(session, AGGREGATES_URL.format(location=location, types=types))
+    data = response['resp']
+    for type_id, aggregate in data.items():
+        market_cache.set(type_id, location, aggregate)
+
+    return data
+
+
+async def get_market_data(session, type_id, region_id=None, station_id=None) -> dict:
     """
     Returns market data from the fuzzwork API for the given type_id at the given location.
         If no region or station id is provided default will be Jita 4-4 CNAP.
+        Data less than MARKET_TTL seconds old is served from the cache.
+    :param session: The bot's shared HTTP session.
     :param type_id:
     :param region_id: The API will accept both region and system IDs for this field.
     :param station_id:
     :return:
     """
-    location = "station=60003760"
-    if station_id:
-        location = f"station={station_id}"
-    elif region_id:
-        location = f"region={region_id}"
+    location = location_param(region_id, station_id)
+    cached = market_cache.get(type_id, location)
+    if cached is not None:
+        return {'resp': {str(type_id): cached}, 'code': 200}
+
+    return {'resp': await fetch_aggregates(session, [type_id], location), 'code': 200}
+
+
+async def get_market_data_many(session, type_ids, region_id=None, station_id=None) -> dict:
+    """
+    Returns market data for several types at one location.
+        Cached types are served from the cache and the rest are fetched concurrently, FUZZWORK_CHUNK types per
+        fuzzwork request.
+    :param session: The bot's shared HTTP session.
+    :param type_ids:
+    :param region_id:
+    :param station_id:
+    :return: A dict mapping str(type_id) to its aggregate data.
+    """
+    location = location_param(region_id, station_id)
+    data = {}
+    missing = []
+    for type_id in set(type_ids):
+        cached = market_cache.get(type_id, location)
+        if cached is None:
+            missing.append(type_id)
+        else:
+            data[str(type_id)] = cached
+
+    missing.sort()
+    for fetched in await asyncio.gather(*[
+        fetch_aggregates(session, missing[i:i + FUZZWORK_CHUNK], location)
+        for i in range(0, len(missing), FUZZWORK_CHUNK)
+    ]):
+        data.update(fetched)
+
+    return data
+
+
+async def get_hub_data(session, type_ids) -> dict:
+    """
+    Returns market data for several types at every trade hub, fetching all hubs concurrently.
+    :param session: The bot's shared HTTP session.
+    :param type_ids:
+    :return: A dict mapping hub name to a dict of str(type_id) to aggregate data.
+    """
+    with metrics.timer('market.hubs'):
+        results = await asyncio.gather(*[
+            get_market_data_many(session, type_ids, station_id=station_id) for station_id in HUBS.values()
+        ])
+
+    return dict(zip(HUBS, results))
+
+
+def parse_item_list(text: str) -> list:
+    """
+    Parses a comma or newline separated list of items, each with an optional quantity (digits only, as commas separate
+    items).
+    :param text:
+    :return: A list of (name, quantity) tuples, in the order given.
+    """
+    items = []
+    for entry in re.split(r'[,\n]', text):
+        entry = entry.strip()
+        if entry == '':
+            continue
+        quantity = 1
+        match = QUANTITY_FIRST.match(entry) or QUANTITY_LAST.match(entry)
+        if match is not None:
+            first, second = match.groups()
+            count, entry = (first, second) if match.re is QUANTITY_FIRST else (second, first)
+            quantity = int(count)
+        items.append((entry.strip(), quantity))
+
+    return items
+
+
+def substitution_note(pairs) -> Optional[str]:
+    """
+    Describes the items that were resolved to a different name than the one asked for (a prefix or typo match), so
+    users can see a substitution happened.
+    :param pairs: An iterable of (requested name, resolved name) tuples.
+    :return: The note, or None if every item matched exactly.
+    """
+    substituted = [(x, y) for x, y in pairs if x.strip().lower() != y.lower()]
+    if len(substituted) == 0:
+        return None
+    if len(substituted) == 1:
+        return f'Showing results for **{substituted[0][1]}**.'
+
+    note = 'Showing results for: ' + ', '.join(f'`{x}` → **{y}**' for x, y in substituted)
+    return note if len(note) <= 1000 else note[:997] + '...'
+
+
+def build_list_embeds(rows: list, missing: list) -> list:
+    """
+    Builds the pages of a multi-item price check.
+    :param rows: A list of (name, type_id, quantity, sell, buy) tuples, where sell and buy are unit prices (the
+                 lowest sell order and the highest buy order).
+    :param missing: Names that could not be priced.
+    :return: A list of discord Embeds.
+    """
+    total_sell = sum(x[2] * x[3] for x in rows)
+    total_buy = sum(x[2] * x[4] for x in rows)
+    totals = f'**Sell:** {total_sell:,.2f} ISK\n**Buy:** {total_buy:,.2f} ISK'
+
+    pages = []
+    for i in range(0, max(len(rows), 1), ITEMS_PER_PAGE):
+        embed = discord.Embed(title=f"Price Check ({len(rows)} items)")
+        embed.set_author(
+            name="Fuzzwork Market Data",
+            url="https://market.fuzzwork.co.uk",
+            icon_url="http://image.eveonline.com/Corporation/98072480_128.png"
+        )
+        for name, type_id, quantity, sell, buy in rows[i:i + ITEMS_PER_PAGE]:
+            embed.add_field(
+                name=f'{quantity:,} x {name}' if quantity != 1 else name,
+                value=f'Sell: {sell * quantity:,.2f} ISK ({sell:,.2f} ea)\n'
+                      f'Buy: {buy * quantity:,.2f} ISK ({buy:,.2f} ea)',
+                inline=False
+            )
+        embed.add_field(name='Total', value=totals, inline=False)
+        if len(missing) != 0:
+            embed.description = 'Not found: ' + ', '.join(f'`{x}`' for x in missing)
+        pages.append(embed)
+
+    return pages
+
+
+def build_hub_embed(types: list, hub_data: dict, missing: list) -> discord.Embed:
+    """
+    Builds a comparison of the lowest sell and highest buy order at each trade hub, marking the best of each.
+    :param types: A list of {'id', 'name'} type data.
+    :param hub_data: The result of get_hub_data.
+    :param missing: Names that could not be found.
+    :return:
+    """
+    embed = discord.Embed(title="Trade Hub Comparison")
+    embed.set_author(
+        name="Fuzzwork Market Data",
+        url="https://market.fuzzwork.co.uk",
+        icon_url="http://image.eveonline.com/Corporation/98072480_128.png"
+    )
+    if len(types) == 1:
+        embed.set_thumbnail(url=f'https://imageserver.eveonline.com/Type/{types[0]["id"]}_64.png')
+
+    for type_data in types:
+        prices = {}
+        for hub, data in hub_data.items():
+            aggregate = data.get(str(type_data['id']))
+            if aggregate is not None:
+                prices[hub] = (float(aggregate['sell']['min']), float(aggregate['buy']['max']))
+
+        # A sell min of 0 means there are no sell orders at that hub.
+        sells = [x[0] for x in prices.values() if x[0] > 0]
+        best_sell = min(sells) if len(sells) != 0 else None
+        best_buy = max((x[1] for x in prices.values()), default=0) or None
 
-    url = f"https://market.fuzzwork.co.uk/aggregates/?{location}&types={type_id}"
+        lines = []
+        for hub, (sell, buy) in prices.items():
+            sell_text = f'{sell:,.2f}' if sell > 0 else '-'
+            buy_text = f'{buy:,.2f}' if buy > 0 else '-'
+            if sell == best_sell:
+                sell_text = f'**{sell_text}**'
+            if buy == best_buy:
+                buy_text = f'**{buy_text}**'
+            lines.append(f'{hub}: Sell {sell_text} / Buy {buy_text}')
+        embed.add_field(name=type_data['name'], value='\n'.join(lines) or 'No market data.', inline=False)
 
-    async with aiohttp.ClientSession() as session:
-        return await get_json(session, url)
+    if len(missing) != 0:
+        embed.description = 'Not found: ' + ', '.join(f'`{x}`' for x in missing)
+    embed.set_footer(text='Best sell and buy prices in bold.')
+    return embed
 
 
 async def build_embed(type_data: dict, market_data: dict) -> discord.Embed:
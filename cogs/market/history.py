@@ -0,0 +1,182 @@
+import os
+import time
+from typing import Optional
+
+import discord
+import numpy as np
+
+from utils.loggers import get_logger
+from utils.metrics import metrics
+
+logger = get_logger(__name__)
+
+HISTORY_PATH = 'data/price_history.npz'
+SAMPLE_INTERVAL = 900   # Seconds between samples.
+HISTORY_SECONDS = 7 * 24 * 3600
+CAPACITY = HISTORY_SECONDS // SAMPLE_INTERVAL + 1
+TREND_WINDOWS = (('24h', 24 * 3600), ('7d', HISTORY_SECONDS))
+
+
+class PriceHistory:
+    """
+    Sampled sell and buy prices for a set of types, kept for HISTORY_SECONDS.
+        Each type gets one row in three (types, CAPACITY) arrays (sample time, sell min and buy max) that is used as
+        a ring buffer, so recording is O(1) and trends are computed over whole arrays at once.
+    """
+    def __init__(self, capacity: int = CAPACITY):
+        self.capacity = capacity
+        self.rows = {}  # type_id -> row index
+        self.times = np.zeros((0, capacity), dtype=np.float64)
+        self.sell = np.zeros((0, capacity), dtype=np.float64)
+        self.buy = np.zeros((0, capacity), dtype=np.float64)
+        self.heads = np.zeros(0, dtype=np.int64)   # Index of the next write in each row.
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _row(self, type_id: int) -> int:
+        """
+        Returns the row for a type, adding one (and growing the arrays by doubling) if it is new.
+        :param type_id:
+        :return:
+        """
+        row = self.rows.get(type_id)
+        if row is not None:
+            return row
+
+        row = len(self.rows)
+        if row == self.times.shape[0]:
+            grow = max(8, row)
+            self.times = np.vstack((self.times, np.zeros((grow, self.capacity))))
+            self.sell = np.vstack((self.sell, np.zeros((grow, self.capacity))))
+            self.buy = np.vstack((self.buy, np.zeros((grow, self.capacity))))
+            self.heads = np.concatenate((self.heads, np.zeros(grow, dtype=np.int64)))
+        self.rows[type_id] = row
+        return row
+
+    def record(self, aggregates: dict, now: float = None):
+        """
+        Records one sample for each type.
+        :param aggregates: A dict mapping type_id (int or str) to its fuzzwork aggregate data.
+        :param now:
+        :return:
+        """
+        now = now or time.time()
+        for type_id, data in aggregates.items():
+            row = self._row(int(type_id))
+            head = self.heads[row]
+            self.times[row, head] = now
+            self.sell[row, head] = float(data['sell']['min'])
+            self.buy[row, head] = float(data['buy']['max'])
+            self.heads[row] = (head + 1) % self.capacity
+
+        metrics.incr('market.history.samples', len(aggregates))
+        metrics.gauge('market.history.types', len(self.rows))
+
+    def series(self, type_id: int, since: float = 0) -> Optional[tuple]:
+        """
+        Returns a type's samples in time order.
+        :param type_id:
+        :param since: Only samples taken at or after this timestamp are returned.
+        :return: (times, sell, buy) arrays, or None if the type has not been recorded.
+        """
+        row = self.rows.get(type_id)
+        if row is None:
+            return None
+
+        order = np.roll(np.arange(self.capacity), -self.heads[row])
+        times = self.times[row, order]
+        mask = (times > 0) & (times >= since)
+        return times[mask], self.sell[row, order][mask], self.buy[row, order][mask]
+
+    def trend(self, type_id: int, window: float, now: float = None) -> Optional[dict]:
+        """
+        Computes sell price statistics over a window.
+        :param type_id:
+        :param window: Seconds.
+        :param now:
+        :return: A dict with the moving average, the volatility (standard deviation of the per-sample returns) and
+            the % change over the window, in percent, or None if there are fewer than two samples with sell orders.
+        """
+        now = now or time.time()
+        series = self.series(type_id, now - window)
+        if series is None:
+            return None
+        sell = series[1][series[1] > 0]   # A sell min of 0 means there were no sell orders.
+        if len(sell) < 2:
+            return None
+
+        returns = np.diff(sell) / sell[:-1]
+        return {
+            'average': float(sell.mean()),
+            'volatility': float(returns.std() * 100),
+            'change': float((sell[-1] - sell[0]) / sell[0] * 100),
+            'samples': len(sell),
+        }
+
+    def save(self, path: str = HISTORY_PATH):
+        """
+        Writes the history to disk, through a temporary file so an interrupted write never replaces a good copy.
+        :param path:
+        :return:
+        """
+        count = len(self.rows)
+        tmp = f'{path}.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(
+                f,
+                type_ids=np.fromiter(self.rows.keys(), dtype=np.int64, count=count),
+                times=self.times[:count],
+                sell=self.sell[:count],
+                buy=self.buy[:count],
+                heads=self.heads[:count],
+            )
+        os.replace(tmp, path)
+
+    def load(self, path: str = HISTORY_PATH):
+        """
+        Replaces the history with the copy on disk, if there is a readable one with the same capacity.
+        :param path:
+        :return:
+        """
+        if not os.path.exists(path):
+            return
+        try:
+            with np.load(path) as data:
+                if data['times'].shape[1] != self.capacity:
+                    logger.warning(f'Price history at {path} has a different capacity and was not loaded.')
+                    return
+                self.rows = {int(x): i for i, x in enumerate(data['type_ids'])}
+                self.times = data['times'].copy()
+                self.sell = data['sell'].copy()
+                self.buy = data['buy'].copy()
+                self.heads = data['heads'].copy()
+        except Exception as e:
+            logger.warning(f'Price history at {path} could not be loaded. Error: {e}')
+            return
+
+        metrics.gauge('market.history.types', len(self.rows))
+
+
+price_history = PriceHistory()
+
+
+def add_trend_field(embed: discord.Embed, type_id: int) -> discord.Embed:
+    """
+    Adds a Trends field to a price check embed, if enough history has been recorded for the type.
+    :param embed:
+    :param type_id:
+    :return:
+    """
+    lines = []
+    for label, window in TREND_WINDOWS:
+        trend = price_history.trend(type_id, window)
+        if trend is not None:
+            lines.append(
+                f"{label}: {trend['change']:+.2f}% (avg {trend['average']:,.2f} ISK, "
+                f"volatility {trend['volatility']:.2f}%)"
+            )
+
+    if len(lines) != 0:
+        embed.add_field(name='Sell Trends', value='\n'.join(lines), inline=False)
+    return embed
@@ -0,0 +1,18 @@
+from tortoise.models import Model
+from tortoise import fields
+
+
+class PriceAlert(Model):
+    id = fields.IntField(pk=True)
+    guild_id = fields.BigIntField(null=False, index=True)
+    channel_id = fields.BigIntField(null=False)
+    type_id = fields.BigIntField(null=False)
+    type_name = fields.CharField(max_length=255, null=False)
+    side = fields.CharField(max_length=4, null=False)   # sell or buy
+    above = fields.BooleanField(null=False)     # Alert when the price goes above the threshold, otherwise below.
+    threshold = fields.FloatField(null=False)
+    triggered = fields.BooleanField(default=False)
+    created = fields.DatetimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.type_name} {self.side} {">" if self.above else "<"} {self.threshold:,.2f} (id: {self.id})'
@@ -1,14 +1,14 @@
+import asyncio
 import traceback
 from datetime import datetime
 
 import discord
-import aiohttp
 from discord.ext import commands, tasks
 from discord.ext.commands import Cog
-from esipy import EsiClient
 from webpreview import OpenGraph as og
 
 from utils import checks, get_json
+from utils.dispatch import PRIORITY_NEWS
 from utils.loggers import get_logger
 from .models import *
 
@@ -19,12 +19,6 @@ class NewsWatch(Cog, command_attrs=dict(hidden=True)):
     def __init__(self, bot):
         self.bot = bot
 
-        self.esi = EsiClient(
-            retry_requests=True,
-            headers={'User-Agent': f'application: MercuryBot contact: {self.bot.config["bot"]["user_agent"]}'},
-            raw_body_only=False,
-        )
-
         self.channels = None
         self.news_task.start()
 
@@ -58,7 +52,7 @@ class NewsWatch(Cog, command_attrs=dict(hidden=True)):
             strict=True
         )
 
-        id_resp = self.esi.request(id_op)
+        id_resp = await self.bot.esi.request(id_op)
 
         if 'character' not in id_resp.data:
             return -1
@@ -196,10 +190,11 @@ class NewsWatch(Cog, command_attrs=dict(hidden=True)):
         articles_to_save = []
 
         try:
-            async with aiohttp.ClientSession() as session:
-                devs = await get_json(session, dev_blog_url)
-                news = await get_json(session, news_url)
-                patches = await get_json(session, patch_url)
+            devs, news, patches = await asyncio.gather(
+                get_json(self.bot.session, dev_blog_url),
+                get_json(self.bot.session, news_url),
+                get_json(self.bot.session, patch_url)
+            )
 
             resps = (devs['resp'], news['resp'], patches['resp'])
 
@@ -260,9 +255,8 @@ class NewsWatch(Cog, command_attrs=dict(hidden=True)):
         embed.set_image(url=image)
         embed.set_footer(text=f'{article["author"]}', icon_url=author_img)
 
-        for channel in self.channels[category]:
-            channel = self.bot.get_channel(channel.channel_id)
-            await channel.send(embed=embed)
+        sends = [(x.channel_id, {'embed': embed}) for x in self.channels[category]]
+        await self.bot.dispatcher.fanout('news', PRIORITY_NEWS, sends)
 
 
 def setup(bot):
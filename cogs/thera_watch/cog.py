@@ -1,15 +1,17 @@
 import traceback
 
 import discord
-import aiohttp
 from discord.ext import commands, tasks
 from discord.ext.commands import Cog
-from esipy import EsiClient
 from utils import get_json as get
 
 from .models import *
 from utils import checks
+from utils.db import fetch_subscriptions
+from utils.dispatch import PRIORITY_THERA
+from utils.esi import PRIORITY_NORMAL
 from utils.loggers import get_logger
+from utils.metrics import metrics
 
 logger = get_logger(__name__)
 
@@ -30,12 +32,6 @@ class TheraWatch(Cog, command_attrs=dict(hidden=True)):
         self.last_thera = None
         self.channels = None
 
-        self.esi = EsiClient(
-            retry_requests=True,
-            headers={'User-Agent': f'application: MercuryBot contact: {self.bot.config["bot"]["user_agent"]}'},
-            raw_body_only=False
-        )
-
         self.thera.start()
 
     def cog_unload(self):
@@ -43,17 +39,18 @@ class TheraWatch(Cog, command_attrs=dict(hidden=True)):
 
     async def load_channels(self):
         """
-        Updates self.channels.
+        Updates self.channels, which maps location type -> location ID -> list of discord channel IDs.
+            All subscriptions are read in one query, so this does not grow with the number of watched locations.
         :return:
         """
-        systems = await TheraEveSystem.all()
-        constellations = await TheraEveConstellation.all()
-        regions = await TheraEveRegion.all()
-        self.channels = {
-            'systems': {x.system_id: await x.channels.all() for x in systems},
-            'constellations': {x.constellation_id: await x.channels.all() for x in constellations},
-            'regions': {x.region_id: await x.channels.all() for x in regions}
-        }
+        with metrics.timer('thera_watch.load_channels'):
+            rows = await fetch_subscriptions(
+                TheraChannel, {'systems': 'systems', 'constellations': 'constellations', 'regions': 'regions'}
+            )
+            channels = {'systems': {}, 'constellations': {}, 'regions': {}}
+            for location_type, location_id, channel_id in rows:
+                channels[location_type].setdefault(location_id, []).append(channel_id)
+            self.channels = channels
 
     async def update_channels(self, location_type: str, location):
         """
@@ -63,7 +60,11 @@ class TheraWatch(Cog, command_attrs=dict(hidden=True)):
         :return:
         """
         plural = f'{location_type}s'
-        self.channels[plural][location.pk] = await location.channels.all()
+        channel_ids = [x.channel_id for x in await location.channels.all()]
+        if len(channel_ids) == 0:
+            self.channels[plural].pop(location.pk, None)
+        else:
+            self.channels[plural][location.pk] = channel_ids
 
     async def location_from_id(self, location_type: str, location_id: int):
         """
@@ -85,7 +86,7 @@ class TheraWatch(Cog, command_attrs=dict(hidden=True)):
 
         if location_id is not 0:
             post_op = self.bot.esi_app.op['post_universe_names'](ids=[location_id])
-            response = self.esi.request(post_op)
+            response = await self.bot.esi.request(post_op)
             if location_type not in response.data[0]['category']:
                 logger.debug(response.data)
                 return -1
@@ -118,7 +119,7 @@ class TheraWatch(Cog, command_attrs=dict(hidden=True)):
         if location_name.lower() != "all regions":
             # Get the system ID from ESI.
             post_op = self.bot.esi_app.op['post_universe_ids'](names=[location_name])
-            response = self.esi.request(post_op)
+            response = await self.bot.esi.request(post_op)
             if plural not in response.data:
                 return -1
             model_kwargs = {
@@ -337,8 +338,7 @@ class TheraWatch(Cog, command_attrs=dict(hidden=True)):
     async def thera(self):
         url = 'https://www.eve-scout.com/api/wormholes'
         try:
-            async with aiohttp.ClientSession() as session:
-                resp = await get(session, url)
+            resp = await get(self.bot.session, url)
             hole = list(resp['resp'])[0]
             hole_id = hole['id']
             source = hole['sourceSolarSystem']
@@ -393,12 +393,18 @@ class TheraWatch(Cog, command_attrs=dict(hidden=True)):
         system = d_system['name']
         region = d_system['region']['name']
         c_id = d_system['constellationID']
-        try:
-            c_name = self.esi.request(
-                self.bot.esi_app.op['get_universe_constellations_constellation_id'](constellation_id=c_id)
-            ).data['name']
-        except:
-            print("oops")
+        constellation = self.bot.universe.constellation(c_id)
+        if constellation is not None:
+            c_name = constellation.name
+        else:
+            try:
+                c_name = (await self.bot.esi.request(
+                    self.bot.esi_app.op['get_universe_constellations_constellation_id'](constellation_id=c_id),
+                    priority=PRIORITY_NORMAL
+                )).data['name']
+            except Exception:
+                logger.exception(f"Error getting the name of constellation {c_id}.")
+                c_name = str(c_id)
         in_sig = hole['wormholeDestinationSignatureId']
         out_sig = hole['signatureId']
 
@@ -422,7 +428,7 @@ class TheraWatch(Cog, command_attrs=dict(hidden=True)):
         if d_system['id'] in self.channels['systems']:
             send_channels['system'] += self.channels['systems'][d_system['id']]
         elif d_system['constellationID'] in self.channels['constellations']:
-            send_channels['constellation'] += self.channels['constellation'][d_system['constellationId']]
+            send_channels['constellation'] += self.channels['constellations'][d_system['constellationID']]
         elif d_system['regionId'] in self.channels['regions'] or 0 in self.channels['regions']:
             if 0 in self.channels['regions']:   # Send to anyone that specified all regions
                 send_channels['region'] += self.channels['regions'][0]
@@ -434,11 +440,8 @@ class TheraWatch(Cog, command_attrs=dict(hidden=True)):
     async def send_thera(self, embed: discord.Embed, channels: dict):
         mentions = {'system': "@everyone", 'constellation': "@here", 'region': ""}
 
-        for k, v in channels.items():
-            for c in v:
-                # Get channel
-                channel = self.bot.get_channel(c.channel_id)
-                await channel.send(content=mentions[k], embed=embed)
+        sends = [(c, {'content': mentions[k], 'embed': embed}) for k, v in channels.items() for c in v]
+        await self.bot.dispatcher.fanout('thera', PRIORITY_THERA, sends)
 
 
 def setup(bot):
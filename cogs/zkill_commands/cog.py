@@ -4,10 +4,10 @@ from typing import Optional
 import discord
 from discord.ext import commands
 from discord.ext.commands import Cog
-from esipy import EsiClient
 from esipy.exceptions import APIException
 
 from utils import get_json
+from utils.cache import name_cache
 from utils.loggers import get_logger
 from .helpers import *
 
@@ -18,13 +18,6 @@ class ZkillCommands(Cog):
     def __init__(self, bot):
         self.bot = bot
 
-        self.esi = EsiClient(
-            retry_requests=True,
-            headers={
-                'User-Agent': f'applucation: MercuryBot contact: {self.bot.config["bot"]["user_agent"]}'
-            }
-        )
-
     async def _get_character_id_from_esi(self, name: str) -> int:
         """
         Returns the character ID from ESI.
@@ -39,7 +32,7 @@ class ZkillCommands(Cog):
             strict=True
         )
 
-        id_response = self.esi.request(id_op)
+        id_response = await self.bot.esi.request(id_op)
 
         if "character" not in id_response.data:
             return -1
@@ -53,18 +46,14 @@ class ZkillCommands(Cog):
         :param character_id:
         :return:
         """
-        name_op = self.bot.esi_app.op["get_characters_character_id"](
-            character_id=character_id
-        )
-
         try:
-            name_response = self.esi.request(name_op)
+            names = await name_cache.resolve(self.bot.esi_app, self.bot.esi, [character_id])
         except APIException:
             logger.error(f'Error getting name for character with ID {character_id} from ESI.')
             logger.error(traceback.print_exc())
             return None
 
-        return name_response.data['name']
+        return names.get(int(character_id))
 
     @commands.command(aliases=['t'])
     async def threat(self, ctx, *, name: str):
@@ -82,7 +71,7 @@ class ZkillCommands(Cog):
             return await ctx.send("Something went wrong, please try again later.")
 
         # Get Zkill Stats
-        stats = await get_char_stats_from_zkill(char_id)
+        stats = await get_char_stats_from_zkill(self.bot.session, char_id)
         if stats is None:
             return await ctx.send("The provided character has no killboard stats.")
 
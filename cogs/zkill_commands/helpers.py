@@ -1,4 +1,3 @@
-import aiohttp
 from typing import Optional
 from datetime import datetime
 
@@ -10,16 +9,16 @@ from utils.loggers import get_logger
 logger = get_logger(__name__)
 
 
-async def get_char_stats_from_zkill(char_id: int) -> Optional[dict]:
+async def get_char_stats_from_zkill(session, char_id: int) -> Optional[dict]:
     """
     Returns a character's zkill stats, or None if the character does not have any.
+    :param session: The bot's shared HTTP session.
     :param char_id:
     :return:
     """
     zkill_stats_url = f"https://zkillboard.com/api/stats/characterID/{char_id}/"
 
-    async with aiohttp.ClientSession() as session:
-        zkill_stats = await get_json(session, zkill_stats_url)
+    zkill_stats = await get_json(session, zkill_stats_url)
 
     zkill_data = zkill_stats['resp']
 
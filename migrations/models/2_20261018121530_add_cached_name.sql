@@ -0,0 +1,10 @@
+-- upgrade --
+CREATE TABLE IF NOT EXISTS "cachedname" (
+    "entity_id" BIGSERIAL NOT NULL PRIMARY KEY,
+    "name" VARCHAR(255) NOT NULL,
+    "category" VARCHAR(32) NOT NULL,
+    "expires" TIMESTAMPTZ,
+    "updated" TIMESTAMPTZ NOT NULL
+);
+-- downgrade --
+DROP TABLE IF EXISTS "cachedname";
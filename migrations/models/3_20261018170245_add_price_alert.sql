@@ -0,0 +1,16 @@
+-- upgrade --
+CREATE TABLE IF NOT EXISTS "pricealert" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "guild_id" BIGINT NOT NULL,
+    "channel_id" BIGINT NOT NULL,
+    "type_id" BIGINT NOT NULL,
+    "type_name" VARCHAR(255) NOT NULL,
+    "side" VARCHAR(4) NOT NULL,
+    "above" BOOL NOT NULL,
+    "threshold" DOUBLE PRECISION NOT NULL,
+    "triggered" BOOL NOT NULL  DEFAULT False,
+    "created" TIMESTAMPTZ NOT NULL  DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS "idx_pricealert_guild_i_0c4d1e" ON "pricealert" ("guild_id");
+-- downgrade --
+DROP TABLE IF EXISTS "pricealert";
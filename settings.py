@@ -40,4 +40,4 @@ if conf:
     log_level = logging.getLevelName(config['logging']['level'])
 else:
     TORTOISE_ORM = None
-    log_level = "INFO"
+    log_level = logging.INFO
@@ -0,0 +1,60 @@
+import asyncio
+import os
+
+import pytest
+from tortoise import Tortoise
+from tortoise.backends.sqlite.client import SqliteClient
+
+# Every cog's models, found the same way settings.py finds them for the bot.
+MODEL_MODULES = [
+    f"cogs.{name}.models"
+    for name in sorted(os.listdir('cogs/'))
+    if os.path.isdir(os.path.join('cogs/', name)) and '__' not in name and os.path.exists(f"cogs/{name}/models.py")
+]
+QUERY_METHODS = ('execute_query', 'execute_query_dict', 'execute_insert', 'execute_many', 'execute_script')
+
+
+class QueryCounter:
+    """
+    Counts the queries sent to the test database.
+    """
+    def __init__(self):
+        self.count = 0
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def db(loop):
+    """
+    An in-memory sqlite database with every model's table.
+    """
+    loop.run_until_complete(Tortoise.init(db_url='sqlite://:memory:', modules={'models': MODEL_MODULES}))
+    loop.run_until_complete(Tortoise.generate_schemas())
+    yield
+    loop.run_until_complete(Tortoise.close_connections())
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    """
+    A QueryCounter that counts every query sent to the test database from here on.
+    """
+    counter = QueryCounter()
+    for name in QUERY_METHODS:
+        original = getattr(SqliteClient, name)
+
+        def counted(self, *args, _original=original, **kwargs):
+            counter.count += 1
+            return _original(self, *args, **kwargs)
+
+        monkeypatch.setattr(SqliteClient, name, counted)
+
+    return counter
@@ -0,0 +1,60 @@
+import pytest
+
+from cogs.kill_watch.cog import KillWatch
+from cogs.kill_watch.models import KillChannel, KillEveCorporation, KillEveSystem
+from cogs.thera_watch.cog import TheraWatch
+from cogs.thera_watch.models import TheraChannel, TheraEveRegion, TheraEveSystem
+
+
+async def seed_kill_watch(count: int):
+    """
+    Adds count kill channels, each following one system and one corporation.
+    """
+    for i in range(count):
+        channel = await KillChannel.create(guild_id=i, channel_id=1000 + i)
+        await channel.systems.add(await KillEveSystem.create(system_id=30000000 + i, name=f'System {i}'))
+        await channel.corporations.add(await KillEveCorporation.create(corporation_id=98000000 + i, name=f'Corp {i}'))
+
+
+async def seed_thera_watch(count: int):
+    """
+    Adds count thera channels, each following one system and one region.
+    """
+    for i in range(count):
+        channel = await TheraChannel.create(guild_id=i, channel_id=1000 + i)
+        await channel.systems.add(await TheraEveSystem.create(system_id=30000000 + i, name=f'System {i}'))
+        await channel.regions.add(await TheraEveRegion.create(region_id=10000000 + i, name=f'Region {i}'))
+
+
+# The query count must not grow with the number of channels.
+SIZES = [0, 1, 50]
+
+
+@pytest.mark.parametrize('count', SIZES)
+def test_kill_watch_load_channels_is_one_query(db, loop, queries, count):
+    cog = KillWatch.__new__(KillWatch)
+    loop.run_until_complete(seed_kill_watch(count))
+
+    before = queries.count
+    loop.run_until_complete(cog.load_channels())
+    assert queries.count - before == 1
+
+    assert len(cog.routing.routes['system']) == count
+    assert len(cog.routing.routes['corporation']) == count
+    if count != 0:
+        assert cog.routing.match({'system': [30000000]}) == {1000: {'system'}}
+
+
+@pytest.mark.parametrize('count', SIZES)
+def test_thera_watch_load_channels_is_one_query(db, loop, queries, count):
+    cog = TheraWatch.__new__(TheraWatch)
+    loop.run_until_complete(seed_thera_watch(count))
+
+    before = queries.count
+    loop.run_until_complete(cog.load_channels())
+    assert queries.count - before == 1
+
+    assert len(cog.channels['systems']) == count
+    assert len(cog.channels['regions']) == count
+    if count != 0:
+        assert cog.channels['regions'][10000000] == [1000]
@@ -0,0 +1,125 @@
+import pytest
+
+from utils import esi
+from utils.esi import ErrorLimiter, EsiUnavailable, PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL, ResponseCache
+from utils.metrics import metrics
+
+EXPIRES = {'Expires': 'Sun, 18 Oct 2026 12:00:00 GMT'}
+
+
+class FakeClock:
+    """
+    Stands in for the time and asyncio modules in utils.esi, so sleeping advances the clock instantly.
+    """
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+    async def sleep(self, delay: float):
+        self.slept.append(delay)
+        self.now += delay
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(esi, 'time', clock)
+    monkeypatch.setattr(esi, 'asyncio', clock)
+    return clock
+
+
+def error_limit(remain: int, reset: int) -> dict:
+    return {'X-ESI-Error-Limit-Remain': str(remain), 'X-ESI-Error-Limit-Reset': str(reset)}
+
+
+def test_refresh_restores_an_evicted_entry():
+    cache = ResponseCache(max_bytes=10)
+    cache.set('a', 200, {'ETag': '"a"'}, b'aaaaaa')
+    entry = cache.get('a')
+
+    # Evicted by another response while the conditional request for 'a' was in flight.
+    cache.set('b', 200, {'ETag': '"b"'}, b'bbbbbb')
+    assert cache.get('a') is None
+
+    status, headers, body, _, etag = cache.refresh('a', entry, EXPIRES)
+    assert (status, body, etag) == (200, b'aaaaaa', '"a"')
+    assert headers['Expires'] == EXPIRES['Expires']
+    assert cache.get('a') is not None
+    assert cache.get('b') is None
+    assert cache.size == 6
+
+
+def test_limiter_sheds_low_priority(loop, clock):
+    limiter = ErrorLimiter(shed_at=50, trip_at=20)
+    loop.run_until_complete(limiter.acquire(PRIORITY_LOW))
+
+    limiter.update(200, error_limit(51, 30))
+    loop.run_until_complete(limiter.acquire(PRIORITY_LOW))
+
+    shed = metrics.counters.get('esi.limiter.shed.low', 0)
+    limiter.update(400, error_limit(50, 30))
+    with pytest.raises(EsiUnavailable):
+        loop.run_until_complete(limiter.acquire(PRIORITY_LOW))
+    assert metrics.counters['esi.limiter.shed.low'] == shed + 1
+
+    # Feeds are never shed, and nothing waited.
+    loop.run_until_complete(limiter.acquire(PRIORITY_NORMAL))
+    loop.run_until_complete(limiter.acquire(PRIORITY_HIGH))
+    assert clock.slept == []
+
+    # The budget is back once the error window resets.
+    clock.now += 30
+    loop.run_until_complete(limiter.acquire(PRIORITY_LOW))
+
+
+def test_limiter_breaker_trips_and_resets(loop, clock):
+    limiter = ErrorLimiter(shed_at=50, trip_at=20)
+    trips = metrics.counters.get('esi.limiter.trips', 0)
+
+    limiter.update(400, error_limit(20, 10))
+    assert metrics.counters['esi.limiter.trips'] == trips + 1
+    assert metrics.gauges['esi.limiter.open'] == 1
+    with pytest.raises(EsiUnavailable):
+        loop.run_until_complete(limiter.acquire(PRIORITY_LOW))
+
+    # Higher priorities wait out the window instead of failing.
+    loop.run_until_complete(limiter.acquire(PRIORITY_HIGH))
+    assert clock.slept == [10]
+
+    # Half open: the window has reset, so requests are let through to see what ESI reports next.
+    loop.run_until_complete(limiter.acquire(PRIORITY_LOW))
+
+    # A healthy response closes the breaker...
+    limiter.update(200, error_limit(100, 60))
+    assert metrics.gauges['esi.limiter.open'] == 0
+    loop.run_until_complete(limiter.acquire(PRIORITY_LOW))
+
+    # ...while more errors in the new window open it again.
+    limiter.update(400, error_limit(15, 45))
+    assert metrics.counters['esi.limiter.trips'] == trips + 2
+    with pytest.raises(EsiUnavailable):
+        loop.run_until_complete(limiter.acquire(PRIORITY_LOW))
+
+
+def test_limiter_trips_on_420(loop, clock):
+    limiter = ErrorLimiter()
+    limiter.update(420, {})
+
+    # With no error limit headers, the breaker stays open for at least a second.
+    with pytest.raises(EsiUnavailable):
+        loop.run_until_complete(limiter.acquire(PRIORITY_LOW))
+    loop.run_until_complete(limiter.acquire(PRIORITY_NORMAL))
+    assert clock.slept == [1]
+
+
+def test_limiter_paces_requests(loop, clock):
+    limiter = ErrorLimiter(rate=2)
+    for _ in range(3):
+        loop.run_until_complete(limiter.acquire(PRIORITY_HIGH))
+    assert clock.slept == [0.5]
@@ -0,0 +1,113 @@
+import asyncio
+
+import discord
+
+from cogs.kill_watch import cog as kill_watch
+from cogs.kill_watch.cog import KillWatch
+from cogs.kill_watch.helpers import RecentIds
+from cogs.kill_watch.routing import RoutingIndex
+
+KILL_CHANNEL = 1
+LOSS_CHANNEL = 2
+
+
+class FakeEsi:
+    def with_priority(self, priority: int):
+        return self
+
+
+class FakeDispatcher:
+    def __init__(self):
+        self.sends = []
+
+    def fanout(self, label: str, priority: int, sends: list) -> asyncio.Future:
+        self.sends += sends
+        done = asyncio.get_event_loop().create_future()
+        done.set_result(None)
+        return done
+
+
+class FakeBot:
+    def __init__(self):
+        self.esi_app = None
+        self.esi = FakeEsi()
+        self.universe = None
+        self.dispatcher = FakeDispatcher()
+
+
+def build_cog(routing: RoutingIndex) -> KillWatch:
+    """
+    Builds a KillWatch cog without its DB loading, websocket or worker tasks.
+    """
+    cog = KillWatch.__new__(KillWatch)
+    cog.bot = FakeBot()
+    cog.routing = routing
+    cog.seen = RecentIds(100)
+    return cog
+
+
+def test_send_kill_makes_no_queries(db, loop, queries, monkeypatch):
+    async def extract_mail_data(esi_app, esi_client, kill_mail, universe=None):
+        return kill_mail
+
+    async def build_embed(data):
+        return discord.Embed(title=str(data['killmail_id']))
+
+    monkeypatch.setattr(kill_watch, 'extract_mail_data', extract_mail_data)
+    monkeypatch.setattr(kill_watch, 'build_embed', build_embed)
+
+    # One channel follows the system the kill happened in, the other the victim's corporation.
+    routing = RoutingIndex.build([
+        ('system', 30000142, KILL_CHANNEL),
+        ('corporation', 98000001, LOSS_CHANNEL),
+    ])
+    cog = build_cog(routing)
+    victim_ids = {'character': {90000001}, 'corporation': {98000001}, 'alliance': set(), 'ship': {587}}
+    kill_mail = {'killmail_id': 1, 'solar_system_id': 30000142, 'victim': {'corporation_id': 98000001}}
+    send_channels = routing.match({'system': [30000142], **victim_ids})
+
+    before = queries.count
+    loop.run_until_complete(cog.send_kill(kill_mail, send_channels, victim_ids))
+    assert queries.count == before
+
+    colours = {channel_id: kwargs['embed'].colour for channel_id, kwargs in cog.bot.dispatcher.sends}
+    assert colours == {KILL_CHANNEL: discord.Color.green(), LOSS_CHANNEL: discord.Color.red()}
+
+
+def test_set_route_replaces_and_removes_channels():
+    routing = RoutingIndex.build([('corporation', 98000001, KILL_CHANNEL), ('corporation', 98000001, LOSS_CHANNEL)])
+
+    # Replace: LOSS_CHANNEL is dropped and 3 is added.
+    routing.set_route('corporation', 98000001, {KILL_CHANNEL, 3})
+    assert routing.routes['corporation'][98000001] == frozenset({KILL_CHANNEL, 3})
+    assert routing.match({'corporation': [98000001]}) == {KILL_CHANNEL: {'corporation'}, 3: {'corporation'}}
+    assert routing.subscriptions[3] == {'corporation': {98000001}}
+    assert LOSS_CHANNEL not in routing.subscriptions
+
+    # Remove: an empty set unsubscribes every channel and drops the route.
+    routing.set_route('corporation', 98000001, set())
+    assert 98000001 not in routing.routes['corporation']
+    assert routing.match({'corporation': [98000001]}) == {}
+    assert routing.subscriptions == {}
+
+
+def test_set_route_clears_only_the_last_channel_entry():
+    routing = RoutingIndex.build([
+        ('corporation', 98000001, KILL_CHANNEL),
+        ('system', 30000142, KILL_CHANNEL),
+        ('system', 30002187, KILL_CHANNEL),
+    ])
+
+    # KILL_CHANNEL keeps its other system and its corporation.
+    routing.set_route('system', 30000142, [])
+    assert routing.subscriptions[KILL_CHANNEL] == {'corporation': {98000001}, 'system': {30002187}}
+
+    # Its last system goes, so the system entry goes with it, but the channel stays subscribed to the corporation.
+    routing.set_route('system', 30002187, [])
+    assert routing.subscriptions[KILL_CHANNEL] == {'corporation': {98000001}}
+    assert routing.is_loss(KILL_CHANNEL, {'corporation': [98000001]})
+
+    # Its last entity goes, so the channel is dropped entirely.
+    routing.set_route('corporation', 98000001, [])
+    assert routing.subscriptions == {}
+    assert not routing.is_loss(KILL_CHANNEL, {'corporation': [98000001]})
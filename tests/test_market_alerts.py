@@ -0,0 +1,96 @@
+from types import SimpleNamespace
+
+import pytest
+
+from cogs.market.alerts import HYSTERESIS, AlertBook, parse_alert
+
+PLEX = 44992
+INJECTOR = 40520
+
+
+def alert(alert_id: int, type_id: int, side: str, above: bool, threshold: float, triggered: bool = False):
+    return SimpleNamespace(
+        id=alert_id, type_id=type_id, side=side, above=above, threshold=threshold, triggered=triggered
+    )
+
+
+def market(plex_sell: float = 5e6, plex_buy: float = 4e6, injector_sell: float = 9e8, injector_buy: float = 8e8):
+    return {
+        str(PLEX): {'sell': {'min': plex_sell}, 'buy': {'max': plex_buy}},
+        str(INJECTOR): {'sell': {'min': injector_sell}, 'buy': {'max': injector_buy}},
+    }
+
+
+def ids(alerts: list) -> list:
+    return [x.id for x in alerts]
+
+
+@pytest.mark.parametrize('text,expected', [
+    ('PLEX sell < 4.5M', ('PLEX', 'sell', False, 4.5e6)),
+    ('Large Skill Injector buy > 900m', ('Large Skill Injector', 'buy', True, 9e8)),
+    ('Tritanium sell<4.25', ('Tritanium', 'sell', False, 4.25)),
+    ('PLEX buy > 1,250,000', ('PLEX', 'buy', True, 1.25e6)),
+])
+def test_parse_alert(text, expected):
+    assert parse_alert(text) == expected
+
+
+@pytest.mark.parametrize('text', ['PLEX', 'PLEX sell', 'PLEX sell = 5m', 'sell < 5m', 'PLEX cheap < 5m'])
+def test_parse_alert_rejects_invalid(text):
+    assert parse_alert(text) is None
+
+
+def test_types_are_deduplicated():
+    book = AlertBook([alert(1, PLEX, 'sell', False, 4.5e6), alert(2, PLEX, 'buy', True, 5e6),
+                      alert(3, INJECTOR, 'sell', False, 8e8)])
+    assert book.types() == [INJECTOR, PLEX]
+
+
+def test_fires_once_and_rearms_past_the_band():
+    below = alert(1, PLEX, 'sell', False, 4.5e6)
+    book = AlertBook([below])
+
+    assert ids(book.evaluate(market(plex_sell=4.6e6))[0]) == []
+    fired, rearmed = book.evaluate(market(plex_sell=4.4e6))
+    assert ids(fired) == [1] and rearmed == [] and below.triggered
+
+    # Still below, and then back above the threshold but inside the band: no repeat and no re-arm.
+    assert book.evaluate(market(plex_sell=4.3e6)) == ([], [])
+    inside = 4.5e6 * (1 + HYSTERESIS / 2)
+    assert book.evaluate(market(plex_sell=inside)) == ([], [])
+    assert book.evaluate(market(plex_sell=4.4e6)) == ([], [])
+
+    # Past the band it re-arms, and crossing again fires again.
+    outside = 4.5e6 * (1 + HYSTERESIS * 2)
+    fired, rearmed = book.evaluate(market(plex_sell=outside))
+    assert fired == [] and ids(rearmed) == [1] and not below.triggered
+    assert ids(book.evaluate(market(plex_sell=4.4e6))[0]) == [1]
+
+
+def test_above_alerts_use_the_buy_side():
+    above = alert(1, INJECTOR, 'buy', True, 9e8)
+    book = AlertBook([above])
+
+    # The sell price crossing does not matter for a buy alert.
+    assert book.evaluate(market(injector_sell=1e9, injector_buy=8.9e8)) == ([], [])
+    assert ids(book.evaluate(market(injector_buy=9.1e8))[0]) == [1]
+    assert book.evaluate(market(injector_buy=8.9e8)) == ([], [])
+    assert ids(book.evaluate(market(injector_buy=8.7e8))[1]) == [1]
+
+
+def test_missing_or_empty_prices_neither_fire_nor_rearm():
+    book = AlertBook([alert(1, PLEX, 'sell', False, 4.5e6), alert(2, INJECTOR, 'sell', False, 8e8, triggered=True)])
+
+    # No sell orders at all reads as a sell min of 0, which is not a price below the threshold.
+    assert book.evaluate(market(plex_sell=0, injector_sell=0)) == ([], [])
+    # A type missing from the poll is skipped too.
+    assert book.evaluate({str(PLEX): market()[str(PLEX)]}) == ([], [])
+
+
+def test_evaluates_many_alerts_in_one_pass():
+    alerts = [alert(i, PLEX, 'sell', False, threshold) for i, threshold in enumerate((4e6, 4.5e6, 5e6, 5.5e6))]
+    book = AlertBook(alerts)
+
+    fired, rearmed = book.evaluate(market(plex_sell=4.75e6))
+    assert ids(fired) == [2, 3] and rearmed == []
+    assert [x.triggered for x in alerts] == [False, False, True, True]
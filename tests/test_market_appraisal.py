@@ -0,0 +1,99 @@
+from types import SimpleNamespace
+
+import pytest
+
+from cogs.market import appraisal
+from cogs.market.appraisal import appraise, parse_line, parse_paste
+
+TYPES = {'tritanium': (34, 'Tritanium'), 'pyerite': (35, 'Pyerite'), 'rifter': (587, 'Rifter')}
+PRICES = {
+    '34': {'sell': {'min': '4.5'}, 'buy': {'max': '4.0'}},
+    '35': {'sell': {'min': '10.0'}, 'buy': {'max': '8.0'}},
+    '587': {'sell': {'min': '350000.0'}, 'buy': {'max': '300000.0'}},
+}
+
+
+@pytest.mark.parametrize('line,expected', [
+    # Inventory and cargo copies: name, quantity, group, ...
+    ('Tritanium\t10,000\tMineral\t\t\t100 m3\t45,000.00 ISK', ('Tritanium', 10000)),
+    # Unstackable items have no quantity.
+    ('Rifter\t\tFrigate\t\t\t27,289.5 m3', ('Rifter', 1)),
+    # Contract copies: name, quantity, type, category, details.
+    ('Pyerite\t2.500\tMineral\tMaterial\t', ('Pyerite', 2500)),
+    ('Tritanium 10000', ('Tritanium', 10000)),
+    ('Tritanium x10,000', ('Tritanium', 10000)),
+    ('Tritanium 10 000', ('Tritanium', 10000)),
+    ('10000 Tritanium', ('Tritanium', 10000)),
+    ('10,000x Pyerite', ('Pyerite', 10000)),
+    ('Small Shield Booster II', ('Small Shield Booster II', 1)),
+    ('Small Shield Booster II 3', ('Small Shield Booster II', 3)),
+    ('  Rifter  ', ('Rifter', 1)),
+])
+def test_parse_line(line, expected):
+    assert parse_line(line) == expected
+
+
+@pytest.mark.parametrize('line', ['', '   ', '\t'])
+def test_parse_line_skips_blank_lines(line):
+    assert parse_line(line) is None
+
+
+def test_parse_paste_merges_repeats_in_order():
+    lines = iter(['Tritanium 100', '', 'pyerite\t5', 'TRITANIUM x50', 'Rifter'])
+    assert parse_paste(lines) == {
+        'tritanium': ('Tritanium', 150),
+        'pyerite': ('pyerite', 5),
+        'rifter': ('Rifter', 1),
+    }
+
+
+class FakeEsi:
+    def __init__(self):
+        self.calls = []
+
+    async def request(self, op):
+        self.calls.append(op)
+        return SimpleNamespace(status=200, data={})
+
+
+def fake_bot() -> SimpleNamespace:
+    return SimpleNamespace(
+        types=SimpleNamespace(exact=lambda name: TYPES.get(name.strip().lower())),
+        esi=FakeEsi(),
+        esi_app=SimpleNamespace(op={'post_universe_ids': lambda names: names}),
+        session=None
+    )
+
+
+def test_appraise_totals(loop, monkeypatch):
+    async def get_market_data_many(session, type_ids, region_id=None, station_id=None):
+        return {str(x): PRICES[str(x)] for x in type_ids}
+
+    monkeypatch.setattr(appraisal, 'get_market_data_many', get_market_data_many)
+    bot = fake_bot()
+    paste = 'Tritanium\t10,000\tMineral\n\n1000 Pyerite\n!!! not an item ???\nRifter\t\tFrigate\nTritanium 5000'
+
+    result = loop.run_until_complete(appraise(bot, paste.splitlines()))
+
+    assert result['rows'] == [
+        ('Tritanium', 34, 15000, 4.5, 4.0),
+        ('Pyerite', 35, 1000, 10.0, 8.0),
+        ('Rifter', 587, 1, 350000.0, 300000.0),
+    ]
+    assert result['missing'] == ['!!! not an item ???']
+    assert result['sell'] == pytest.approx(15000 * 4.5 + 1000 * 10.0 + 350000.0)
+    assert result['buy'] == pytest.approx(15000 * 4.0 + 1000 * 8.0 + 300000.0)
+    # Ordered by sell value: the Rifter, then the Tritanium, then the Pyerite.
+    assert result['top'] == [2, 0, 1]
+    # Only the name that could not be resolved locally went to ESI, in one call.
+    assert bot.esi.calls == [['!!! not an item ???']]
+
+
+def test_appraise_empty_paste(loop, monkeypatch):
+    async def get_market_data_many(session, type_ids, region_id=None, station_id=None):
+        return {}
+
+    monkeypatch.setattr(appraisal, 'get_market_data_many', get_market_data_many)
+
+    result = loop.run_until_complete(appraise(fake_bot(), ['', '  ']))
+    assert result == {'rows': [], 'missing': [], 'sell': 0.0, 'buy': 0.0, 'top': []}
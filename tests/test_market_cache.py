@@ -0,0 +1,85 @@
+import pytest
+
+from cogs.market import helpers
+from cogs.market.helpers import MarketCache
+
+JITA = 'station=60003760'
+AMARR = 'station=60008494'
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 1_800_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(helpers, 'time', clock)
+    return clock
+
+
+def aggregate(sell: float) -> dict:
+    return {'sell': {'min': str(sell)}, 'buy': {'max': '0'}}
+
+
+def test_evicts_the_oldest_entry_past_its_size(clock):
+    cache = MarketCache(ttl=300, size=3)
+    for type_id in (34, 35, 36):
+        cache.set(type_id, JITA, aggregate(type_id))
+        clock.now += 1
+
+    # Refreshing 34 makes 35 the oldest entry.
+    cache.set(34, JITA, aggregate(34))
+    cache.set(37, JITA, aggregate(37))
+    assert len(cache.entries) == 3
+    assert cache.peek(35, JITA) is None
+    assert [cache.peek(x, JITA) for x in (34, 36, 37)] == [aggregate(34), aggregate(36), aggregate(37)]
+
+    # Keys are per location.
+    cache.set(34, AMARR, aggregate(1))
+    assert cache.peek(36, JITA) is None
+    assert cache.peek(34, JITA) == aggregate(34)
+    assert cache.peek(34, AMARR) == aggregate(1)
+
+
+def test_expired_entries_are_not_served(clock):
+    cache = MarketCache(ttl=300, size=10)
+    cache.set(34, JITA, aggregate(4.5))
+    clock.now += 200
+    cache.set(35, JITA, aggregate(10))
+
+    clock.now += 101
+    assert cache.get(34, JITA) is None
+    assert cache.get(35, JITA) == aggregate(10)
+    assert (34, JITA) not in cache.entries
+
+    clock.now += 200
+    cache.evict()
+    assert cache.entries == {}
+
+
+def test_counts_decay(clock, monkeypatch):
+    cache = MarketCache(ttl=300, size=10)
+    for type_id, count in ((34, 8), (35, 3), (36, 1)):
+        for _ in range(count):
+            cache.get(type_id, JITA)
+    assert cache.hot(2) == [(34, JITA), (35, JITA)]
+
+    cache.decay()
+    assert cache.requests == {(34, JITA): 4, (35, JITA): 1}
+
+    # A key that is requested again climbs back past the ones nobody asks for any more.
+    for _ in range(7):
+        cache.get(36, JITA)
+    cache.decay()
+    assert cache.hot(3) == [(36, JITA), (34, JITA)]
+    assert cache.requests == {(34, JITA): 2, (36, JITA): 3}
+
+    # Only the REQUEST_KEYS most requested keys are kept.
+    monkeypatch.setattr(helpers, 'REQUEST_KEYS', 1)
+    cache.decay()
+    assert cache.requests == {(36, JITA): 1}
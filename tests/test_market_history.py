@@ -0,0 +1,98 @@
+import pytest
+
+from cogs.market.history import PriceHistory
+
+PLEX = 44992
+NOW = 1_800_000_000.0
+HOUR = 3600
+DAY = 24 * HOUR
+
+
+def aggregate(sell: float, buy: float = 0) -> dict:
+    return {'sell': {'min': str(sell)}, 'buy': {'max': str(buy)}}
+
+
+def test_ring_buffer_wraps_around():
+    history = PriceHistory(capacity=4)
+    for i in range(1, 7):
+        history.record({PLEX: aggregate(i * 10, i)}, now=NOW + i)
+
+    times, sell, buy = history.series(PLEX)
+    assert list(times) == [NOW + 3, NOW + 4, NOW + 5, NOW + 6]
+    assert list(sell) == [30, 40, 50, 60]
+    assert list(buy) == [3, 4, 5, 6]
+
+
+def test_series_before_the_buffer_is_full():
+    history = PriceHistory(capacity=4)
+    history.record({str(PLEX): aggregate(10)}, now=NOW)
+
+    times, sell, _ = history.series(PLEX)
+    assert list(times) == [NOW] and list(sell) == [10]
+    assert history.series(34) is None
+
+
+def test_rows_grow_without_losing_samples():
+    history = PriceHistory(capacity=3)
+    for type_id in range(20):
+        history.record({type_id: aggregate(type_id + 1)}, now=NOW)
+    history.record({0: aggregate(100)}, now=NOW + 1)
+
+    assert len(history) == 20
+    assert list(history.series(0)[1]) == [1, 100]
+    assert list(history.series(19)[1]) == [20]
+
+
+def test_trend_windows():
+    history = PriceHistory()
+    for age, sell in ((8 * DAY, 50), (3 * DAY, 90), (12 * HOUR, 100), (HOUR, 110)):
+        history.record({PLEX: aggregate(sell)}, now=NOW - age)
+
+    day = history.trend(PLEX, DAY, now=NOW)
+    assert day['samples'] == 2
+    assert day['change'] == pytest.approx(10.0)
+    assert day['average'] == pytest.approx(105.0)
+    assert day['volatility'] == pytest.approx(0.0)
+
+    # The sample from 8 days ago is outside the 7 day window.
+    week = history.trend(PLEX, 7 * DAY, now=NOW)
+    assert week['samples'] == 3
+    assert week['change'] == pytest.approx(200 / 9)
+    assert week['average'] == pytest.approx(100.0)
+    assert week['volatility'] == pytest.approx((10 / 90 - 10 / 100) / 2 * 100)
+
+
+def test_trend_ignores_zero_prices():
+    history = PriceHistory()
+    for age, sell in ((3 * HOUR, 100), (2 * HOUR, 0), (HOUR, 120)):
+        history.record({PLEX: aggregate(sell)}, now=NOW - age)
+
+    trend = history.trend(PLEX, DAY, now=NOW)
+    assert trend['samples'] == 2
+    assert trend['change'] == pytest.approx(20.0)
+
+
+@pytest.mark.parametrize('sells', [(), (100,), (0, 0, 0), (0, 100)])
+def test_trend_needs_two_prices(sells):
+    history = PriceHistory()
+    for i, sell in enumerate(sells):
+        history.record({PLEX: aggregate(sell)}, now=NOW - HOUR * (i + 1))
+
+    assert history.trend(PLEX, DAY, now=NOW) is None
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / 'history.npz')
+    history = PriceHistory(capacity=4)
+    for i in range(1, 7):
+        history.record({PLEX: aggregate(i * 10)}, now=NOW + i)
+    history.save(path)
+
+    loaded = PriceHistory(capacity=4)
+    loaded.load(path)
+    assert list(loaded.series(PLEX)[1]) == [30, 40, 50, 60]
+
+    # A history saved with a different capacity is ignored rather than misread.
+    other = PriceHistory(capacity=5)
+    other.load(path)
+    assert len(other) == 0
@@ -0,0 +1,83 @@
+import pytest
+
+from utils.sde import TypeIndex
+
+TYPES = [
+    (34, 'Tritanium'),
+    (35, 'Pyerite'),
+    (44992, 'PLEX'),
+    (40520, 'Large Skill Injector'),
+    (45635, 'Small Skill Injector'),
+    (24690, 'Hurricane'),
+    (33155, 'Hurricane Fleet Issue'),
+    (17738, 'Machariel'),
+]
+
+
+@pytest.fixture
+def index():
+    return TypeIndex(TYPES)
+
+
+def test_exact_is_case_insensitive(index):
+    assert index.exact('tritanium') == (34, 'Tritanium')
+    assert index.exact('  PLEX ') == (44992, 'PLEX')
+    assert index.exact('Tritan') is None
+
+
+def test_exact_prefers_the_matching_case():
+    index = TypeIndex([(1, 'Plex'), (2, 'PLEX')])
+    assert index.exact('PLEX') == (2, 'PLEX')
+    assert index.exact('Plex') == (1, 'Plex')
+
+
+def test_name_by_id(index):
+    assert index.name(17738) == 'Machariel'
+    assert index.name('35') == 'Pyerite'
+    assert index.name(1) is None
+
+
+def test_prefix_is_alphabetical(index):
+    assert index.prefix('hurr') == [(24690, 'Hurricane'), (33155, 'Hurricane Fleet Issue')]
+    assert index.prefix('Hurr', limit=1) == [(24690, 'Hurricane')]
+    assert index.prefix('Zealot') == []
+
+
+def test_fuzzy_tolerates_typos(index):
+    matches = index.fuzzy('Tritanim')
+    assert matches[0][:2] == (34, 'Tritanium')
+    assert matches[0][2] >= 0.5
+
+    assert index.fuzzy('Machareil')[0][:2] == (17738, 'Machariel')
+    assert index.fuzzy('Zzzz') == []
+
+
+def test_fuzzy_orders_by_score(index):
+    matches = index.fuzzy('Hurricane')
+    assert [x[1] for x in matches] == ['Hurricane', 'Hurricane Fleet Issue']
+    assert matches[0][2] == 1.0
+    assert matches[0][2] > matches[1][2]
+
+
+def test_resolve(index):
+    assert index.resolve('hurricane') == (24690, 'Hurricane')  # Exact, despite the longer name sharing the prefix.
+    assert index.resolve('Large Skill') == (40520, 'Large Skill Injector')  # The only type with that prefix.
+    assert index.resolve('Tritanim') == (34, 'Tritanium')  # Fuzzy.
+
+
+def test_resolve_ambiguous_and_not_found(index):
+    # Two types share the prefix and neither is a close enough fuzzy match.
+    assert index.resolve('Hurr') is None
+    # No prefix match, and the two fuzzy candidates are both below resolve's threshold.
+    assert index.resolve('Injector') is None
+    assert index.resolve('Zzzz') is None
+
+
+def test_save_and_load(index, tmp_path):
+    path = str(tmp_path / 'types.json.gz')
+    index.save(path)
+
+    loaded = TypeIndex.load(path)
+    assert len(loaded) == len(TYPES)
+    assert loaded.exact('Pyerite') == (35, 'Pyerite')
+    assert loaded.resolve('Tritanim') == (34, 'Tritanium')
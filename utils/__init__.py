@@ -1,15 +1,61 @@
-import async_timeout
+import json
+import time
 from datetime import timedelta
+from urllib.parse import urlsplit
+
+import aiohttp
+import async_timeout
+
+from .metrics import metrics
+from .singleflight import SingleFlight
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:   # orjson is optional, fall back to the standard library.
+    loads = json.loads
 
+# Concurrent get_json calls for the same URL share one request.
+_flights = SingleFlight('http')
 
-async def get_json(session, url, user_agent=None):
-    headers = {'user-agent': f'application: MercuryBot contact: {user_agent}',
-               'content-type': 'application/json'}
-    with async_timeout.timeout(15):
+
+def create_session(user_agent: str = None) -> aiohttp.ClientSession:
+    """
+    Creates a pooled HTTP session for calls to external APIs (zKill, fuzzwork, EVE-Scout, ...).
+        Connections are kept alive and DNS lookups are cached, so repeat calls to a host skip the TCP and TLS setup.
+    :param user_agent: Contact information sent in the User-Agent header.
+    :return:
+    """
+    connector = aiohttp.TCPConnector(limit=100, limit_per_host=10, ttl_dns_cache=300, keepalive_timeout=60)
+    headers = {'user-agent': f'application: MercuryBot contact: {user_agent}'} if user_agent else None
+    return aiohttp.ClientSession(connector=connector, headers=headers)
+
+
+async def get_json(session, url, user_agent=None, timeout: float = 15):
+    """
+    GETs a JSON document. Concurrent calls for the same URL share a single request and its result.
+    :param session: An aiohttp session, normally bot.session.
+    :param url:
+    :param user_agent: Overrides the session's User-Agent.
+    :param timeout: Total timeout for the request, in seconds.
+    :return: A dict with the decoded response (resp) and status code (code). It is shared, so do not modify it.
+    """
+    return await _flights.do((url, user_agent), lambda: _get_json(session, url, user_agent, timeout))
+
+
+async def _get_json(session, url, user_agent, timeout: float):
+    headers = {'content-type': 'application/json'}
+    if user_agent is not None:
+        headers['user-agent'] = f'application: MercuryBot contact: {user_agent}'
+
+    start = time.perf_counter()
+    async with async_timeout.timeout(timeout):
         async with session.get(url, headers=headers) as response:
-            resp = await response.json()
+            body = await response.read()
             resp_code = response.status
-            return {'resp': resp, 'code': resp_code}
+    metrics.observe(f'http.{urlsplit(url).hostname}', time.perf_counter() - start)
+
+    return {'resp': loads(body), 'code': resp_code}
 
 
 def strftdelta(tdelta: timedelta) -> str:
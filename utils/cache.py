@@ -0,0 +1,224 @@
+import asyncio
+import time
+import traceback
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Optional
+
+from tortoise.query_utils import Q
+
+from .loggers import get_logger
+from .metrics import metrics
+
+logger = get_logger(__name__)
+
+DAY = 86400
+
+# Seconds a resolved name stays valid, by post_universe_names category. None never expires.
+NAME_TTLS = {
+    'inventory_type': None,
+    'solar_system': None,
+    'constellation': None,
+    'region': None,
+    'faction': None,
+    'station': None,
+    'corporation': DAY,
+    'alliance': DAY,
+    'character': 7 * DAY,
+}
+DEFAULT_NAME_TTL = DAY
+
+
+class LRUCache:
+    """
+    A size bounded mapping that forgets the least recently used key once it is full.
+    """
+    def __init__(self, size: int):
+        self.size = size
+        self.data = OrderedDict()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        if key not in self.data:
+            return default
+        self.data.move_to_end(key)
+        return self.data[key]
+
+    def set(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.data.pop(key, default)
+
+    def clear(self):
+        self.data.clear()
+
+
+class NameCache:
+    """
+    Two tier ID -> name cache shared by every cog.
+        Names are served from an in-memory LRU, backed by the cachedname table so they survive restarts.
+        New names are written to the table in batches by flush().
+    """
+    def __init__(self, size: int = 50000, flush_interval: float = 60.0):
+        """
+        :param size: Number of names kept in memory.
+        :param flush_interval: Seconds between writes of new names to the database.
+        """
+        self.memory = LRUCache(size)
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.task = None
+
+    def get(self, entity_id: int) -> Optional[str]:
+        """
+        Returns the cached name for an ID, or None if it is unknown or has expired.
+        :param entity_id:
+        :return:
+        """
+        entry = self.memory.get(entity_id)
+        if entry is None:
+            metrics.incr('names.misses')
+            return None
+        name, category, expires = entry
+        if expires is not None and expires < time.time():
+            self.memory.pop(entity_id)
+            metrics.incr('names.expired')
+            metrics.incr('names.misses')
+            return None
+
+        metrics.incr('names.hits')
+        return name
+
+    def put(self, entity_id: int, name: str, category: str):
+        """
+        Caches a name, scheduling it to be written to the database.
+        :param entity_id:
+        :param name:
+        :param category: The post_universe_names category, used to pick the TTL.
+        :return:
+        """
+        ttl = NAME_TTLS.get(category, DEFAULT_NAME_TTL)
+        expires = time.time() + ttl if ttl is not None else None
+        self.memory.set(entity_id, (name, category, expires))
+        self.pending[entity_id] = (name, category, expires)
+        metrics.gauge('names.size', len(self.memory))
+
+    async def resolve(self, esi_app, esi_client, ids) -> dict:
+        """
+        Returns a dict mapping each of the given IDs to its name.
+            Cached names are returned directly, everything else is resolved with post_universe_names.
+            IDs that could not be resolved are left out of the returned dict.
+        :param esi_app:
+        :param esi_client:
+        :param ids: An iterable of IDs. None values are ignored.
+        :return:
+        """
+        names = {}
+        missing = []
+        for x in {int(x) for x in ids if x is not None}:
+            name = self.get(x)
+            if name is None:
+                missing.append(x)
+            else:
+                names[x] = name
+
+        # ESI accepts at most 1000 IDs per call.
+        for chunk in [missing[i:i + 1000] for i in range(0, len(missing), 1000)]:
+            response = await esi_client.request(esi_app.op['post_universe_names'](ids=chunk))
+            if response.status == 200:
+                resolved = response.data
+            else:
+                # ESI rejects the whole call if a single ID is invalid, so fall back to resolving them one at a time.
+                logger.debug(f'Bulk name lookup failed with status {response.status}, resolving IDs individually.')
+                responses = await asyncio.gather(*[
+                    esi_client.request(esi_app.op['post_universe_names'](ids=[x])) for x in chunk
+                ])
+                resolved = [r.data[0] for r in responses if r.status == 200]
+
+            for item in resolved:
+                names[item['id']] = item['name']
+                self.put(item['id'], item['name'], item['category'])
+
+        return names
+
+    async def warm(self):
+        """
+        Loads the most recently resolved, unexpired names from the database into memory.
+        :return:
+        """
+        from cogs.core.models import CachedName
+
+        now = datetime.now(timezone.utc)
+        with metrics.timer('names.warm'):
+            rows = await CachedName.filter(Q(expires__isnull=True) | Q(expires__gt=now)) \
+                .order_by('-updated').limit(self.memory.size)
+            # Oldest first, so the most recent names end up at the hot end of the LRU.
+            for row in reversed(rows):
+                expires = row.expires.timestamp() if row.expires is not None else None
+                self.memory.set(row.entity_id, (row.name, row.category, expires))
+        metrics.gauge('names.size', len(self.memory))
+        logger.info(f'Name cache warmed with {len(rows)} names.')
+
+    async def flush(self):
+        """
+        Writes names resolved since the last flush to the database.
+        :return:
+        """
+        from cogs.core.models import CachedName
+
+        if len(self.pending) == 0:
+            return
+        pending, self.pending = self.pending, {}
+        now = datetime.now(timezone.utc)
+        rows = [
+            CachedName(
+                entity_id=entity_id,
+                name=name,
+                category=category,
+                expires=datetime.fromtimestamp(expires, timezone.utc) if expires is not None else None,
+                updated=now
+            )
+            for entity_id, (name, category, expires) in pending.items()
+        ]
+        await CachedName.filter(entity_id__in=list(pending)).delete()
+        await CachedName.bulk_create(rows)
+        metrics.incr('names.flushed', len(rows))
+
+    def start(self, loop):
+        """
+        Starts the periodic flush.
+        :param loop:
+        :return:
+        """
+        if self.task is None:
+            self.task = loop.create_task(self._flush_loop())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f'Error saving the name cache: {e}')
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f'Error saving the name cache: {e}')
+                logger.error(traceback.format_exc())
+
+
+name_cache = NameCache()
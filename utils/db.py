@@ -0,0 +1,25 @@
+from tortoise import Tortoise
+
+
+async def fetch_subscriptions(channel_model, relations: dict) -> list:
+    """
+    Loads every subscription of a channel model in a single query over its many to many through-tables.
+    :param channel_model: The channel model (e.g. KillChannel). It must have a channel_id field.
+    :param relations: A dict mapping entity type to the name of the M2M field on channel_model, e.g.
+                      {'system': 'systems'}.
+    :return: A list of (entity_type, entity_id, channel_id) tuples.
+    """
+    meta = channel_model._meta
+    selects = []
+    for entity_type, field_name in relations.items():
+        field = meta.fields_map[field_name]
+        selects.append(
+            f'SELECT \'{entity_type}\' AS "entity_type", t."{field.forward_key}" AS "entity_id", '
+            f'c."channel_id" AS "channel_id" '
+            f'FROM "{field.through}" t JOIN "{meta.db_table}" c ON c."{meta.db_pk_column}" = t."{field.backward_key}"'
+        )
+
+    connection = Tortoise.get_connection(meta.default_connection or 'default')
+    rows = await connection.execute_query_dict(' UNION ALL '.join(selects))
+
+    return [(x['entity_type'], x['entity_id'], x['channel_id']) for x in rows]
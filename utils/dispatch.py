@@ -0,0 +1,147 @@
+import asyncio
+import itertools
+import time
+import traceback
+
+from .loggers import get_logger
+from .metrics import metrics
+
+logger = get_logger(__name__)
+
+# Lower numbers are sent first.
+PRIORITY_THERA = 0
+PRIORITY_KILL = 1
+PRIORITY_NEWS = 2
+PRIORITY_ALERT = 3
+
+
+class _Batch:
+    """
+    Tracks delivery of one fanout so the time to the last delivery can be recorded.
+    """
+    def __init__(self, label: str, size: int):
+        self.label = label
+        self.remaining = size
+        self.started = time.perf_counter()
+        self.done = asyncio.get_event_loop().create_future()
+        if size == 0:
+            self.done.set_result(None)
+
+    def complete(self):
+        self.remaining -= 1
+        if self.remaining == 0:
+            metrics.observe(f'dispatch.{self.label}.last_delivery', time.perf_counter() - self.started)
+            if not self.done.done():    # It is cancelled if the dispatcher was closed.
+                self.done.set_result(None)
+
+
+class Dispatcher:
+    """
+    Shared outbound dispatcher for feed posts.
+        Messages are sent by a bounded pool of workers in priority order. Each channel has its own token bucket
+        (discord allows 5 messages per 5 seconds per channel), and a message for a channel that is out of tokens is
+        put back on the queue for later instead of holding up a worker.
+    """
+    def __init__(self, bot, concurrency: int = 10, rate: int = 5, per: float = 5.0):
+        """
+        :param bot:
+        :param concurrency: Number of messages that may be in flight at once.
+        :param rate: Messages allowed per channel in each period.
+        :param per: Length of the rate limit period, in seconds.
+        """
+        self.bot = bot
+        self.concurrency = concurrency
+        self.rate = rate
+        self.per = per
+
+        self.queue = None
+        self.buckets = {}
+        self.workers = []
+        self.batches = set()    # Futures of the batches still being delivered.
+        self._seq = itertools.count()
+
+    def start(self):
+        """
+        Starts the workers if they are not already running.
+        :return:
+        """
+        if len(self.workers) == 0:
+            self.queue = asyncio.PriorityQueue()
+            self.workers = [self.bot.loop.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+        # Anything still waiting on a batch would otherwise wait forever.
+        for done in list(self.batches):
+            done.cancel()
+        self.batches.clear()
+
+    async def drain(self):
+        """
+        Waits until every queued batch has been delivered.
+        :return:
+        """
+        while len(self.batches) != 0:
+            await asyncio.wait(list(self.batches))
+
+    def fanout(self, label: str, priority: int, sends: list) -> asyncio.Future:
+        """
+        Queues a batch of messages.
+        :param label: Metrics label for the batch (e.g. kills).
+        :param priority: One of the PRIORITY_* constants.
+        :param sends: A list of (channel_id, kwargs) tuples. kwargs are passed to channel.send, so embeds can be
+                      shared between destinations.
+        :return: A future that resolves once every message in the batch has been attempted. Callers do not have to
+                 wait on it; delivery times are recorded either way.
+        """
+        self.start()
+        batch = _Batch(label, len(sends))
+        if not batch.done.done():
+            self.batches.add(batch.done)
+            batch.done.add_done_callback(self.batches.discard)
+        for channel_id, kwargs in sends:
+            self.queue.put_nowait((priority, next(self._seq), channel_id, kwargs, batch))
+        metrics.gauge('dispatch.queue_depth', self.queue.qsize())
+
+        return batch.done
+
+    def _take_token(self, channel_id: int) -> float:
+        """
+        Takes a token from the channel's bucket.
+        :param channel_id:
+        :return: 0 if a token was taken, otherwise the number of seconds until one is available.
+        """
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(channel_id, (self.rate, now))
+        tokens = min(self.rate, tokens + (now - updated) * self.rate / self.per)
+        if tokens >= 1:
+            self.buckets[channel_id] = (tokens - 1, now)
+            return 0
+        self.buckets[channel_id] = (tokens, now)
+        return (1 - tokens) * self.per / self.rate
+
+    async def _worker(self):
+        while True:
+            item = await self.queue.get()
+            priority, seq, channel_id, kwargs, batch = item
+            metrics.gauge('dispatch.queue_depth', self.queue.qsize())
+
+            delay = self._take_token(channel_id)
+            if delay > 0:
+                metrics.incr(f'dispatch.{batch.label}.deferred')
+                self.bot.loop.call_later(delay, self.queue.put_nowait, item)
+                continue
+
+            try:
+                channel = self.bot.get_channel(channel_id)
+                if channel is not None:
+                    await channel.send(**kwargs)
+                    metrics.incr(f'dispatch.{batch.label}.sent')
+            except Exception as e:
+                metrics.incr(f'dispatch.{batch.label}.failed')
+                logger.error(f"Error sending {batch.label} message to channel {channel_id}: {e}")
+                logger.error(traceback.format_exc())
+            finally:
+                batch.complete()
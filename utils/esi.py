@@ -0,0 +1,438 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+from esipy.exceptions import APIException
+
+from .loggers import get_logger
+from .metrics import metrics
+from .singleflight import SingleFlight
+
+logger = get_logger(__name__)
+
+# Request priorities, lower is more important. Commands use the default of PRIORITY_LOW.
+PRIORITY_HIGH = 0   # Kill feed enrichment.
+PRIORITY_NORMAL = 1     # Other background feeds and snapshots.
+PRIORITY_LOW = 2    # Commands.
+
+PRIORITY_NAMES = {PRIORITY_HIGH: 'high', PRIORITY_NORMAL: 'normal', PRIORITY_LOW: 'low'}
+
+
+class EsiUnavailable(Exception):
+    """
+    Raised when a request is shed because ESI's error budget is nearly spent.
+    """
+    pass
+
+
+def get_header(headers: dict, name: str):
+    """
+    Case insensitive header lookup.
+    :param headers:
+    :param name:
+    :return: The header value, or None.
+    """
+    name = name.lower()
+    for k, v in headers.items():
+        if k.lower() == name:
+            # pyswagger responses hold each header as a list of values.
+            return v[0] if isinstance(v, (list, tuple)) else v
+    return None
+
+
+def expires_at(headers: dict) -> float:
+    """
+    Returns the Expires header of a response as a unix timestamp, or 0 if it is missing or invalid.
+    :param headers:
+    :return:
+    """
+    expires = get_header(headers, 'Expires')
+    if expires is None:
+        return 0
+    try:
+        return parsedate_to_datetime(expires).timestamp()
+    except (TypeError, ValueError):
+        return 0
+
+
+class ResponseCache:
+    """
+    Size bounded LRU of ESI GET responses, keyed by URL and query.
+        Entries are served until their Expires time, after which they are kept for revalidation with their ETag.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        """
+        :param key:
+        :return: (status, headers, body, expires, etag) or None.
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def set(self, key, status: int, headers: dict, body: bytes):
+        etag = get_header(headers, 'ETag')
+        expires = expires_at(headers)
+        if etag is None and expires <= time.time():
+            return  # Nothing to gain from caching this response.
+        if len(body) > self.max_bytes:
+            return
+
+        self._store(key, (status, headers, body, expires, etag))
+
+    def refresh(self, key, entry: tuple, headers: dict):
+        """
+        Extends a cached entry after ESI answered 304 Not Modified.
+            The entry is the one the conditional request was sent for, so a copy evicted while the request was in
+            flight is put back rather than lost.
+        :param key:
+        :param entry: The (status, headers, body, expires, etag) entry that was revalidated.
+        :param headers: The headers of the 304 response.
+        :return: The refreshed entry.
+        """
+        status, cached_headers, body, _, etag = entry
+        cached_headers = dict(cached_headers)
+        for name in ('Expires', 'Last-Modified', 'Date'):
+            value = get_header(headers, name)
+            if value is not None:
+                cached_headers[name] = value
+        entry = (status, cached_headers, body, expires_at(headers), get_header(headers, 'ETag') or etag)
+        self._store(key, entry)
+        return entry
+
+    def _store(self, key, entry: tuple):
+        """
+        Inserts an entry as the most recently used, evicting the least recently used ones to stay within max_bytes.
+        :param key:
+        :param entry:
+        :return:
+        """
+        self.pop(key)
+        self.entries[key] = entry
+        self.size += len(entry[2])
+        while self.size > self.max_bytes:
+            self.pop(next(iter(self.entries)))
+        metrics.gauge('esi.cache.bytes', self.size)
+        metrics.gauge('esi.cache.entries', len(self.entries))
+
+    def pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[2])
+
+
+class ErrorLimiter:
+    """
+    Process-wide guard for ESI's error limit (X-ESI-Error-Limit-Remain / X-ESI-Error-Limit-Reset) and request rate.
+        ESI bans clients that spend their error budget, so:
+            - Once the remaining budget drops to shed_at, low priority requests are refused with EsiUnavailable.
+            - Once it drops to trip_at (or ESI answers 420), the breaker opens: low priority requests are refused and
+              everything else waits for the error window to reset.
+        Requests are also paced by a token bucket of rate requests per second.
+    """
+    def __init__(self, rate: float = 100.0, shed_at: int = 50, trip_at: int = 20):
+        """
+        :param rate: Requests per second allowed across the process.
+        :param shed_at: Remaining errors at which low priority requests are shed.
+        :param trip_at: Remaining errors at which the breaker opens.
+        """
+        self.rate = rate
+        self.shed_at = shed_at
+        self.trip_at = trip_at
+
+        self.error_remain = 100
+        self.reset_at = 0.0
+        self.open_until = 0.0
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def _take_token(self) -> float:
+        """
+        :return: 0 if a token was taken, otherwise the number of seconds until one is available.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self, priority: int):
+        """
+        Waits until a request of the given priority may be sent.
+        :param priority: One of the PRIORITY_* constants.
+        :return:
+        """
+        label = PRIORITY_NAMES.get(priority, 'low')
+        while True:
+            now = time.monotonic()
+            if self.open_until > now:
+                if priority >= PRIORITY_LOW:
+                    metrics.incr(f'esi.limiter.shed.{label}')
+                    raise EsiUnavailable('ESI error limit reached, try again shortly.')
+                metrics.incr(f'esi.limiter.waits.{label}')
+                await asyncio.sleep(self.open_until - now)
+                continue
+
+            if priority >= PRIORITY_LOW and self.error_remain <= self.shed_at and self.reset_at > now:
+                metrics.incr(f'esi.limiter.shed.{label}')
+                raise EsiUnavailable('ESI error limit nearly reached, try again shortly.')
+
+            delay = self._take_token()
+            if delay == 0:
+                return
+            await asyncio.sleep(delay)
+
+    def update(self, status: int, headers: dict):
+        """
+        Records the error limit state reported on a response.
+        :param status:
+        :param headers:
+        :return:
+        """
+        now = time.monotonic()
+        remain = get_header(headers, 'X-ESI-Error-Limit-Remain')
+        reset = get_header(headers, 'X-ESI-Error-Limit-Reset')
+        try:
+            if remain is not None and reset is not None:
+                self.error_remain = int(remain)
+                self.reset_at = now + int(reset)
+        except ValueError:
+            pass
+
+        if status == 420 or (self.error_remain <= self.trip_at and self.reset_at > now):
+            if self.open_until <= now:
+                metrics.incr('esi.limiter.trips')
+                logger.warning(f'ESI error limit breaker opened ({self.error_remain} errors remaining).')
+            self.open_until = max(self.reset_at, now + 1)
+
+        metrics.gauge('esi.limiter.error_remain', self.error_remain)
+        metrics.gauge('esi.limiter.open', int(self.open_until > now))
+
+
+class PrioritizedClient:
+    """
+    A view of an AsyncEsiClient that sends every request at a fixed priority.
+        It can be passed anywhere an ESI client is expected.
+    """
+    def __init__(self, client: 'AsyncEsiClient', priority: int):
+        self.client = client
+        self.priority = priority
+
+    async def request(self, req_and_resp, raw_body_only: bool = False):
+        return await self.client.request(req_and_resp, raw_body_only=raw_body_only, priority=self.priority)
+
+    async def multi_request(self, reqs_and_resps: list, raw_body_only: bool = False) -> list:
+        return await self.client.multi_request(reqs_and_resps, raw_body_only=raw_body_only, priority=self.priority)
+
+
+class AsyncEsiClient:
+    """
+    An asyncio native ESI client.
+        Requests are built from the operations in the bot's swagger app (bot.esi_app.op[...]) exactly as they are for
+        esipy's EsiClient, but are sent over a pooled aiohttp session so that waiting on ESI never blocks the loop.
+    """
+    def __init__(self, user_agent: str, retry_requests: bool = True, raise_on_error: bool = False,
+                 timeout: float = 15, pool_size: int = 50, cache_size: int = 32 * 1024 * 1024):
+        """
+        :param user_agent: Contact information sent in the User-Agent header.
+        :param retry_requests: Retry requests that fail with a 5xx status.
+        :param raise_on_error: Raise an APIException for responses with a status of 400 or greater.
+        :param timeout: Total timeout for a single request, in seconds.
+        :param pool_size: Maximum number of pooled connections to ESI.
+        :param cache_size: Maximum size of cached response bodies, in bytes. 0 disables the cache.
+        """
+        self.headers = {'User-Agent': f'application: MercuryBot contact: {user_agent}'}
+        self.retry_requests = retry_requests
+        self.raise_on_error = raise_on_error
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.pool_size = pool_size
+        self.cache = ResponseCache(cache_size) if cache_size > 0 else None
+        self.limiter = ErrorLimiter()
+        self.flights = SingleFlight('esi')
+
+        self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """
+        The pooled session used for all ESI requests. Created on first use so that it is bound to the running loop.
+        :return:
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers=self.headers,
+                timeout=self.timeout
+            )
+        return self._session
+
+    async def close(self):
+        """
+        Closes the underlying session.
+        :return:
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def with_priority(self, priority: int) -> PrioritizedClient:
+        """
+        Returns a view of this client that sends requests at the given priority.
+        :param priority: One of the PRIORITY_* constants.
+        :return:
+        """
+        return PrioritizedClient(self, priority)
+
+    async def request(self, req_and_resp, raw_body_only: bool = False, priority: int = PRIORITY_LOW):
+        """
+        Sends the request for a swagger operation and returns the populated pyswagger response.
+            GET responses are cached until they expire and are then revalidated with If-None-Match.
+            Requests that reach the network go through the error limiter, which may raise EsiUnavailable.
+        :param req_and_resp: The tuple returned by calling an operation, e.g. esi_app.op['get_status']()
+        :param raw_body_only: Do not parse the response body into the swagger models.
+        :param priority: One of the PRIORITY_* constants.
+        :return: pyswagger Response
+        """
+        req, resp = req_and_resp
+        # Reset the request and response so operations can be reused.
+        req.reset()
+        resp.reset()
+        req.prepare(scheme='https', handle_files=False)
+
+        status, headers, body = await self._cached_send(req, priority)
+
+        if self.raise_on_error and status >= 400:
+            try:
+                json_response = json.loads(body)
+            except ValueError:
+                json_response = {}
+            raise APIException(
+                req.url,
+                status,
+                json_response=json_response,
+                request_param=req.query,
+                response_header=headers
+            )
+
+        resp.raw_body_only = raw_body_only
+        resp.apply_with(status=status, header=headers, raw=body)
+
+        return resp
+
+    async def multi_request(self, reqs_and_resps: list, raw_body_only: bool = False,
+                            priority: int = PRIORITY_LOW) -> list:
+        """
+        Sends several requests concurrently.
+        :param reqs_and_resps: A list of operation tuples.
+        :param raw_body_only:
+        :param priority:
+        :return: A list of pyswagger Responses, in the same order as the requests.
+        """
+        return await asyncio.gather(*[
+            self.request(x, raw_body_only=raw_body_only, priority=priority) for x in reqs_and_resps
+        ])
+
+    def cache_key(self, req) -> tuple:
+        return req.url, tuple(sorted((k, str(v)) for k, v in req.query))
+
+    async def _cached_send(self, req, priority: int) -> tuple:
+        """
+        Sends a prepared request through the response cache.
+            Concurrent identical GETs that miss the cache share a single upstream call.
+        :param req:
+        :param priority:
+        :return: (status, headers, body)
+        """
+        if self.cache is None or req.method.lower() != 'get':
+            return await self._send(req, priority)
+
+        key = self.cache_key(req)
+        entry = self.cache.get(key)
+        if entry is not None and entry[3] > time.time():
+            self._count('hits')
+            return entry[:3]
+
+        try:
+            return await self.flights.do(key, lambda: self._fetch(req, priority, key))
+        except EsiUnavailable:
+            # The shared call may have been shed at a lower priority than this caller's.
+            if priority >= PRIORITY_LOW:
+                raise
+            return await self._fetch(req, priority, key)
+
+    async def _fetch(self, req, priority: int, key) -> tuple:
+        """
+        Fetches a GET from ESI, revalidating any cached copy, and updates the cache.
+        :param req:
+        :param priority:
+        :param key:
+        :return: (status, headers, body)
+        """
+        entry = self.cache.get(key)
+        headers = None
+        if entry is not None and entry[4] is not None:
+            headers = dict(req.header)
+            headers['If-None-Match'] = entry[4]
+
+        status, response_headers, body = await self._send(req, priority, headers=headers)
+        if status == 304 and entry is not None:
+            self._count('revalidated')
+            return self.cache.refresh(key, entry, response_headers)[:3]
+
+        self._count('misses')
+        if status == 200:
+            self.cache.set(key, status, response_headers, body)
+        else:
+            self.cache.pop(key)
+
+        return status, response_headers, body
+
+    @staticmethod
+    def _count(outcome: str):
+        """
+        Counts a cache outcome and updates the hit rate. Revalidated responses count as hits.
+        :param outcome: hits, revalidated or misses.
+        :return:
+        """
+        metrics.incr(f'esi.cache.{outcome}')
+        hits = metrics.counters.get('esi.cache.hits', 0) + metrics.counters.get('esi.cache.revalidated', 0)
+        total = hits + metrics.counters.get('esi.cache.misses', 0)
+        metrics.gauge('esi.cache.hit_rate', round(hits / total, 3))
+
+    async def _send(self, req, priority: int, headers: dict = None, _retry: int = 0) -> tuple:
+        """
+        Sends a prepared pyswagger request, retrying server errors with a backoff.
+        :param req:
+        :param priority:
+        :param headers: Headers to send instead of req.header.
+        :param _retry:
+        :return: (status, headers, body)
+        """
+        if _retry:
+            # Backoff delay in seconds: 0.01, 0.16, 0.81, 2.56
+            await asyncio.sleep(_retry ** 4 / 100)
+
+        await self.limiter.acquire(priority)
+        params = [(k, str(v)) for k, v in req.query]
+        async with self.session.request(req.method.upper(), req.url, params=params,
+                                        data=req.data, headers=headers or req.header) as response:
+            body = await response.read()
+            status = response.status
+            response_headers = dict(response.headers)
+        self.limiter.update(status, response_headers)
+
+        if self.retry_requests and 500 <= status <= 599 and _retry < 4:
+            logger.debug(f'ESI returned {status} for {req.url}, retrying.')
+            return await self._send(req, priority, headers=headers, _retry=_retry + 1)
+
+        return status, response_headers, body
@@ -0,0 +1,126 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class Timing:
+    """
+    Keeps a rolling window of duration samples (in seconds) along with lifetime totals.
+    """
+    def __init__(self, size: int = 1024):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def percentile(self, pct: float) -> float:
+        """
+        Returns the given percentile of the current window.
+        :param pct: 0-100
+        :return:
+        """
+        if len(self.samples) == 0:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'avg': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': max(self.samples) if self.samples else 0.0,
+        }
+
+
+# Upper bounds, in seconds, of the default latency histogram buckets.
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """
+    Lifetime counts of observations per bucket. The last bucket counts everything above the largest bound.
+    """
+    def __init__(self, bounds: tuple = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def summary(self) -> list:
+        """
+        :return: A list of (upper bound, count) tuples. The bound of the last bucket is None.
+        """
+        return list(zip(self.bounds + (None,), self.counts))
+
+
+class Metrics:
+    """
+    A minimal in-process metrics registry of counters, gauges and timings.
+        Names are dotted, with the component first (e.g. kill_watch.queue_depth).
+    """
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+        self.histograms = {}
+
+    def incr(self, name: str, value: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name: str, value):
+        self.gauges[name] = value
+
+    def observe(self, name: str, seconds: float):
+        if name not in self.timings:
+            self.timings[name] = Timing()
+        self.timings[name].observe(seconds)
+
+    def histogram(self, name: str, seconds: float):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        self.histograms[name].observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str, histogram: bool = False):
+        """
+        Times the body of a with block.
+        :param name:
+        :param histogram: Also count the duration in a latency histogram of the same name.
+        :return:
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe(name, elapsed)
+            if histogram:
+                self.histogram(name, elapsed)
+
+    def summary(self, prefix: str = '') -> dict:
+        """
+        Returns a snapshot of every metric whose name starts with prefix.
+        :param prefix:
+        :return:
+        """
+        return {
+            'counters': {k: v for k, v in sorted(self.counters.items()) if k.startswith(prefix)},
+            'gauges': {k: v for k, v in sorted(self.gauges.items()) if k.startswith(prefix)},
+            'timings': {k: v.summary() for k, v in sorted(self.timings.items()) if k.startswith(prefix)},
+            'histograms': {k: v.summary() for k, v in sorted(self.histograms.items()) if k.startswith(prefix)},
+        }
+
+
+metrics = Metrics()
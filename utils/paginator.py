@@ -0,0 +1,52 @@
+import asyncio
+
+import discord
+
+PREVIOUS = '◀'
+NEXT = '▶'
+
+
+async def paginate(bot, ctx, pages: list, timeout: float = 120.0, content: str = None):
+    """
+    Sends a list of embeds as one message that can be paged through with reactions by the command's author.
+    :param bot:
+    :param ctx:
+    :param pages: A list of discord Embeds.
+    :param timeout: Seconds without a page change after which the reactions stop working.
+    :param content: Optional text sent with the message.
+    :return: The sent message.
+    """
+    if len(pages) > 1:
+        for i, page in enumerate(pages):
+            page.set_footer(text=f'Page {i + 1}/{len(pages)}')
+
+    message = await ctx.send(content, embed=pages[0])
+    if len(pages) == 1:
+        return message
+
+    for emoji in (PREVIOUS, NEXT):
+        await message.add_reaction(emoji)
+
+    def check(reaction, user):
+        return user == ctx.author and reaction.message.id == message.id and str(reaction.emoji) in (PREVIOUS, NEXT)
+
+    current = 0
+    while True:
+        try:
+            reaction, user = await bot.wait_for('reaction_add', timeout=timeout, check=check)
+        except asyncio.TimeoutError:
+            break
+
+        current = (current + (1 if str(reaction.emoji) == NEXT else -1)) % len(pages)
+        await message.edit(embed=pages[current])
+        try:
+            await message.remove_reaction(reaction.emoji, user)
+        except discord.Forbidden:
+            pass    # Without manage messages the author has to remove their own reaction.
+
+    try:
+        await message.clear_reactions()
+    except discord.HTTPException:
+        pass
+
+    return message
@@ -0,0 +1,338 @@
+import asyncio
+import bz2
+import csv
+import gzip
+import io
+import json
+import sys
+from array import array
+from bisect import bisect_left
+from collections import Counter, namedtuple
+from typing import Optional
+
+import aiohttp
+
+from .loggers import get_logger
+
+logger = get_logger(__name__)
+
+SDE_URL = 'https://www.fuzzwork.co.uk/dump/latest/{table}.csv.bz2'
+UNIVERSE_PATH = 'data/universe.json.gz'
+TYPES_PATH = 'data/types.json.gz'
+
+System = namedtuple('System', ('system_id', 'name', 'constellation_id', 'region_id', 'security'))
+Constellation = namedtuple('Constellation', ('constellation_id', 'name', 'region_id'))
+Region = namedtuple('Region', ('region_id', 'name'))
+
+
+async def fetch_sde_table(session: aiohttp.ClientSession, table: str) -> list:
+    """
+    Downloads a table from fuzzwork's CSV conversion of the static data export.
+    :param session:
+    :param table: The SDE table name, e.g. mapSolarSystems
+    :return: A list of dicts, one per row.
+    """
+    async with session.get(SDE_URL.format(table=table)) as response:
+        response.raise_for_status()
+        raw = await response.read()
+
+    # Whole tables take seconds to decompress and parse, so keep it off the event loop.
+    return await asyncio.get_event_loop().run_in_executor(None, _parse_sde_table, raw)
+
+
+def _parse_sde_table(raw: bytes) -> list:
+    """
+    Decompresses and parses a downloaded SDE table.
+    :param raw: The bz2 compressed CSV.
+    :return: A list of dicts, one per row.
+    """
+    text = bz2.decompress(raw).decode('utf-8')
+    return list(csv.DictReader(io.StringIO(text)))
+
+
+class UniverseIndex:
+    """
+    In memory index of every system, constellation and region in New Eden.
+        These never change between expansions, so the index is built once from the SDE and stored on disk in a
+        compact columnar form. All lookups are dict reads.
+    """
+    def __init__(self):
+        self.systems = {}
+        self.constellations = {}
+        self.regions = {}
+        self._system_names = {}
+
+    @property
+    def loaded(self) -> bool:
+        return len(self.systems) != 0
+
+    def system(self, system_id: int) -> Optional[System]:
+        return self.systems.get(int(system_id))
+
+    def constellation(self, constellation_id: int) -> Optional[Constellation]:
+        return self.constellations.get(int(constellation_id))
+
+    def region(self, region_id: int) -> Optional[Region]:
+        return self.regions.get(int(region_id))
+
+    def system_from_name(self, name: str) -> Optional[System]:
+        """
+        Case insensitive lookup of a system by name.
+        :param name:
+        :return:
+        """
+        return self._system_names.get(name.strip().lower())
+
+    def add_region(self, region_id: int, name: str):
+        self.regions[region_id] = Region(region_id, name)
+
+    def add_constellation(self, constellation_id: int, name: str, region_id: int):
+        self.constellations[constellation_id] = Constellation(constellation_id, name, region_id)
+
+    def add_system(self, system_id: int, name: str, constellation_id: int, region_id: int, security: float):
+        system = System(system_id, name, constellation_id, region_id, security)
+        self.systems[system_id] = system
+        self._system_names[name.lower()] = system
+
+    def save(self, path: str = UNIVERSE_PATH):
+        """
+        Writes the index to disk as gzipped columns.
+        :param path:
+        :return:
+        """
+        systems = list(self.systems.values())
+        constellations = list(self.constellations.values())
+        regions = list(self.regions.values())
+        data = {
+            'systems': {
+                'id': [x.system_id for x in systems],
+                'name': [x.name for x in systems],
+                'constellation_id': [x.constellation_id for x in systems],
+                'security': [round(x.security, 4) for x in systems],
+            },
+            'constellations': {
+                'id': [x.constellation_id for x in constellations],
+                'name': [x.name for x in constellations],
+                'region_id': [x.region_id for x in constellations],
+            },
+            'regions': {
+                'id': [x.region_id for x in regions],
+                'name': [x.name for x in regions],
+            },
+        }
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            json.dump(data, f, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, path: str = UNIVERSE_PATH) -> 'UniverseIndex':
+        """
+        Loads an index previously written by save().
+        :param path:
+        :return:
+        """
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            data = json.load(f)
+
+        index = cls()
+        regions = data['regions']
+        for region_id, name in zip(regions['id'], regions['name']):
+            index.add_region(region_id, name)
+        constellations = data['constellations']
+        for constellation_id, name, region_id in zip(
+                constellations['id'], constellations['name'], constellations['region_id']):
+            index.add_constellation(constellation_id, name, region_id)
+        systems = data['systems']
+        for system_id, name, constellation_id, security in zip(
+                systems['id'], systems['name'], systems['constellation_id'], systems['security']):
+            region_id = index.constellations[constellation_id].region_id
+            index.add_system(system_id, name, constellation_id, region_id, security)
+
+        return index
+
+    @classmethod
+    async def build(cls, session: aiohttp.ClientSession) -> 'UniverseIndex':
+        """
+        Builds the index from the SDE map tables.
+        :param session:
+        :return:
+        """
+        index = cls()
+        for row in await fetch_sde_table(session, 'mapRegions'):
+            index.add_region(int(row['regionID']), row['regionName'])
+        for row in await fetch_sde_table(session, 'mapConstellations'):
+            index.add_constellation(int(row['constellationID']), row['constellationName'], int(row['regionID']))
+        for row in await fetch_sde_table(session, 'mapSolarSystems'):
+            index.add_system(
+                int(row['solarSystemID']),
+                row['solarSystemName'],
+                int(row['constellationID']),
+                int(row['regionID']),
+                float(row['security'])
+            )
+
+        return index
+
+
+def trigrams(text: str) -> set:
+    """
+    Returns the set of character trigrams of a lowercased, padded string.
+    :param text:
+    :return:
+    """
+    padded = f'  {text.lower()} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TypeIndex:
+    """
+    In memory index of every published inventory type, for resolving type names without ESI.
+        Names are interned and kept in one list sorted case-insensitively, with the type IDs in a parallel array, so
+        exact and prefix lookups are a binary search. A second pair of arrays, sorted by ID, serves ID -> name.
+        Typo tolerant lookups use a trigram index. Everything is built up front, which takes a few seconds for the
+        full type list, so build and load the index in an executor.
+    """
+    def __init__(self, types=()):
+        """
+        :param types: An iterable of (type_id, name) tuples.
+        """
+        ordered = sorted(((sys.intern(name), type_id) for type_id, name in types), key=lambda x: x[0].lower())
+        self.names = [x[0] for x in ordered]
+        self._lower = [x.lower() for x in self.names]
+        self.ids = array('l', [x[1] for x in ordered])
+
+        by_id = sorted(range(len(self.ids)), key=lambda i: self.ids[i])
+        self._sorted_ids = array('l', [self.ids[i] for i in by_id])
+        self._id_positions = array('l', by_id)
+
+        self._trigrams = {}
+        self._trigram_counts = array('H')
+        self._build_trigrams()
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def loaded(self) -> bool:
+        return len(self.names) != 0
+
+    def name(self, type_id: int) -> Optional[str]:
+        """
+        Returns the name of a type.
+        :param type_id:
+        :return:
+        """
+        type_id = int(type_id)
+        i = bisect_left(self._sorted_ids, type_id)
+        if i < len(self._sorted_ids) and self._sorted_ids[i] == type_id:
+            return self.names[self._id_positions[i]]
+        return None
+
+    def exact(self, name: str) -> Optional[tuple]:
+        """
+        Case insensitive lookup of a type by its full name.
+        :param name:
+        :return: (type_id, name) or None.
+        """
+        key = name.strip().lower()
+        i = bisect_left(self._lower, key)
+        # Several types can share a name apart from case, prefer the one that matches exactly.
+        match = None
+        while i < len(self._lower) and self._lower[i] == key:
+            if match is None or self.names[i] == name.strip():
+                match = (self.ids[i], self.names[i])
+            i += 1
+        return match
+
+    def prefix(self, prefix: str, limit: int = 10) -> list:
+        """
+        Returns types whose names start with the given prefix, case insensitively, in alphabetical order.
+        :param prefix:
+        :param limit:
+        :return: A list of (type_id, name) tuples.
+        """
+        key = prefix.strip().lower()
+        i = bisect_left(self._lower, key)
+        matches = []
+        while i < len(self._lower) and len(matches) < limit and self._lower[i].startswith(key):
+            matches.append((self.ids[i], self.names[i]))
+            i += 1
+        return matches
+
+    def _build_trigrams(self):
+        for i, name in enumerate(self._lower):
+            grams = trigrams(name)
+            self._trigram_counts.append(len(grams))
+            for gram in grams:
+                self._trigrams.setdefault(gram, array('l')).append(i)
+
+    def fuzzy(self, name: str, limit: int = 5, threshold: float = 0.5) -> list:
+        """
+        Typo tolerant lookup, scoring names by the Dice similarity of their trigrams.
+        :param name:
+        :param limit:
+        :param threshold: Minimum similarity, between 0 and 1.
+        :return: A list of (type_id, name, score) tuples, best first.
+        """
+        grams = trigrams(name.strip())
+        shared = Counter()
+        for gram in grams:
+            shared.update(self._trigrams.get(gram, ()))
+
+        scored = []
+        for i, count in shared.items():
+            score = 2 * count / (len(grams) + self._trigram_counts[i])
+            if score >= threshold:
+                scored.append((score, i))
+        scored.sort(key=lambda x: (-x[0], len(self.names[x[1]])))
+
+        return [(self.ids[i], self.names[i], round(score, 3)) for score, i in scored[:limit]]
+
+    def resolve(self, name: str) -> Optional[tuple]:
+        """
+        Resolves a user supplied name: an exact match, else the only type with that prefix, else the best fuzzy match.
+        :param name:
+        :return: (type_id, name) or None.
+        """
+        match = self.exact(name)
+        if match is not None:
+            return match
+
+        matches = self.prefix(name, limit=2)
+        if len(matches) == 1:
+            return matches[0]
+
+        matches = self.fuzzy(name, limit=1, threshold=0.6)
+        if len(matches) != 0:
+            return matches[0][:2]
+        return None
+
+    def save(self, path: str = TYPES_PATH):
+        """
+        Writes the index to disk as gzipped columns.
+        :param path:
+        :return:
+        """
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            json.dump({'id': list(self.ids), 'name': self.names}, f, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, path: str = TYPES_PATH) -> 'TypeIndex':
+        """
+        Loads an index previously written by save().
+        :param path:
+        :return:
+        """
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(zip(data['id'], data['name']))
+
+    @classmethod
+    async def build(cls, session: aiohttp.ClientSession) -> 'TypeIndex':
+        """
+        Builds the index from the SDE invTypes table. Parsing and indexing run in an executor.
+        :param session:
+        :return:
+        """
+        rows = await fetch_sde_table(session, 'invTypes')
+        types = [(int(x['typeID']), x['typeName']) for x in rows if x['published'] == '1']
+        return await asyncio.get_event_loop().run_in_executor(None, cls, types)
@@ -0,0 +1,35 @@
+import asyncio
+
+from .metrics import metrics
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls.
+        While a call for a key is in flight, later callers with the same key wait on it instead of making their own.
+        The call runs as its own task, so a caller being cancelled does not cancel it for everyone else.
+    """
+    def __init__(self, name: str):
+        """
+        :param name: Metrics label, e.g. http or esi.
+        """
+        self.name = name
+        self.flights = {}
+
+    async def do(self, key, fn):
+        """
+        Returns the result of fn(), sharing one call between concurrent callers with the same key.
+        :param key: A hashable, normalized description of the request.
+        :param fn: A function returning an awaitable. It is only called if no call for the key is in flight.
+        :return:
+        """
+        task = self.flights.get(key)
+        if task is None:
+            metrics.incr(f'singleflight.{self.name}.calls')
+            task = asyncio.ensure_future(fn())
+            self.flights[key] = task
+            task.add_done_callback(lambda _: self.flights.pop(key, None))
+        else:
+            metrics.incr(f'singleflight.{self.name}.saved')
+
+        return await asyncio.shield(task)
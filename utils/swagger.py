@@ -0,0 +1,98 @@
+import os
+import urllib.request
+from pathlib import Path
+from typing import Optional
+
+from pyswagger import App
+
+from .loggers import get_logger
+
+logger = get_logger(__name__)
+
+SWAGGER_URL = 'https://esi.evetech.net/latest/swagger.json?datasource=tranquility'
+SWAGGER_PATH = 'data/swagger.json'
+SWAGGER_ETAG_PATH = 'data/swagger.etag'
+
+
+def _parse(path: str = SWAGGER_PATH) -> App:
+    """
+    Parses a swagger document on disk into a pyswagger app.
+    :param path:
+    :return:
+    """
+    return App.create(Path(path).absolute().as_uri())
+
+
+def _save(body: bytes, etag: Optional[str]):
+    """
+    Writes a swagger document and its ETag to the cache. The document is written to a temporary file first so a
+    partial download never replaces a good copy.
+    :param body:
+    :param etag:
+    :return:
+    """
+    tmp = f'{SWAGGER_PATH}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(body)
+    os.replace(tmp, SWAGGER_PATH)
+
+    if etag is not None:
+        with open(SWAGGER_ETAG_PATH, 'w') as f:
+            f.write(etag)
+    elif os.path.exists(SWAGGER_ETAG_PATH):
+        os.remove(SWAGGER_ETAG_PATH)
+
+
+def cached_etag() -> Optional[str]:
+    if not os.path.exists(SWAGGER_ETAG_PATH):
+        return None
+    with open(SWAGGER_ETAG_PATH, 'r') as f:
+        return f.read().strip() or None
+
+
+def load_swagger(user_agent: str) -> App:
+    """
+    Returns the ESI swagger app, from the on-disk cache when there is one.
+        On the first run (or if the cache is unreadable) the spec is downloaded, blocking, and cached.
+    :param user_agent:
+    :return:
+    """
+    if os.path.exists(SWAGGER_PATH):
+        try:
+            return _parse()
+        except Exception as e:
+            logger.warning(f'Cached ESI swagger spec could not be parsed, downloading it again. Error: {e}')
+
+    logger.info('Downloading the ESI swagger spec.')
+    request = urllib.request.Request(
+        SWAGGER_URL,
+        headers={'User-Agent': f'application: MercuryBot contact: {user_agent}'}
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        _save(response.read(), response.headers.get('ETag'))
+
+    return _parse()
+
+
+async def refresh_swagger(session, loop) -> Optional[App]:
+    """
+    Checks ESI for a newer swagger spec, revalidating the cached copy with its ETag.
+    :param session: An aiohttp session.
+    :param loop:
+    :return: The newly parsed app, or None if the cached spec is still current.
+    """
+    headers = {}
+    etag = cached_etag()
+    if etag is not None:
+        headers['If-None-Match'] = etag
+
+    async with session.get(SWAGGER_URL, headers=headers) as response:
+        if response.status == 304:
+            return None
+        response.raise_for_status()
+        body = await response.read()
+        etag = response.headers.get('ETag')
+
+    # Writing and parsing the spec takes a few seconds, so keep it off the event loop.
+    await loop.run_in_executor(None, _save, body, etag)
+    return await loop.run_in_executor(None, _parse)